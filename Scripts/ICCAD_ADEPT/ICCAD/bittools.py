@@ -7,11 +7,43 @@ else:
     print('Numba unavailable. Falling back to pure python')
 
 
-_pop_count_lut = np.asarray([bin(x).count('1') for x in range(256)])
+_pop_count_lut = np.asarray([bin(x).count('1') for x in range(256)], dtype='uint8')
+
+
+if hasattr(np, 'bitwise_count'):
+    _bitwise_count = np.bitwise_count
+else:
+    def _bitwise_count(a):
+        a = np.ascontiguousarray(a)
+        return _pop_count_lut[a.view('uint8')].reshape(a.shape + (a.itemsize,)).sum(axis=-1, dtype='uint8')
+
+
+def _words(a):
+    # uint64 view of the last axis of a if possible, a itself otherwise.
+    a = np.asarray(a)
+    if a.dtype == np.uint8 and a.ndim > 0 and a.shape[-1] % 8 == 0 and a.flags.c_contiguous:
+        return a.view('uint64')
+    return a
 
 
 def popcount(a):
-    return np.sum(_pop_count_lut[a])
+    return int(_bitwise_count(_words(a)).sum(dtype='int64'))
+
+
+@numba.njit
+def popcount_masked(a, mask):
+    # number of bits set in both uint8 arrays a and mask, callable from jitted kernels.
+    count = 0
+    for i in range(len(a)):
+        count += _pop_count_lut[a[i] & mask[i]]
+    return count
+
+
+def popcount_batch(a, axis=-1):
+    a = np.asarray(a)
+    if axis == -1 or axis == a.ndim - 1:
+        a = _words(a)
+    return _bitwise_count(a).sum(axis=axis, dtype='int64')
 
 
 _bit_in_lut = np.array([2 ** x for x in range(7, -1, -1)], dtype='uint8')
@@ -22,27 +54,23 @@ def bit_in(a, pos):
     return a[pos >> 3] & _bit_in_lut[pos & 7]
 
 
-def make_count_into_lut():
-    lut = np.zeros((256, 8), dtype='int')
-    for i, l in enumerate(lut):
-        for p in range(8):
-            if i & (1 << (7-p)):
-                l[p] = 1
-    return lut
+def count_into(bits, counts, rows=1024):
+    bits = np.asarray(bits)
+    bits = bits.reshape(-1, bits.shape[-1])
+    nbits = min(len(counts), bits.shape[-1] * 8)
+    for r in range(0, len(bits), rows):
+        counts[:nbits] += np.unpackbits(bits[r:r + rows], axis=-1, count=nbits).sum(axis=0, dtype='int64')
 
 
-_count_into_lut = make_count_into_lut()
-
-
-@numba.njit
-def count_into(bits, counts):
-    for pidx in range(len(bits)):
-        p = bits[pidx]
-        for i, byte in enumerate(p):
-            if byte == 0: continue
-            mx = min(8, len(counts)-i*8)
-            if mx > 0:
-                counts[i*8:(i+1)*8] += _count_into_lut[byte, :mx]
+def count_batch(bits, axis=0, nbits=None):
+    # number of set bits at each bit position of the last axis, reduced along axis.
+    bits = np.asarray(bits)
+    if nbits is None:
+        nbits = bits.shape[-1] * 8
+    if axis < 0:
+        axis += bits.ndim
+    assert axis != bits.ndim - 1
+    return np.unpackbits(bits, axis=-1, count=nbits).sum(axis=axis, dtype='int64')
 
 
 @numba.njit
@@ -0,0 +1,420 @@
+from lark import Lark, Transformer
+from collections import namedtuple, defaultdict
+import os
+import re
+from .circuit import Node, Line
+
+
+Gate = namedtuple('Gate', ['kind', 'output', 'inputs'])
+
+# 2-input (or 1-input) circuit node kinds used for decompositions.
+_split_kinds = {'and': 'AND2', 'or': 'OR2', 'nand': 'NAND2', 'nor': 'NOR2', 'xor': 'XOR2', 'xnor': 'XNOR2',
+                'not': 'INV', 'buf': 'NBUFF'}
+_base_kinds = {'nand': 'and', 'nor': 'or', 'xnor': 'xor'}
+# node kinds outside of libraries (generic circuit nodes, .bench gates) and their primitives.
+_generic_kinds = {'__const0__': 'const0', '__const1__': 'const1', 'inv': 'not', 'and': 'and', 'nand': 'nand',
+                  'or': 'or', 'nor': 'nor', 'xor': 'xor', 'xnor': 'xnor', 'not': 'not', 'buf': 'buf'}
+
+_cache = {}
+
+
+class Cell:
+    def __init__(self, name, inputs, outputs, gates=None, tables=None, sequential=False):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.sequential = sequential
+        self.tables = tuple(tables) if tables is not None else _evaluate(self.inputs, self.outputs, gates)
+        self.primitive = 'dff' if sequential else _primitive(self.tables, len(self.inputs))
+        # per output: minimal sum-of-products, and all primes of the on-set and off-set as lists of
+        # (input index, polarity) literals.
+        self.covers = []
+        self.primes = []
+        if not sequential:
+            k = len(self.inputs)
+            full = (1 << (1 << k)) - 1
+            self.covers = [_literals(_cover(t, k), k) for t in self.tables]
+            self.primes = [(_literals(_primes(t, k), k), _literals(_primes(full ^ t, k), k)) for t in self.tables]
+        if sequential or (self.primitive is not None and len(self.inputs) <= 2):
+            self.decomposition = []
+        elif gates is not None:
+            self.decomposition = _split_gates(name, gates)
+        else:
+            self.decomposition = _sop_gates(self.inputs, self.outputs, self.tables)
+
+    def __repr__(self):
+        return f'<Cell {self.name}({",".join(self.inputs)} -> {",".join(self.outputs)}) {self.primitive}>'
+
+
+class Library:
+    def __init__(self, cells, drive_suffix=r'X[0-9]+$'):
+        self.cells = cells
+        self.drive_suffix = re.compile(drive_suffix)
+        self._kinds = {}
+
+    def cell(self, kind):
+        if kind not in self._kinds:
+            cell = self.cells.get(kind)
+            if cell is None:
+                cell = self.cells.get(self.drive_suffix.sub('', kind))
+            self._kinds[kind] = cell
+        return self._kinds[kind]
+
+    def primitive(self, kind):
+        cell = self.cell(kind)
+        return cell.primitive if cell is not None else None
+
+    def truth_table(self, kind, k):
+        # truth table of the single output of a combinational node with k inputs, None if unknown.
+        cell = self.cell(kind)
+        if cell is not None:
+            if cell.sequential or len(cell.outputs) != 1 or len(cell.inputs) != k:
+                return None
+            return cell.tables[0]
+        prim = _generic_kinds.get(kind.lower())
+        if prim is None:
+            return None
+        if prim.startswith('const'):
+            return ((1 << (1 << k)) - 1) if prim == 'const1' else 0
+        inputs = [f'i{j}' for j in range(k)]
+        return _evaluate(inputs, ['z'], [Gate(prim, 'z', inputs)])[0]
+
+    def pin_index(self, kind, pin):
+        cell = self.cell(kind)
+        if cell is None:
+            return None
+        if pin in cell.inputs:
+            return cell.inputs.index(pin)
+        if pin in cell.outputs:
+            return cell.outputs.index(pin)
+        return None
+
+    def split_complex_gates(self, circuit):
+        """Replaces every node of a cell with a decomposition by its 1- and 2-input gates, in place.
+
+        This covers all cells with more than two inputs or without a primitive function, including plain
+        AND3, NAND4 or OR4, and not just the AO/OA/AOI221/NOR3 families the earlier SAED-specific split handled.
+        WaveSim only evaluates nodes with up to two inputs and raises ValueError for others (it used to read
+        only their first two inputs), so netlists must be split before WaveSim.
+        """
+        for n in list(circuit.nodes):
+            cell = self.cell(n.kind)
+            if cell is not None and len(cell.decomposition) > 0:
+                _split_node(circuit, n, cell)
+
+    def __repr__(self):
+        return f'<Library with {len(self.cells)} cells>'
+
+
+def load(path):
+    """Compiles a cell library from a Verilog primitive description (.vlib, .v) or a truth-table file (.tt).
+
+    Results are cached in memory per path and modification time.
+    """
+    path = os.path.abspath(path)
+    key = (path, os.path.getmtime(path))
+    if key not in _cache:
+        with open(path, 'r') as f:
+            text = f.read()
+        _cache[key] = Library(parse_tt(text) if path.endswith('.tt') else parse_vlib(text))
+    return _cache[key]
+
+
+class VlibTransformer(Transformer):
+    @staticmethod
+    def net(args): return str(args[0])
+
+    @staticmethod
+    def gate(args):
+        kind = str(args[0])
+        nets = [a for a in args[1:] if not hasattr(a, 'type')]
+        if kind in ('not', 'buf'):
+            return [Gate(kind, o, [nets[-1]]) for o in nets[:-1]]
+        return [Gate(kind, nets[0], nets[1:])]
+
+    @staticmethod
+    def input(args): return 'input', [str(a) for a in args]
+
+    @staticmethod
+    def output(args): return 'output', [str(a) for a in args]
+
+    @staticmethod
+    def wire(args): return 'wire', [str(a) for a in args]
+
+    @staticmethod
+    def module(args):
+        name = str(args[0])
+        ports = [str(a) if a is not None else '' for a in args[1].children]
+        declared = {}
+        gates = []
+        for stmt in args[2:]:
+            if isinstance(stmt, tuple):
+                for n in stmt[1]:
+                    declared[n] = stmt[0]
+            else:
+                gates += stmt
+        inputs = [p for p in ports if p == '' or declared.get(p) == 'input']  # '' for unused positions
+        outputs = [p for p in ports if declared.get(p) == 'output']
+        sequential = any(g.kind == 'dff' for g in gates)
+        return name, Cell(name, inputs, outputs, gates=gates, sequential=sequential)
+
+    @staticmethod
+    def start(args): return dict(args)
+
+
+def parse_vlib(text):
+    grammar = r"""
+    start: module*
+    module: "module" NAME ports ";" _statement* "endmodule"
+    ports: "(" [NAME] ( "," [NAME] )* ")"
+    _statement: input | output | wire | gate
+    input: "input" NAME ( "," NAME )* ";"
+    output: "output" NAME ( "," NAME )* ";"
+    wire: "wire" NAME ( "," NAME )* ";"
+    gate: PRIMITIVE NAME? "(" net ( "," net )* ")" ";"
+    net: NAME | CONST
+    PRIMITIVE: "and" | "or" | "nand" | "nor" | "xor" | "xnor" | "not" | "buf" | "dff"
+    CONST: "1'b0" | "1'b1"
+    NAME: /[a-z_][a-z0-9_]*/i
+    COMMENT: "//" /[^\n]*/
+    %ignore ( /\r?\n/ | COMMENT )+
+    %ignore /[\t\f ]+/
+    """
+    return Lark(grammar, parser="lalr", transformer=VlibTransformer()).parse(text)
+
+
+def parse_tt(text):
+    # one cell per line: NAME INPUT... : OUTPUT=TABLE ...
+    # TABLE is an integer (any Python literal base) with bit i holding the output value for the input
+    # combination i, where the first input is the least significant bit of i.
+    cells = {}
+    for line in text.splitlines():
+        line = line.split('#')[0].strip()
+        if len(line) == 0:
+            continue
+        lhs, rhs = line.split(':')
+        name, *inputs = lhs.split()
+        outputs = []
+        tables = []
+        for assignment in rhs.split():
+            pin, table = assignment.split('=')
+            outputs.append(pin)
+            tables.append(int(table, 0))
+        cells[name] = Cell(name, inputs, outputs, tables=tables)
+    return cells
+
+
+def _evaluate(inputs, outputs, gates):
+    # truth tables of all outputs as integers, bit i is the value for input combination i.
+    size = 1 << len(inputs)
+    full = (1 << size) - 1
+    values = {"1'b0": 0, "1'b1": full}
+    for j, pin in enumerate(inputs):
+        values[pin] = sum(1 << i for i in range(size) if (i >> j) & 1)
+    pending = list(gates)
+    while len(pending) > 0:
+        ready = [g for g in pending if all(i in values for i in g.inputs)]
+        if len(ready) == 0:
+            raise ValueError(f'undriven or cyclic nets in {[g.output for g in pending]}')
+        for g in ready:
+            ins = [values[i] for i in g.inputs]
+            base = _base_kinds.get(g.kind, g.kind)
+            v = ins[0]
+            for i in ins[1:]:
+                if base == 'and':
+                    v &= i
+                elif base == 'or':
+                    v |= i
+                elif base == 'xor':
+                    v ^= i
+            if g.kind in ('nand', 'nor', 'xnor', 'not'):
+                v ^= full
+            values[g.output] = v
+            pending.remove(g)
+    return [values[o] for o in outputs]
+
+
+def _primitive(tables, k):
+    if len(tables) != 1:
+        return None
+    table = tables[0]
+    size = 1 << k
+    full = (1 << size) - 1
+    if k == 0:
+        return 'const1' if table else 'const0'
+    if k == 1:
+        return {0b10: 'buf', 0b01: 'not'}.get(table)
+    and_table = 1 << (size - 1)
+    xor_table = sum(1 << i for i in range(size) if bin(i).count('1') % 2)
+    candidates = {and_table: 'and', full ^ and_table: 'nand', full ^ 1: 'or', 1: 'nor',
+                  xor_table: 'xor', full ^ xor_table: 'xnor'}
+    return candidates.get(table)
+
+
+def _tree(kind, output, inputs, new_net):
+    # 2-input gates for a k-input primitive, as a balanced tree.
+    gates = []
+    base = _base_kinds.get(kind, kind)
+    level = list(inputs)
+    while len(level) > 2:
+        nxt = []
+        for i in range(0, len(level) - 1, 2):
+            net = new_net()
+            gates.append(Gate(_split_kinds[base], net, [level[i], level[i + 1]]))
+            nxt.append(net)
+        if len(level) % 2:
+            nxt.append(level[-1])
+        level = nxt
+    gates.append(Gate(_split_kinds[kind], output, level))
+    return gates
+
+
+def _net_counter(prefix):
+    count = [0]
+
+    def new_net():
+        count[0] += 1
+        return f'{prefix}{count[0]}'
+    return new_net
+
+
+def _split_gates(name, gates):
+    new_net = _net_counter('~t')
+    split = []
+    for g in gates:
+        if any(i.startswith("1'b") for i in g.inputs):
+            raise ValueError(f'constant inputs are not supported in complex cell {name}')
+        split += _tree(g.kind, g.output, g.inputs, new_net)
+    return split
+
+
+def _primes(table, k):
+    # all prime implicants of table as (mask, value) cubes. Input j is a literal of a cube if bit j of mask is set.
+    full_mask = (1 << k) - 1
+    cubes = {(full_mask, m) for m in range(1 << k) if (table >> m) & 1}
+    primes = set()
+    while len(cubes) > 0:
+        merged = set()
+        used = set()
+        for mask, value in cubes:
+            for j in range(k):
+                bit = 1 << j
+                if mask & bit and (mask, value ^ bit) in cubes:
+                    merged.add((mask & ~bit, value & ~bit))
+                    used.add((mask, value))
+        primes |= cubes - used
+        cubes = merged
+    return sorted(primes)
+
+
+def _literals(cubes, k):
+    return [[(j, (value >> j) & 1) for j in range(k) if (mask >> j) & 1] for mask, value in cubes]
+
+
+def _cover(table, k):
+    # greedy selection of prime implicants covering all minterms of table.
+    primes = _primes(table, k)
+    minterms = {m for m in range(1 << k) if (table >> m) & 1}
+    covers = [{m for m in minterms if (m & mask) == value} for mask, value in primes]
+    cover = []
+    for m in sorted(minterms):  # essential primes first
+        covering = [p for p in range(len(primes)) if m in covers[p]]
+        if len(covering) == 1 and primes[covering[0]] not in cover:
+            cover.append(primes[covering[0]])
+    for p in cover:
+        minterms -= covers[primes.index(p)]
+    while len(minterms) > 0:
+        best = max(range(len(primes)), key=lambda p: len(covers[p] & minterms))
+        cover.append(primes[best])
+        minterms -= covers[best]
+    return cover
+
+
+def _sop_gates(inputs, outputs, tables):
+    new_net = _net_counter('~s')
+    gates = []
+    inverted = {}
+    k = len(inputs)
+    for pin, table in zip(outputs, tables):
+        terms = []
+        for mask, value in _cover(table, k):
+            literals = []
+            for j, i in enumerate(inputs):
+                if not (mask >> j) & 1:
+                    continue
+                if (value >> j) & 1:
+                    literals.append(i)
+                else:
+                    if i not in inverted:
+                        inverted[i] = new_net()
+                        gates.append(Gate('INV', inverted[i], [i]))
+                    literals.append(inverted[i])
+            terms.append(literals)
+        if len(terms) == 0 or any(len(t) == 0 for t in terms):
+            raise ValueError(f'constant output {pin} is not supported in complex cells')
+        products = []
+        for literals in terms:
+            if len(literals) == 1:
+                products.append(literals[0])
+            else:
+                net = new_net()
+                gates += _tree('and', net, literals, new_net)
+                products.append(net)
+        if len(products) == 1:
+            gates.append(Gate('NBUFF', pin, products))
+        else:
+            gates += _tree('or', pin, products, new_net)
+    return gates
+
+
+def _split_node(circuit, n, cell):
+    name = n.name
+    ins = dict((pin, n.i_lines[i] if i < len(n.i_lines) else None) for i, pin in enumerate(cell.inputs))
+    outs = dict((pin, n.o_lines[i] if i < len(n.o_lines) else None) for i, pin in enumerate(cell.outputs))
+
+    # keep only the gates needed for connected outputs
+    needed = set(pin for pin, line in outs.items() if line is not None)
+    gates = []
+    for g in reversed(cell.decomposition):
+        if g.output in needed:
+            gates.insert(0, g)
+            needed.update(g.inputs)
+
+    n.remove()
+    nodes = []
+    readers = defaultdict(list)
+    for idx, g in enumerate(gates):
+        node = Node(circuit, f'{name}~{idx}', g.kind)
+        for pin, net in enumerate(g.inputs):
+            readers[net].append(node.i[pin])
+        nodes.append(node)
+
+    for pin, line in ins.items():
+        if line is None:
+            continue
+        rs = readers.get(pin, [])
+        if len(rs) == 0:  # input does not influence any connected output
+            line.driver.o_lines[line.driver_pin] = None
+            continue
+        line.reader, line.reader_pin = rs[0].node, rs[0].pin
+        rs[0].node.i_lines[rs[0].pin] = line
+        for r in rs[1:]:
+            Line(circuit, line.driver, r)
+
+    for node, g in zip(nodes, gates):
+        rs = readers.get(g.output, [])
+        out_line = outs.get(g.output)
+        if out_line is not None and len(rs) == 0:
+            node.o_lines[0] = out_line
+            out_line.driver, out_line.driver_pin = node, 0
+        elif out_line is None and len(rs) == 1:
+            Line(circuit, node, rs[0])
+        else:
+            fork = Node(circuit, f'{name}~{g.output}')
+            Line(circuit, node, fork)
+            for r in rs:
+                Line(circuit, fork, r)
+            if out_line is not None:
+                pin = len(fork.o_lines)
+                fork.o_lines[pin] = out_line
+                out_line.driver, out_line.driver_pin = fork, pin
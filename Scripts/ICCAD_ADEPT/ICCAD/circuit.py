@@ -189,6 +189,29 @@ class Circuit:
             if marks[n.index]:
                 yield n
 
+    def comb_fanin(self, origin_nodes):
+        """Yields the origin nodes and all nodes in their combinational fan-in, breadth-first from the origins.
+
+        Unlike fanin, the search stops at flip-flops that are not origins, they are sources of the cone.
+        """
+        origin_nodes = list(dict.fromkeys(origin_nodes))
+        marks = [False] * len(self.nodes)
+        for n in origin_nodes:
+            marks[n.index] = True
+        queue = deque(origin_nodes)
+        origins = len(queue)
+        while len(queue) > 0:
+            n = queue.popleft()
+            yield n
+            origins -= 1
+            if origins < 0 and 'DFF' in n.kind: continue
+            for line in n.i_lines:
+                if line is None: continue
+                pred = line.driver
+                if not marks[pred.index]:
+                    marks[pred.index] = True
+                    queue.append(pred)
+
     def fanout_free_regions(self):
         for stem in self.reversed_topological_order():
             if len(stem.o) == 1 and 'DFF' not in stem.kind: continue
@@ -0,0 +1,378 @@
+import numpy as np
+import importlib.util
+import time
+if importlib.util.find_spec('numba') is not None:
+    import numba
+else:
+    from . import numba
+    print('Numba unavailable. Falling back to pure python')
+from . import bittools
+from . import saed
+from .logic_sim import LogicSim
+from .wave_sim import WaveSim, TMAX, TMIN
+
+
+# node evaluation codes for library primitives
+_AND, _OR, _XOR, _BUF, _CONST0, _CONST1 = range(6)
+_prim_codes = {'and': (_AND, 0), 'nand': (_AND, 1), 'or': (_OR, 0), 'nor': (_OR, 1), 'xor': (_XOR, 0),
+               'xnor': (_XOR, 1), 'not': (_BUF, 1), 'buf': (_BUF, 0), 'const0': (_CONST0, 0),
+               'const1': (_CONST1, 0), 'dff': (_BUF, 0)}
+# primitives of node kinds outside of libraries, other kinds are matched by prefix like in LogicSim (.bench gates)
+_generic_prims = {'__fork__': 'buf', '__const0__': 'const0', '__const1__': 'const1', 'tieh': 'const1',
+                  'input': 'buf', 'output': 'buf', 'nbuff': 'buf', 'inv': 'not'}
+
+
+class FaultSim:
+    """Parallel-pattern single-fault simulator for stuck-at and transition faults on top of LogicSim.
+
+    Faults are (line index, value) pairs. For stuck-at faults, value is the stuck value. For transition faults,
+    value is the final value of the slow transition: (line, 1) is slow-to-rise, (line, 0) is slow-to-fall.
+    The circuit is simulated fault-free with LogicSim once per batch of patterns. Each fault is then
+    propagated event-driven from its site through its fanout cone up to the capturing interface nodes.
+    A pattern only detects a fault at captured lines without don't-care inputs in their fan-in cone.
+    Detected faults are dropped for the following batches.
+    Complex cells without a primitive function must be split with saed.split_complex_gates first.
+    """
+    def __init__(self, circuit, nvectors=512, library=None):
+        assert (nvectors % 8) == 0
+        self.circuit = circuit
+        self.nvectors = nvectors
+        library = library or saed.library
+        self.sim = LogicSim(circuit, nvectors, 1, library)
+
+        order = self.sim.order
+        nnodes = len(order)
+        self.codes = np.zeros((nnodes, 2), dtype='int8')
+        kind_codes = {}
+        in_ptr, in_lines, out_ptr, out_lines = [0], [], [0], []
+        for pos, n in enumerate(order):
+            if n.kind not in kind_codes:
+                kind_codes[n.kind] = self._kind_code(n.kind, library)
+            self.codes[pos] = kind_codes[n.kind]
+            in_lines += [line.index if line is not None else -1 for line in n.i_lines]
+            out_lines += [line.index if line is not None else -1 for line in n.o_lines]
+            in_ptr.append(len(in_lines))
+            out_ptr.append(len(out_lines))
+        self.in_ptr = np.asarray(in_ptr, dtype='int64')
+        self.in_lines = np.asarray(in_lines, dtype='int64')
+        self.out_ptr = np.asarray(out_ptr, dtype='int64')
+        self.out_lines = np.asarray(out_lines, dtype='int64')
+
+        # topological position of each line's reader, -1 for lines ending at interface nodes
+        pos = dict((n.index, p) for p, n in enumerate(order))
+        stops = set(n.index for n in self.sim.interface)
+        self.reader_pos = np.asarray([pos[line.reader.index] if line.reader is not None and
+                                      line.reader.index not in stops else -1 for line in circuit.lines],
+                                     dtype='int64')
+        self.observed = np.zeros(len(circuit.lines), dtype='bool')
+        self.observed[self.sim.capture_lines] = True
+
+        # interface positions in the fan-in cone of each captured line, as lists cone_pos[cone_ptr[i]:cone_ptr[i+1]].
+        # Empty cones hold len(self.sim.interface), a row of _care's window without don't-cares.
+        interface = dict((n, p) for p, n in enumerate(self.sim.interface))
+        cone_ptr, cone_pos = [0], []
+        for line in self.sim.capture_lines:
+            positions = set()
+            marks = set()
+            stack = [circuit.lines[line].driver]
+            while len(stack) > 0:
+                n = stack.pop()
+                if n in marks: continue
+                marks.add(n)
+                if n in interface:
+                    positions.add(interface[n])
+                    continue
+                stack.extend(pred.driver for pred in n.i_lines if pred is not None)
+            cone_pos += sorted(positions) or [len(self.sim.interface)]
+            cone_ptr.append(len(cone_pos))
+        self.cone_ptr = np.asarray(cone_ptr, dtype='int64')
+        self.cone_pos = np.asarray(cone_pos, dtype='int64')
+
+    @staticmethod
+    def _kind_code(kind, library):
+        prim = library.primitive(kind)
+        if prim is None:
+            if library.cell(kind) is not None:
+                raise ValueError(f'{kind} has no primitive function, split complex gates with saed.split_complex_gates '
+                                 f'first')
+            t = kind.lower()
+            prims = [p for p in _prim_codes if t.startswith(p)]
+            prim = _generic_prims.get(t, max(prims, key=len) if len(prims) > 0 else None)
+        if prim not in _prim_codes:
+            raise ValueError(f'Unsupported node kind for fault simulation: {kind}')
+        return _prim_codes[prim]
+
+    def stuck_at_faults(self):
+        return [(line.index, v) for line in self.circuit.lines for v in (0, 1)]
+
+    def transition_faults(self):
+        return [(line.index, v) for line in self.circuit.lines for v in (1, 0)]
+
+    def stuck_at(self, tests, faults=None):
+        """Grades faults (default: all stuck-at faults) with tests (PackedVectors of any vdim).
+
+        Returns the number of detecting patterns for each fault (0 for undetected faults, counted until the
+        batch that detected it) and the cumulative coverage after each batch.
+        """
+        faults = self.stuck_at_faults() if faults is None else faults
+        return self._grade(faults, tests, False)
+
+    def transition(self, tests8v, faults=None):
+        """Grades faults (default: all transition faults) with 8-valued launch/capture tests.
+
+        A fault is activated where the initial value of its line is ~value and the final value is value. The line
+        then keeps ~value in the capture frame. Returns detection counts and coverage like stuck_at().
+        """
+        faults = self.transition_faults() if faults is None else faults
+        return self._grade(faults, tests8v, True)
+
+    def _simulate(self, values, offset):
+        self.sim.assign(values[:, None], offset)
+        self.sim.propagate()
+        return self.sim.state[:, 0].copy()
+
+    def _care(self, care_bits, offset):
+        # per captured line, the patterns without don't-care inputs in its fan-in cone (all 255 elsewhere).
+        nbytes = self.sim.state.shape[-1]
+        window = np.full((len(self.sim.interface) + 1, nbytes), 255, dtype='uint8')
+        src = care_bits[:, offset // 8:offset // 8 + nbytes]
+        window[:len(src), :src.shape[-1]] = src
+        care = np.full((len(self.circuit.lines), nbytes), 255, dtype='uint8')
+        care[self.sim.capture_lines] = np.bitwise_and.reduceat(window[self.cone_pos], self.cone_ptr[:-1], axis=0)
+        return care
+
+    def _grade(self, faults, tests, transition):
+        faults = np.asarray(faults, dtype='int64').reshape(-1, 2)
+        detects = np.zeros(len(faults), dtype='int64')
+        coverage = []
+        nbytes = self.sim.state.shape[-1]
+        fstate = np.zeros((len(self.circuit.lines), nbytes), dtype='uint8')
+        for offset in range(0, len(tests), self.nvectors):
+            count = min(self.nvectors, len(tests) - offset)
+            valid = np.packbits(np.arange(nbytes * 8) < count)
+            good = self._simulate(tests.value_bits, offset)
+            initial = self._simulate(tests.initial_bits, offset) if transition else good
+            care = self._care(tests.care_bits, offset)
+            fault_eval(faults, detects, transition, initial, good, valid, care, fstate, self.codes, self.in_ptr,
+                       self.in_lines, self.out_ptr, self.out_lines, self.reader_pos, self.observed)
+            coverage.append(np.count_nonzero(detects) / max(1, len(faults)))
+        return detects, coverage
+
+
+class SmallDelayFaultSim:
+    """Small-delay fault simulator on top of WaveSim.
+
+    Faults are (line, polarity, delay) triples: delay is added to line_times[line, 0, polarity]. For each pattern,
+    the fault-free waveforms are computed once in slot 0 and copied to all slots. The faults are then simulated
+    sdim - 1 at a time, one per slot with WaveSim's per-slot delay overrides, starting from the first level
+    reading their lines. A fault is skipped for a pattern if its line does not toggle or if the latest transition
+    on its line plus the extra delay plus the longest path to any capture cannot reach the clock time (slack).
+    A fault is detected and dropped once a captured value differs from the fault-free capture at the clock time.
+    """
+    def __init__(self, circuit, line_times, sdim=64, tdim=16, library=None):
+        assert sdim > 1
+        self.sim = WaveSim(circuit, line_times, sdim, tdim, library)
+        ops = self.sim.ops
+
+        # first level reading each line, and the longest path from each line to any capture.
+        nlines = len(circuit.lines)
+        self.line_level = np.full(nlines, len(self.sim.level_starts), dtype='int64')
+        self.line_slack = np.full(nlines, TMIN, dtype='float64')
+        self.line_slack[[n.i_lines[0].index for n in self.sim.interface if len(n.i_lines) > 0 and
+                         n.i_lines[0] is not None]] = 0
+        line_dmax = line_times[:, 0].max(axis=-1)
+        for level in range(len(self.sim.level_starts) - 1, -1, -1):
+            for op in ops[self.sim.level_starts[level]:self.sim.level_stops[level]]:
+                for idx in op[5:7]:
+                    if idx >= nlines: continue  # zero or interface input
+                    self.line_level[idx] = level
+                    self.line_slack[idx] = max(self.line_slack[idx], line_dmax[idx] + self.line_slack[op[4]])
+        self.evaluations = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """Simulated faults times patterns per second."""
+        return self.evaluations / self.elapsed if self.elapsed > 0 else 0.0
+
+    def run(self, vectors, faults, clock, launch=0.0):
+        """Grades faults with vectors launched at launch and captured at clock.
+
+        Returns the index of the first detecting pattern for each fault, -1 for undetected faults.
+        """
+        sim = self.sim
+        faults = list(faults)
+        lines = np.asarray([f[0] for f in faults], dtype='int64')
+        delays = np.zeros((len(faults), 2), dtype='float32')
+        for i, (_, polarity, delay) in enumerate(faults):
+            delays[i, polarity] = delay
+        reach = delays.max(axis=-1) + self.line_slack[lines]
+        detected = np.full(len(faults), -1, dtype='int64')
+        alive = np.ones(len(faults), dtype=bool)
+        times = np.asarray([clock], dtype='float64')
+        start = time.perf_counter()
+        for offset in range(0, len(vectors), sim.sdim):
+            # fault-free captures and line statistics for a batch of patterns
+            sim.set_slot_delays()
+            sim.assign(vectors, launch, offset)
+            sim.propagate()
+            good = sim._values(sim.cmap, 0, sim.sdim, times)[..., 0]
+            stats = sim._stats(sim.lmap[lines], 0, sim.sdim)
+            for p in range(offset, min(offset + sim.sdim, len(vectors))):
+                st = stats[:, p - offset]
+                cand = np.nonzero(alive & (st[:, 2] > 0) & (st[:, 1] + reach > clock))[0]
+                if len(cand) == 0: continue
+                cand = cand[np.argsort(-self.line_level[lines[cand]], kind='stable')]
+                # the same pattern in all slots. The first chunk starts at level 0, later chunks start at lower
+                # levels than all earlier ones and reuse the fault-free waveforms below.
+                sim.assign(vectors, launch, p)
+                sim.state[sim.inputs_offset:, 1:] = sim.state[sim.inputs_offset:, :1]
+                for c_start in range(0, len(cand), sim.sdim - 1):
+                    chunk = cand[c_start:c_start + sim.sdim - 1]
+                    sim.set_slot_delays(np.concatenate(([-1], lines[chunk])),
+                                        np.concatenate(([[0, 0]], delays[chunk])))
+                    sim.propagate(len(chunk) + 1, int(self.line_level[lines[chunk[-1]]]) if c_start > 0 else 0)
+                    values = sim._values(sim.cmap, 1, len(chunk) + 1, times)[..., 0]
+                    hits = chunk[(values != good[:, p - offset, None]).any(axis=0)]
+                    detected[hits] = p
+                    alive[hits] = False
+                    self.evaluations += len(chunk)
+            if not alive.any(): break
+        sim.set_slot_delays()
+        self.elapsed += time.perf_counter() - start
+        return detected
+
+
+@numba.njit
+def _heap_push(heap, size, item):
+    heap[size] = item
+    i = size
+    while i > 0:
+        parent = (i - 1) >> 1
+        if heap[parent] <= heap[i]: break
+        heap[parent], heap[i] = heap[i], heap[parent]
+        i = parent
+    return size + 1
+
+
+@numba.njit
+def _heap_pop(heap, size):
+    item = heap[0]
+    size -= 1
+    heap[0] = heap[size]
+    i = 0
+    while True:
+        child = 2 * i + 1
+        if child >= size: break
+        if child + 1 < size and heap[child + 1] < heap[child]:
+            child += 1
+        if heap[i] <= heap[child]: break
+        heap[i], heap[child] = heap[child], heap[i]
+        i = child
+    return item, size
+
+
+@numba.njit
+def fault_eval(faults, detects, transition, initial, good, valid, care, fstate, codes, in_ptr, in_lines, out_ptr,
+               out_lines, reader_pos, observed):
+    nbytes = good.shape[-1]
+    nlines = good.shape[0]
+    faulty = np.zeros(nlines, dtype=np.bool_)
+    queued = np.zeros(len(codes), dtype=np.bool_)
+    heap = np.zeros(len(codes), dtype=np.int64)
+    touched = np.zeros(nlines, dtype=np.int64)
+    diff = np.zeros(nbytes, dtype=np.uint8)
+    acc = np.zeros(nbytes, dtype=np.uint8)
+    for fidx in range(len(faults)):
+        if detects[fidx] > 0: continue
+        line = faults[fidx, 0]
+        value = faults[fidx, 1]
+
+        # activation: stuck-at faults where the good value is ~value, the line is forced to value. Transition
+        # faults where the initial value is ~value and the good value is value, the line keeps ~value.
+        active = False
+        for b in range(nbytes):
+            if transition:
+                if value:
+                    acc[b] = ~initial[line, b] & good[line, b] & valid[b]
+                else:
+                    acc[b] = initial[line, b] & ~good[line, b] & valid[b]
+            elif value:
+                acc[b] = ~good[line, b] & valid[b]
+            else:
+                acc[b] = good[line, b] & valid[b]
+            if acc[b]: active = True
+        if not active: continue
+        for b in range(nbytes):
+            diff[b] = 0
+            if (value == 1) != transition:
+                fstate[line, b] = good[line, b] | acc[b]
+            else:
+                fstate[line, b] = good[line, b] & ~acc[b]
+        faulty[line] = True
+        touched[0] = line
+        ntouched = 1
+        size = 0
+        if observed[line]:
+            for b in range(nbytes):
+                diff[b] |= (fstate[line, b] ^ good[line, b]) & care[line, b]
+        if reader_pos[line] >= 0:
+            queued[reader_pos[line]] = True
+            size = _heap_push(heap, size, reader_pos[line])
+
+        # event-driven propagation in topological order
+        while size > 0:
+            pos, size = _heap_pop(heap, size)
+            queued[pos] = False
+            kind = codes[pos, 0]
+            inv = codes[pos, 1]
+            for b in range(nbytes):
+                if kind == _CONST1 or kind == _AND:
+                    acc[b] = 255
+                else:
+                    acc[b] = 0
+            for j in range(in_ptr[pos], in_ptr[pos + 1]):
+                l = in_lines[j]
+                if kind == _CONST0 or kind == _CONST1: break
+                for b in range(nbytes):
+                    v = 0
+                    if l >= 0:
+                        v = fstate[l, b] if faulty[l] else good[l, b]
+                    if kind == _AND:
+                        acc[b] &= v
+                    elif kind == _OR:
+                        acc[b] |= v
+                    elif kind == _XOR:
+                        acc[b] ^= v
+                    else:
+                        acc[b] = v
+                if kind == _BUF: break
+            if inv:
+                for b in range(nbytes):
+                    acc[b] = ~acc[b]
+            for j in range(out_ptr[pos], out_ptr[pos + 1]):
+                o = out_lines[j]
+                if o < 0: continue
+                changed = False
+                for b in range(nbytes):
+                    if acc[b] != good[o, b]:
+                        changed = True
+                        break
+                if not changed: continue
+                for b in range(nbytes):
+                    fstate[o, b] = acc[b]
+                if not faulty[o]:
+                    faulty[o] = True
+                    touched[ntouched] = o
+                    ntouched += 1
+                if observed[o]:
+                    for b in range(nbytes):
+                        diff[b] |= (acc[b] ^ good[o, b]) & care[o, b]
+                r = reader_pos[o]
+                if r >= 0 and not queued[r]:
+                    queued[r] = True
+                    size = _heap_push(heap, size, r)
+
+        for t in range(ntouched):
+            faulty[touched[t]] = False
+        detects[fidx] = bittools.popcount_masked(diff, valid)
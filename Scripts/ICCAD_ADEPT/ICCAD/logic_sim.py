@@ -1,20 +1,41 @@
 import numpy as np
+import heapq
+from functools import partial
 from . import packed_vectors
+from . import saed
 
 
 class LogicSim:
-    def __init__(self, circuit, nvectors=1, vdim=1):
+    # node functions for cell library primitives
+    prim_fct = {'buf': 'fork', 'dff': 'sdff'}
+
+    def __init__(self, circuit, nvectors=1, vdim=1, library=None, observe=None, recycle=False):
+        library = library or saed.library
         self.circuit = circuit
         self.nvectors = nvectors
         nbytes = (nvectors - 1) // 8 + 1
         self.interface = list(circuit.interface) + [n for n in circuit.nodes if 'dff' in n.kind.lower()]
-        self.state = np.zeros((len(circuit.lines), vdim, nbytes), dtype='uint8')
+        # with observe (interface nodes or positions), propagate evaluates only the fan-in cone of these nodes.
+        if observe is None:
+            self.order = list(circuit.topological_order())
+        else:
+            observe = [self.interface[o] if isinstance(o, (int, np.integer)) else o for o in observe]
+            cone = set(circuit.comb_fanin(observe))
+            self.order = [n for n in circuit.topological_order() if n in cone]
+        # flip-flops are pseudo-primary inputs and outputs: propagate never evaluates them, not even if a primary
+        # input drives their D pin directly.
+        self._comb_order = [n for n in self.order if 'dff' not in n.kind.lower()]
+        # rows of self.state for each line. With recycle, the row of a line is reused by lines later in self.order
+        # once its reader is done, so only captured lines keep their values after propagate.
+        self.lmap = self._recycle() if recycle else np.arange(len(circuit.lines))
+        self.state = np.zeros((int(self.lmap.max(initial=-1)) + 1, vdim, nbytes), dtype='uint8')
         self.state_epoch = np.zeros(len(circuit.nodes), dtype='int8') - 1
         self.tmp = np.zeros((5, vdim, nbytes), dtype='uint8')
         self.zero = np.zeros((vdim, nbytes), dtype='uint8')
         if vdim > 1:
             self.zero[1] = 255
         self.epoch = 0
+        self.frame = None
 
         self.fork_vd1 = self.fork_vdx
         self.const0_vd1 = self.const0_vdx
@@ -41,49 +62,183 @@ class LogicSim:
         self.xor2_vd3 = self.xor_vd3
         
         known_fct = [(f[:-4], getattr(self, f)) for f in dir(self) if f.endswith(f'_vd{vdim}')]
+        kind_fct = {}
         self.node_fct = []
         for n in circuit.nodes:
-            t = n.kind.lower().replace('__fork__', 'fork')
-            t = t.replace('__const0__', 'const0')
-            t = t.replace('__const1__', 'const1')
-            t = t.replace('tieh', 'const1')
-            # t = t.replace('xor', 'or').replace('xnor', 'nor')
-            fcts = [f for n, f in known_fct if t.startswith(n)]
-            if len(fcts) < 1:
-                raise ValueError(f'Unknown node kind {n.kind}')
-            self.node_fct.append(fcts[0])
-
-    def assign(self, stimuli):
-        if isinstance(stimuli, packed_vectors.PackedVectors):
-            stimuli = stimuli.bits
-        for (stim, node) in zip(stimuli, self.interface):
-            if len(node.o) == 0: continue
-            outputs = [self.state[line.index] if line else self.tmp[3] for line in node.o_lines]
-            self.node_fct[node.index]([stim], outputs)
-            for line in node.o_lines:
-                if line:
-                    self.state_epoch[line.reader.index] = self.epoch
-        for n in self.circuit.nodes:
+            if n.kind not in kind_fct:
+                kind_fct[n.kind] = self._kind_fct(n.kind, library, known_fct, vdim)
+            self.node_fct.append(kind_fct[n.kind])
+
+        # scatter/gather indices for assign and capture
+        copy_pos, copy_lines, q_pos, q_lines, qn_pos, qn_lines = [], [], [], [], [], []
+        readers, capture_pos, capture_lines = [], [], []
+        for pos, node in enumerate(self.interface):
+            is_dff = 'dff' in node.kind.lower()
+            for pin, line in enumerate(node.o_lines):
+                if line is None: continue
+                if not is_dff:
+                    copy_pos.append(pos); copy_lines.append(line.index)
+                elif pin == 0:
+                    q_pos.append(pos); q_lines.append(line.index)
+                else:
+                    qn_pos.append(pos); qn_lines.append(line.index)
+                readers.append(line.reader.index)
+            if len(node.i) > 0 and node.i_lines[0] is not None:
+                capture_pos.append(pos); capture_lines.append(node.i_lines[0].index)
+
+        # constant lines are set once here, only their readers need to be scheduled on assign
+        for n in circuit.nodes:
             if (n.kind == '__const1__') or (n.kind == '__const0__'):
-                outputs = [self.state[line.index] if line else self.tmp[3] for line in n.o_lines]
+                outputs = [self.state[self.lmap[line.index]] if line else self.tmp[3] for line in n.o_lines]
                 self.node_fct[n.index]([], outputs)
-                # print('assign const')
-                for line in n.o_lines:
-                    if line:
-                        self.state_epoch[line.reader.index] = self.epoch
-
-    def capture(self, responses):
+                readers += [line.reader.index for line in n.o_lines if line]
+
+        as_idx = partial(np.asarray, dtype='int64')
+        self.copy_pos, self.copy_lines = as_idx(copy_pos), as_idx(copy_lines)
+        self.q_pos, self.q_lines = as_idx(q_pos), as_idx(q_lines)
+        self.qn_pos, self.qn_lines = as_idx(qn_pos), as_idx(qn_lines)
+        self.assign_readers = as_idx(readers)
+        self.capture_pos, self.capture_lines = as_idx(capture_pos), as_idx(capture_lines)
+
+    def _recycle(self):
+        # each line needs its row from its first write to its last read in self.order (-1: before propagate,
+        # len(self.order): after). Rows are reused like registers, lines written nowhere share one spare row.
+        pos = dict((n, i) for i, n in enumerate(self.order))
+        end = len(self.order)
+        interface = set(self.interface)
+        first = np.full(len(self.circuit.lines), end + 1)
+        last = np.full(len(self.circuit.lines), -1)
+        for line in self.circuit.lines:
+            driver, reader = line.driver, line.reader
+            if driver in interface:
+                first[line.index] = -1
+            elif len(driver.i) == 0:  # constants are written once
+                first[line.index] = -1
+                last[line.index] = end
+            if driver in pos:
+                first[line.index] = min(first[line.index], pos[driver])
+                last[line.index] = max(last[line.index], pos[driver])
+            if reader in interface:
+                last[line.index] = end
+            elif reader in pos:
+                last[line.index] = max(last[line.index], pos[reader])
+        lmap = np.full(len(self.circuit.lines), -1)
+        free = []
+        busy = []
+        nrows = 0
+        for lidx in np.argsort(first, kind='stable'):
+            if first[lidx] > end: break
+            while len(busy) > 0 and busy[0][0] < first[lidx]:
+                free.append(heapq.heappop(busy)[1])
+            if len(free) > 0:
+                lmap[lidx] = free.pop()
+            else:
+                lmap[lidx] = nrows
+                nrows += 1
+            heapq.heappush(busy, (last[lidx], lmap[lidx]))
+        lmap[first > end] = nrows
+        return lmap
+
+    def _kind_fct(self, kind, library, known_fct, vdim):
+        prim = library.primitive(kind)
+        if prim is not None:
+            return getattr(self, f'{self.prim_fct.get(prim, prim)}_vd{vdim}')
+        cell = library.cell(kind)
+        if cell is not None and not cell.sequential:
+            return partial(getattr(self, f'cell_vd{vdim}'), cell)
+        t = kind.lower().replace('__fork__', 'fork')
+        t = t.replace('__const0__', 'const0')
+        t = t.replace('__const1__', 'const1')
+        t = t.replace('tieh', 'const1')
+        fcts = [f for n, f in known_fct if t.startswith(n)]
+        if len(fcts) < 1:
+            raise ValueError(f'Unknown node kind {kind}')
+        return fcts[0]
+
+    def assign(self, stimuli, offset=0):
+        if isinstance(stimuli, packed_vectors.PackedVectors):
+            stimuli = stimuli.bits
+        stimuli = self._window(stimuli, offset)
+        if stimuli.shape[-1] < self.state.shape[-1]:
+            padded = np.zeros(stimuli.shape[:-1] + self.state.shape[-1:], dtype='uint8')
+            padded[..., :stimuli.shape[-1]] = stimuli
+            stimuli = padded
+        self.state[self.lmap[self.copy_lines]] = stimuli[self.copy_pos]
+        self.state[self.lmap[self.q_lines]] = self._dff_out(stimuli[self.q_pos], False)
+        self.state[self.lmap[self.qn_lines]] = self._dff_out(stimuli[self.qn_pos], True)
+        self.state_epoch[self.assign_readers] = self.epoch
+
+    def capture(self, responses, offset=0):
         if isinstance(responses, packed_vectors.PackedVectors):
             responses = responses.bits
-        for (resp, node) in zip(responses, self.interface):
-            if len(node.i) == 0: continue
-            resp[...] = self.state[node.i_lines[0].index]
+        responses = self._window(responses, offset)
+        nbytes = responses.shape[-1]
+        responses[self.capture_pos] = self.state[self.lmap[self.capture_lines], ..., :nbytes]
+
+    def _dff_out(self, values, invert):
+        # flip-flop outputs for a batch of values of shape (n, vdim, nbytes), DC becomes X for vdim > 1.
+        if invert:
+            values = values.copy()
+            values[:, :max(1, values.shape[1] - 1)] ^= 255
+        if values.shape[1] == 2:
+            values[:, 0] |= ~values[:, 1]
+        elif values.shape[1] == 3:
+            dc = ~(values[:, 0] ^ values[:, 1]) & ~values[:, 2]
+            values[:, 0] |= dc
+            values[:, 1] |= dc
+        return values
+
+    def _window(self, bits, offset):
+        # the bytes of bits that hold vectors offset to offset + self.nvectors.
+        assert (offset % 8) == 0
+        byte_offset = offset // 8
+        return bits[..., byte_offset:byte_offset + self.state.shape[-1]]
+
+    def cycles(self, stimuli, responses=None):
+        """Simulates one clock cycle for each entry of stimuli, keeping the flip-flop states in between.
+
+        Each entry holds values for all interface positions (like PackedVectors for assign), only the values
+        for circuit.interface are used. The flip-flops take the values captured at their D inputs as the next
+        state. Each vector is an independent sequence. Stimuli may be any iterable, responses for cycle c are
+        written to responses[c] if given. The flip-flop state persists across calls, so long traces can be
+        streamed in segments. Returns the number of simulated cycles.
+
+        Each cycle is still one assign, propagate and capture call from Python. Only the per-cycle bookkeeping
+        around them uses precomputed index arrays, so short cycles on small circuits stay dominated by this
+        round trip.
+        """
+        if self.frame is None:
+            self.reset_flops()
+        npi = len(self.circuit.interface)
+        ncycles = 0
+        for stim in stimuli:
+            if isinstance(stim, packed_vectors.PackedVectors):
+                stim = stim.bits
+            nbytes = min(stim.shape[-1], self.frame.shape[-1])
+            self.frame[:npi, ..., :nbytes] = stim[:npi, ..., :nbytes]
+            self.assign(self.frame)
+            self.propagate()
+            self.capture(self.frame)
+            if responses is not None:
+                resp = responses[ncycles]
+                if isinstance(resp, packed_vectors.PackedVectors):
+                    resp = resp.bits
+                resp[..., :nbytes] = self.frame[..., :nbytes]
+            ncycles += 1
+        return ncycles
+
+    def reset_flops(self, values=None):
+        # sets the flip-flop states for cycles(), to values (one row per flip-flop) or to 0.
+        self.frame = np.zeros((len(self.interface),) + self.state.shape[1:], dtype='uint8')
+        npi = len(self.circuit.interface)
+        self.frame[npi:] = self.zero if values is None else values
 
     def propagate(self):
-        for node in self.circuit.topological_order():
+        lmap = self.lmap
+        for node in self._comb_order:
             if self.state_epoch[node.index] != self.epoch: continue
-            inputs = [self.state[line.index] if line else self.zero for line in node.i_lines]
-            outputs = [self.state[line.index] if line else self.tmp[3] for line in node.o_lines]
+            inputs = [self.state[lmap[line.index]] if line else self.zero for line in node.i_lines]
+            outputs = [self.state[lmap[line.index]] if line else self.tmp[3] for line in node.o_lines]
             # print('sim', node)
             self.node_fct[node.index](inputs, outputs)
             for line in node.o_lines:
@@ -414,3 +569,55 @@ class LogicSim:
     def const1_vd3(self, _, outputs):
         for o in outputs: o[...] = self.zero
         self.not_vd3(outputs, outputs)
+
+    # library cells with arbitrary functions, evaluated as sum-of-products over the input planes.
+    # For vdim 2 and 3, an output is known if a prime implicant of its on-set or off-set is satisfied by the
+    # known inputs, and X otherwise.
+
+    @staticmethod
+    def _sop(cubes, ones, zeros, out):
+        out[...] = 0
+        term = np.empty_like(out)
+        for literals in cubes:
+            term[...] = 255
+            for j, polarity in literals:
+                term &= ones[j] if polarity else zeros[j]
+            out |= term
+
+    def cell_vd1(self, cell, inputs, outputs):
+        ones = [i[0] for i in inputs]
+        zeros = [~i[0] for i in inputs]
+        for o, cover in zip(outputs, cell.covers):
+            self._sop(cover, ones, zeros, o[0])
+
+    def cell_vd2(self, cell, inputs, outputs):
+        ones = [i[0] & i[1] for i in inputs]
+        zeros = [~i[0] & i[1] for i in inputs]
+        any1 = self.tmp[0][0]
+        any0 = self.tmp[1][0]
+        for o, (on, off) in zip(outputs, cell.primes):
+            self._sop(on, ones, zeros, any1)
+            self._sop(off, ones, zeros, any0)
+            o[0] = ~any0  # value = 1 or X
+            o[1] = any1 | any0  # care = known
+
+    def cell_vd3(self, cell, inputs, outputs):
+        dcs = [~(i[0] ^ i[1]) & ~i[2] for i in inputs]
+        i_ones = [i[0] & ~dc for i, dc in zip(inputs, dcs)]
+        i_zeros = [~i[0] & ~dc for i, dc in zip(inputs, dcs)]
+        f_ones = [~i[1] & ~dc for i, dc in zip(inputs, dcs)]
+        f_zeros = [i[1] & ~dc for i, dc in zip(inputs, dcs)]
+        s_ones = [o & ~i[2] for i, o in zip(inputs, i_ones)]
+        s_zeros = [z & ~i[2] for i, z in zip(inputs, i_zeros)]
+        i1, i0, f1, f0, s1, s0 = np.empty((6, self.state.shape[-1]), dtype='uint8')
+        for o, (on, off) in zip(outputs, cell.primes):
+            self._sop(on, i_ones, i_zeros, i1)
+            self._sop(off, i_ones, i_zeros, i0)
+            self._sop(on, f_ones, f_zeros, f1)
+            self._sop(off, f_ones, f_zeros, f0)
+            self._sop(on, s_ones, s_zeros, s1)
+            self._sop(off, s_ones, s_zeros, s0)
+            known = (i1 | i0) & (f1 | f0)
+            o[0] = i1 | ~known  # initial value = 1 or X
+            o[1] = f0 | ~known  # ~final value = 0 or X
+            o[2] = known & ~(s1 | s0)  # toggles = known and not stable
@@ -1,14 +1,65 @@
 import numpy as np
-from .bittools import popcount, bit_in
+import os
+import struct
+
+
+def _nbytes(nvectors):
+    return (nvectors - 1) // 8 + 1
+
+
+def _tail_mask(nvectors):
+    return np.uint8((0xff << ((8 - nvectors % 8) % 8)) & 0xff)
+
+
+def _extract_bits(bits, start, count):
+    # copies count bits starting at bit position start from the last axis of bits into a new array.
+    nbytes = _nbytes(count)
+    first = start // 8
+    shift = start % 8
+    if shift == 0:
+        out = bits[..., first:first + nbytes].copy()
+    else:
+        src = bits[..., first:first + nbytes + 1]
+        out = src[..., :nbytes] << shift
+        out[..., :src.shape[-1] - 1] |= src[..., 1:] >> (8 - shift)
+    if count > 0:
+        out[..., -1] &= _tail_mask(count)
+    return out
+
+
+def _place_bits(bits, start, src, count):
+    # ORs the first count bits of src into the last axis of bits starting at bit position start.
+    if count == 0:
+        return
+    src = _extract_bits(src, 0, count)
+    first = start // 8
+    shift = start % 8
+    if shift == 0:
+        bits[..., first:first + src.shape[-1]] |= src
+    else:
+        bits[..., first:first + src.shape[-1]] |= src >> shift
+        rest = bits[..., first + 1:first + 1 + src.shape[-1]]
+        rest |= (src << (8 - shift))[..., :rest.shape[-1]]
+
+
+def _take_bits(bits, nvectors, indices, rows=256):
+    # gathers the given vector indices from the last axis of bits. Rows are unpacked in chunks to limit memory.
+    flat = bits.reshape(int(np.prod(bits.shape[:-1])), bits.shape[-1])
+    out = np.zeros((len(flat), _nbytes(len(indices))), dtype='uint8')
+    if len(indices) > 0:
+        for r in range(0, len(flat), rows):
+            unpacked = np.unpackbits(flat[r:r + rows], axis=-1, count=nvectors)
+            out[r:r + rows] = np.packbits(unpacked[:, indices], axis=-1)
+    return out.reshape(bits.shape[:-1] + (out.shape[-1],))
 
 
 class PackedVectors:
-    def __init__(self, nvectors=8, width=1, vdim=1, from_cache=None):
+    def __init__(self, nvectors=8, width=1, vdim=1, from_cache=None, copy=True):
         if from_cache is not None:
-            self.bits = np.array(from_cache)
+            self.bits = np.array(from_cache) if copy else np.asarray(from_cache)
             self.width, self.vdim, nbytes = self.bits.shape
         else:
-            self.bits = np.zeros((width, vdim, (nvectors - 1) // 8 + 1), dtype='uint8')
+            self.bits = np.zeros((width, vdim, _nbytes(nvectors)), dtype='uint8')
             self.vdim = vdim
             self.width = width
         self.nvectors = nvectors
@@ -65,21 +116,42 @@ class PackedVectors:
         return a
         
     def __add__(self, other):
-        a = PackedVectors(self.nvectors + other.nvectors, self.width, max(self.vdim, other.vdim))
-        # a.bits[:self.bits.shape[0], 0] = self.bits[:, 0]
-        # if self.vdim == 2:
-        #    a.bits[:self.bits.shape[0], 1] = self.care_bits
-        # elif self.vdim == 3:
-        #    a.bits[:self.bits.shape[0], 1] = ~self.value_bits
-        #    a.bits[:self.bits.shape[0], 2] = self.toggle_bits
-        for i in range(self.nvectors):
-            a[i] = self[i]
-        for i in range(len(other)):
-            a[self.nvectors+i] = other[i]
+        assert self.width == other.width
+        vdim = max(self.vdim, other.vdim)
+        a = PackedVectors(self.nvectors + other.nvectors, self.width, vdim)
+        _place_bits(a.bits, 0, self.bits_as(vdim), self.nvectors)
+        _place_bits(a.bits, self.nvectors, other.bits_as(vdim), other.nvectors)
         return a
 
+    def bits_as(self, vdim):
+        if vdim == self.vdim:
+            return self.bits
+        assert vdim > self.vdim
+        bits = np.zeros((self.width, vdim, self.bits.shape[-1]), dtype='uint8')
+        bits[:, 0] = self.bits[:, 0]
+        if self.vdim == 1:
+            care = ~np.zeros_like(self.bits[:, 0])
+        else:
+            care = self.bits[:, 1]
+        if vdim == 2:
+            bits[:, 1] = care
+        else:
+            bits[:, 1] = self.bits[:, 0] ^ care
+        return bits
+
     def __len__(self):
         return self.nvectors
+
+    def chunks(self, nvectors):
+        # yields (offset, vectors) pairs. Chunks are views of self.bits if nvectors is a multiple of 8.
+        for offset in range(0, self.nvectors, nvectors):
+            yield offset, self[offset:offset + nvectors]
+
+    def save(self, filename, interface=None):
+        mv = MappedVectors.create(filename, self.width, self.vdim, interface, self.nvectors)
+        mv.append(self)
+        mv.flush()
+        return mv
     
     def randomize(self, one_probability=0.5):
         for data in self.bits:
@@ -92,12 +164,8 @@ class PackedVectors:
             
     def copy(self, selection_mask=None):
         if selection_mask is not None:
-            cpy = PackedVectors(popcount(selection_mask), len(self.bits), self.vdim)
-            cur = 0
-            for vidx in range(self.nvectors):
-                if bit_in(selection_mask, vidx):
-                    cpy[cur] = self[vidx]
-                    cur += 1
+            selection = np.unpackbits(np.asarray(selection_mask, dtype='uint8'))[:self.nvectors]
+            return self._take(np.flatnonzero(selection))
         else:
             cpy = PackedVectors(self.nvectors, len(self.bits), self.vdim)
             np.copyto(cpy.bits, self.bits)
@@ -192,6 +260,28 @@ class PackedVectors:
                     c = 'R'
             self.set_value(vector, mapping[i], c)
     
+    def set_values_bulk(self, vectors, values, mapping=None, inversions=None):
+        # like calling set_values(vectors[i], values[i], mapping, inversions) for all i.
+        # All strings in values must have the same length.
+        vectors = np.arange(self.nvectors)[vectors]
+        if len(vectors) == 0:
+            return
+        codes = np.frombuffer(''.join(values).encode('ascii'), dtype='uint8').reshape(len(vectors), -1)
+        if inversions is not None:
+            inversions = np.asarray(inversions, dtype='bool')[:codes.shape[1]]
+            codes = codes.copy()
+            codes[:, inversions] = _inversion_lut[codes[:, inversions]]
+        if mapping is None or len(mapping) == 0:
+            mapping = range(codes.shape[1])
+        mapping = np.asarray(mapping, dtype='int')[:codes.shape[1]]
+        planes = _value_luts[self.vdim][codes].transpose(1, 2, 0)  # position, vdim, vector
+        if len(vectors) == self.nvectors and (vectors == np.arange(self.nvectors)).all():
+            self.bits[mapping] = np.packbits(planes, axis=-1)
+        else:
+            unpacked = np.unpackbits(self.bits[mapping], axis=-1, count=self.nvectors)
+            unpacked[..., vectors] = planes
+            self.bits[mapping] = np.packbits(unpacked, axis=-1)
+
     def set_values_for_position(self, position, values):
         for i, v in enumerate(values):
             self.set_value(i, position, v)
@@ -202,14 +292,20 @@ class PackedVectors:
 
     def __getitem__(self, vector):
         if isinstance(vector, slice):
-            first = self.get_values_for_position(0)[vector]
-            ret = PackedVectors(len(first), self.width, self.vdim)
-            ret.set_values_for_position(0, first)
-            for pos in range(1, self.width):
-                ret.set_values_for_position(pos, self.get_values_for_position(pos)[vector])
-            return ret
+            start, stop, step = vector.indices(self.nvectors)
+            if step != 1:
+                return self._take(np.arange(start, stop, step))
+            nvectors = max(0, stop - start)
+            if start % 8 == 0 and (stop % 8 == 0 or stop == self.nvectors):
+                # byte-aligned: share memory with self.bits
+                view = self.bits[..., start // 8:start // 8 + _nbytes(nvectors)]
+                return PackedVectors(nvectors, from_cache=view, copy=False)
+            return PackedVectors(nvectors, from_cache=_extract_bits(self.bits, start, nvectors), copy=False)
         return ''.join(self.get_value(vector, pos) for pos in range(len(self.bits)))
 
+    def _take(self, indices):
+        return PackedVectors(len(indices), from_cache=_take_bits(self.bits, self.nvectors, indices), copy=False)
+
     @staticmethod
     def _set_value_vd1(a, m, v):
         if v in [True, 1, '1', 'H', 'h']:
@@ -297,3 +393,99 @@ class PackedVectors:
             out = np.zeros((self.width, self.bits.shape[-1]), dtype='uint8')
         out[...] = (self.value_bits ^ other.value_bits) & self.care_bits & other.care_bits
         return out
+
+
+def _make_value_luts():
+    # maps each character code to its bit-plane values for each vdim, using the same rules as set_value.
+    luts = {}
+    pv = PackedVectors(1, 1, 3)
+    for vdim, f in [(1, pv._set_value_vd1), (2, pv._set_value_vd2), (3, pv._set_value_vd3)]:
+        lut = np.zeros((256, vdim), dtype='uint8')
+        for code in range(256):
+            a = np.zeros(vdim, dtype='uint8')
+            f(a, pv.mask[0], chr(code))
+            lut[code] = a >> 7
+        luts[vdim] = lut
+    return luts
+
+
+_value_luts = _make_value_luts()
+_inversion_lut = np.arange(256, dtype='uint8')
+for _a, _b in ['01', 'LH', 'RF']:
+    _inversion_lut[ord(_a)], _inversion_lut[ord(_b)] = ord(_b), ord(_a)
+
+
+class MappedVectors(PackedVectors):
+    """PackedVectors backed by a memory-mapped file.
+
+    The file starts with a small header (width, vdim, nvectors and the interface names) followed by the
+    pattern data. The data is stored byte-column first, so that new vectors can be appended without moving
+    existing data. ``bits`` is a view of the mapped file with the usual shape (width, vdim, nbytes).
+    """
+    _header = struct.Struct('<8sQQQQQ')
+    _magic = b'KYUPYPV1'
+    _align = 4096
+
+    def __init__(self, filename, mode='r'):
+        self.filename = filename
+        self.mode = mode
+        with open(filename, 'rb') as f:
+            magic, width, vdim, nvectors, names_len, self._data_offset = self._header.unpack(
+                f.read(self._header.size))
+            if magic != self._magic:
+                raise ValueError(f'not a vectors file: {filename}')
+            names = f.read(names_len).decode('utf-8')
+        self.interface = names.split('\n') if names_len > 0 else []
+        # empty storage for the base class, self.bits is replaced by a view of the mapped file in _remap.
+        super().__init__(nvectors, from_cache=np.zeros((width, vdim, 0), dtype='uint8'), copy=False)
+        self._capacity = 0
+        self._map = None
+        self._remap()
+
+    @classmethod
+    def create(cls, filename, width, vdim=1, interface=None, nvectors=0):
+        names = '\n'.join(getattr(n, 'name', n) for n in interface or []).encode('utf-8')
+        data_offset = (cls._header.size + len(names) - 1) // cls._align * cls._align + cls._align
+        with open(filename, 'wb') as f:
+            f.write(cls._header.pack(cls._magic, width, vdim, 0, len(names), data_offset))
+            f.write(names)
+            f.truncate(data_offset + _nbytes(max(nvectors, 1)) * width * vdim)
+        return cls(filename, 'r+')
+
+    def _remap(self):
+        capacity = (os.path.getsize(self.filename) - self._data_offset) // (self.width * self.vdim)
+        if capacity != self._capacity or self._map is None:
+            self._capacity = capacity
+            self._map = np.memmap(self.filename, dtype='uint8', mode=self.mode, offset=self._data_offset,
+                                  shape=(capacity, self.width, self.vdim))
+        self.bits = self._map.transpose(1, 2, 0)[..., :_nbytes(self.nvectors)]
+
+    def append(self, vectors):
+        if self.mode == 'r':
+            raise ValueError(f'vectors file opened read-only: {self.filename}')
+        assert vectors.width == self.width
+        nbytes = _nbytes(self.nvectors + vectors.nvectors)
+        if nbytes > self._capacity:
+            self._map.flush()
+            self._map = None
+            with open(self.filename, 'r+b') as f:
+                f.truncate(self._data_offset + max(nbytes, 2 * self._capacity) * self.width * self.vdim)
+            self._remap()
+        _place_bits(self._map.transpose(1, 2, 0), self.nvectors, vectors.bits_as(self.vdim), vectors.nvectors)
+        self.nvectors += vectors.nvectors
+        self._remap()
+        self._write_header()
+
+    def _write_header(self):
+        with open(self.filename, 'r+b') as f:
+            magic, width, vdim, _, names_len, data_offset = self._header.unpack(f.read(self._header.size))
+            f.seek(0)
+            f.write(self._header.pack(magic, width, vdim, self.nvectors, names_len, data_offset))
+
+    def flush(self):
+        if self.mode != 'r':
+            self._map.flush()
+            self._write_header()
+
+    def __repr__(self):
+        return f'<MappedVectors {self.filename} nvectors={self.nvectors}, width={self.width}, vdim={self.vdim}>'
@@ -0,0 +1,45 @@
+import re
+import time
+import numpy as np
+
+
+class SaifAccumulator:
+    """Accumulates per-line switching activity from a WaveSim (or WaveSimCuda) into a SAIF file.
+
+    Call add() after each propagate() to add the activity of all simulated slots within [t_start, t_end).
+    """
+    def __init__(self, sim, t_start, t_end):
+        self.sim = sim
+        self.t_start = t_start
+        self.t_end = t_end
+        self.counts = np.zeros((len(sim.circuit.lines), 3), dtype='float64')  # T0, T1, TC
+        self.duration = 0.0
+
+    def add(self, sdim=None):
+        sdim = self.sim.sdim if sdim is None else min(sdim, self.sim.sdim)
+        self.sim.saif(self.counts, self.t_start, self.t_end, sdim)
+        self.duration += sdim * (self.t_end - self.t_start)
+
+    def nets(self):
+        # net name and line index for each signal, the line driving its fork.
+        for n in self.sim.circuit.nodes:
+            if n.kind == '__fork__' and len(n.i_lines) > 0 and n.i_lines[0] is not None:
+                yield n.name, n.i_lines[0].index
+
+    def write(self, file, design=None, timescale='1 ns', scale=1.0):
+        design = design or self.sim.circuit.name or 'top'
+        with open(file, 'w') as f:
+            f.write('(SAIFILE\n(SAIFVERSION "2.0")\n(DIRECTION "backward")\n')
+            f.write(f'(DESIGN "{design}")\n(DATE "{time.strftime("%c")}")\n')
+            f.write('(VENDOR "kyupy")\n(PROGRAM_NAME "kyupy")\n(VERSION "1.0")\n(DIVIDER / )\n')
+            f.write(f'(TIMESCALE {timescale})\n(DURATION {round(self.duration * scale)})\n')
+            f.write(f'(INSTANCE {_escape(design)}\n  (NET\n')
+            for name, lidx in self.nets():
+                t0, t1, tc = self.counts[lidx]
+                f.write(f'    ({_escape(name)}\n      (T0 {round(t0 * scale)}) (T1 {round(t1 * scale)}) (TX 0) (TZ 0)'
+                        f' (TC {int(tc)}) (IG 0)\n    )\n')
+            f.write('  )\n)\n)\n')
+
+
+def _escape(name):
+    return re.sub(r'([^A-Za-z0-9_])', r'\\\1', name)
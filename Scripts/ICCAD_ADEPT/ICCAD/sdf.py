@@ -1,3 +1,4 @@
+import re
 import numpy as np
 from lark import Lark, Transformer
 from collections import namedtuple
@@ -9,8 +10,9 @@ IOPath = namedtuple('IOPath', ['ipin', 'opin', 'r', 'f'])
 
 
 class DelayFile:
-    def __init__(self, name, cells):
+    def __init__(self, name, cells, timescale=1e-9):
         self.name = name
+        self.timescale = timescale  # seconds per time unit of all delays
         if None in cells:
             self.interconnects = cells[None]
         else:
@@ -146,11 +148,17 @@ class SdfTransformer(Transformer):
         entries = [e for a in args if hasattr(a, 'children') for e in a.children]
         return name, entries
 
+    @staticmethod
+    def timescale(args):
+        m = re.match(r'\s*([0-9.]+)\s*([munpf]?)s', str(args[0]))
+        return float(m.group(1)) * {'': 1, 'm': 1e-3, 'u': 1e-6, 'n': 1e-9, 'p': 1e-12, 'f': 1e-15}[m.group(2)]
+
     @staticmethod
     def start(args):
         name = next((a for a in args if isinstance(a, str)), None)
         cells = dict(t for t in args if isinstance(t, tuple))
-        return DelayFile(name, cells)
+        timescale = next((a for a in args if isinstance(a, float)), 1e-9)
+        return DelayFile(name, cells, timescale)
 
 
 def parse(sdf):
@@ -165,8 +173,9 @@ def parse(sdf):
         | "(VOLTAGE" _NOB ")"
         | "(PROCESS" _NOB ")"
         | "(TEMPERATURE" _NOB ")"
-        | "(TIMESCALE" _NOB ")"
+        | timescale
         | cell )* ")"
+    timescale: "(TIMESCALE" /[^()]+/ ")"
     cell: "(CELL" ( "(CELLTYPE" _NOB ")"
         | "(INSTANCE" ID? ")"
         | "(TIMINGCHECK" _ignore* ")"
@@ -1,8 +1,11 @@
 from lark import Lark, Transformer
 from collections import namedtuple
+import itertools
 import re
 import gzip
-from .packed_vectors import PackedVectors
+import io
+import numpy as np
+from .packed_vectors import PackedVectors, MappedVectors
 from .logic_sim import LogicSim
 
 
@@ -10,6 +13,31 @@ Call = namedtuple('Call', ['name', 'parameters'])
 ScanPattern = namedtuple('ScanPattern', ['load', 'launch', 'capture', 'unload'])
 
 
+def scan_patterns(calls, si_ports, so_ports):
+    launch = {}
+    capture = {}
+    load = {}
+    for call in calls:
+        if call.name == 'load_unload':
+            unload = {}
+            for so_port in so_ports:
+                if so_port in call.parameters:
+                    unload[so_port] = call.parameters[so_port].replace('\n', '')
+            if len(capture) > 0:
+                yield ScanPattern(load, launch, capture, unload)
+                capture = {}
+                launch = {}
+            load = {}
+            for si_port in si_ports:
+                if si_port in call.parameters:
+                    load[si_port] = call.parameters[si_port].replace('\n', '')
+        if call.name.endswith('_launch') or call.name.endswith('_capture'):
+            if len(launch) == 0:
+                launch = dict((k, v.replace('\n', '')) for k, v in call.parameters.items())
+            else:
+                capture = dict((k, v.replace('\n', '')) for k, v in call.parameters.items())
+
+
 class StilFile:
     def __init__(self, version, signal_groups, scan_chains, calls):
         self.version = version
@@ -18,29 +46,8 @@ class StilFile:
         self.si_ports = dict((v[0], k) for k, v in scan_chains.items())
         self.so_ports = dict((v[-1], k) for k, v in scan_chains.items())
         self.calls = calls
-        self.patterns = []
-        launch = {}
-        capture = {}
-        load = {}
-        for call in self.calls:
-            if call.name == 'load_unload':
-                unload = {}
-                for so_port in self.so_ports:
-                    if so_port in call.parameters:
-                        unload[so_port] = call.parameters[so_port].replace('\n', '')
-                if len(capture) > 0:
-                    self.patterns.append(ScanPattern(load, launch, capture, unload))
-                    capture = {}
-                    launch = {}
-                load = {}
-                for si_port in self.si_ports:
-                    if si_port in call.parameters:
-                        load[si_port] = call.parameters[si_port].replace('\n', '')
-            if call.name.endswith('_launch') or call.name.endswith('_capture'):
-                if len(launch) == 0:
-                    launch = dict((k, v.replace('\n', '')) for k, v in call.parameters.items())
-                else:
-                    capture = dict((k, v.replace('\n', '')) for k, v in call.parameters.items())
+        self.patterns = list(scan_patterns(calls, self.si_ports, self.so_ports))
+        self._sim4v = None
     
     def _maps(self, c):
         interface = list(c.interface) + [n for n in c.nodes if 'DFF' in n.kind]
@@ -74,47 +81,254 @@ class StilFile:
         return interface, pi_map, po_map, scan_maps, scan_inversions
         
     def tests(self, c):
+        return self._tests(c, self.patterns)
+
+    def tests8v(self, c):
+        return self._tests8v(c, self.patterns)
+
+    def responses(self, c):
+        return self._responses(c, self.patterns)
+
+    def _tests(self, c, patterns):
         interface, pi_map, po_map, scan_maps, scan_inversions = self._maps(c)
-        tests = PackedVectors(len(self.patterns), len(interface), 2)
-        for i, p in enumerate(self.patterns):
-            for si_port in self.si_ports.keys():
-                tests.set_values(i, p.load[si_port], scan_maps[si_port], scan_inversions[si_port])
-            tests.set_values(i, p.launch['_pi'], pi_map)
+        tests = PackedVectors(len(patterns), len(interface), 2)
+        for si_port in self.si_ports.keys():
+            tests.set_values_bulk(slice(None), [p.load[si_port] for p in patterns],
+                                  scan_maps[si_port], scan_inversions[si_port])
+        tests.set_values_bulk(slice(None), [p.launch['_pi'] for p in patterns], pi_map)
         return tests
 
-    def tests8v(self, c):
+    def _tests8v(self, c, patterns):
         interface, pi_map, po_map, scan_maps, scan_inversions = self._maps(c)
-        init = PackedVectors(len(self.patterns), len(interface), 2)
-        for i, p in enumerate(self.patterns):
-            # init.set_values(i, '0' * len(interface))
-            for si_port in self.si_ports.keys():
-                init.set_values(i, p.load[si_port], scan_maps[si_port], scan_inversions[si_port])
-            init.set_values(i, p.launch['_pi'], pi_map)
-        sim4v = LogicSim(c, len(init), 2)
+        init = self._tests(c, patterns)
+        # one 4-valued LogicSim for all chunks of a StilReader
+        if self._sim4v is None or self._sim4v.circuit is not c or self._sim4v.nvectors < len(init):
+            self._sim4v = LogicSim(c, len(init), 2)
+        sim4v = self._sim4v
         sim4v.assign(init)
         sim4v.propagate()
         launch = init.copy()
         sim4v.capture(launch)
-        for i, p in enumerate(self.patterns):
-            # if there was no launch clock, then init = launch
-            if ('P' not in p.launch['_pi']) or ('P' not in p.capture['_pi']):
-                for si_port in self.si_ports.keys():
-                    launch.set_values(i, p.load[si_port], scan_maps[si_port], scan_inversions[si_port])
-            if 'P' in p.capture['_pi']:
-                launch.set_values(i, p.capture['_pi'], pi_map)
-        
+        # if there was no launch clock, then init = launch
+        reload = [i for i, p in enumerate(patterns)
+                  if ('P' not in p.launch['_pi']) or ('P' not in p.capture['_pi'])]
+        for si_port in self.si_ports.keys():
+            launch.set_values_bulk(reload, [patterns[i].load[si_port] for i in reload],
+                                   scan_maps[si_port], scan_inversions[si_port])
+        clocked = [i for i, p in enumerate(patterns) if 'P' in p.capture['_pi']]
+        launch.set_values_bulk(clocked, [patterns[i].capture['_pi'] for i in clocked], pi_map)
+
         return PackedVectors.from_pair(init, launch)
                 
-    def responses(self, c):
+    def _responses(self, c, patterns):
         interface, pi_map, po_map, scan_maps, scan_inversions = self._maps(c)
-        resp = PackedVectors(len(self.patterns), len(interface), 2)
-        for i, p in enumerate(self.patterns):
-            resp.set_values(i, p.capture['_po'], po_map)
-            for so_port in self.so_ports.keys():
-                resp.set_values(i, p.unload[so_port], scan_maps[so_port], scan_inversions[so_port])
+        resp = PackedVectors(len(patterns), len(interface), 2)
+        resp.set_values_bulk(slice(None), [p.capture['_po'] for p in patterns], po_map)
+        for so_port in self.so_ports.keys():
+            resp.set_values_bulk(slice(None), [p.unload[so_port] for p in patterns],
+                                 scan_maps[so_port], scan_inversions[so_port])
         return resp
-        
-        
+
+
+class StilReader(StilFile):
+    """Incremental STIL reader for files too large to parse at once.
+
+    Only the header blocks (up to the Pattern block) are parsed with the grammar. Patterns are then read
+    one Call at a time while iterating, so memory use does not depend on the number of patterns.
+    tests, tests8v and responses convert chunk-wise and either append to a given MappedVectors, write into a
+    given preallocated PackedVectors, or return a new PackedVectors.
+    """
+    def __init__(self, stil, buffer_size=1 << 20):
+        self._stil = stil
+        self._buffer_size = buffer_size
+        header = []
+        with _open(stil) as f:
+            for line in f:
+                if _pattern_block.match(line):
+                    break
+                header.append(line)
+        self._header_lines = len(header)
+        version, signal_groups, scan_chains = Lark(_grammar, parser="lalr", transformer=_HeaderTransformer())\
+            .parse(''.join(header))
+        super().__init__(version, signal_groups, scan_chains, [])
+        self.calls = None
+        self.patterns = None
+
+    def iter_calls(self):
+        with _open(self._stil) as f:
+            for _ in range(self._header_lines):
+                f.readline()
+            yield from _CallScanner(f, self._buffer_size).calls()
+
+    def iter_patterns(self):
+        return scan_patterns(self.iter_calls(), self.si_ports, self.so_ports)
+
+    def tests(self, c, out=None, chunk=4096):
+        return self._convert(self._tests, c, out, chunk)
+
+    def tests8v(self, c, out=None, chunk=4096):
+        return self._convert(self._tests8v, c, out, chunk)
+
+    def responses(self, c, out=None, chunk=4096):
+        return self._convert(self._responses, c, out, chunk)
+
+    def _convert(self, f, c, out, chunk):
+        assert (chunk % 8) == 0
+        parts = []
+        offset = 0
+        patterns = []
+        for p in itertools.chain(self.iter_patterns(), [None]):
+            if p is not None:
+                patterns.append(p)
+                if len(patterns) < chunk: continue
+            elif len(patterns) == 0 and (offset > 0 or out is not None):
+                break
+            vectors = f(c, patterns)
+            if out is None:
+                parts.append(vectors.bits)
+            elif isinstance(out, MappedVectors):
+                out.append(vectors)
+            else:
+                out.bits[..., offset // 8:offset // 8 + vectors.bits.shape[-1]] = vectors.bits
+            offset += len(patterns)
+            patterns = []
+        if out is None:
+            return PackedVectors(offset, from_cache=np.concatenate(parts, axis=-1), copy=False)
+        return out
+
+
+class _CallScanner:
+    # reads the statements of a Pattern block from a text file and yields its Calls.
+    def __init__(self, f, buffer_size):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self):
+        data = self.f.read(self.buffer_size)
+        if not data:
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self, n=1):
+        while len(self.buf) - self.pos < n and self._fill():
+            pass
+        return self.buf[self.pos:self.pos + n]
+
+    def _skip_space(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos >= len(self.buf) and not self._fill():
+                return
+            if self._peek(2) == '//':
+                self._until('\n')
+            elif self.pos < len(self.buf) and not self.buf[self.pos].isspace():
+                return
+
+    def _until(self, s):
+        while True:
+            i = self.buf.find(s, self.pos)
+            if i >= 0:
+                text = self.buf[self.pos:i]
+                self.pos = i + len(s)
+                return text
+            if not self._fill():
+                raise ValueError(f'unexpected end of STIL file while looking for {s!r}')
+
+    def _expect(self, s):
+        self._skip_space()
+        if self._peek(len(s)) != s:
+            raise ValueError(f'expected {s!r} in STIL Pattern block, found {self._peek(20)!r}')
+        self.pos += len(s)
+
+    def _quoted(self):
+        self._expect('"')
+        return self._until('"')
+
+    def _word(self):
+        self._skip_space()
+        m = _word.match(self._peek(64))
+        if m is None:
+            raise ValueError(f'unexpected STIL statement: {self._peek(20)!r}')
+        self.pos += m.end()
+        return m.group()
+
+    def _skip_block(self):
+        self._expect('{')
+        depth = 1
+        while depth > 0:
+            m = _brace.search(self.buf, self.pos)
+            if m is None:
+                self.pos = len(self.buf)
+                if not self._fill():
+                    raise ValueError('unexpected end of STIL file in block')
+                continue
+            self.pos = m.end()
+            depth += 1 if m.group() == '{' else -1
+
+    def _skip_statement(self):
+        # skips a statement with arguments up to ';' or over its block.
+        while True:
+            m = _statement_end.search(self.buf, self.pos)
+            if m is not None:
+                break
+            self.pos = len(self.buf)
+            if not self._fill():
+                raise ValueError('unexpected end of STIL file in statement')
+        if m.group() == ';':
+            self.pos = m.end()
+        else:
+            self.pos = m.start()
+            self._skip_block()
+
+    def calls(self):
+        self._expect('Pattern')
+        self._quoted()
+        self._expect('{')
+        yield from self._block_calls()
+
+    def _block_calls(self):
+        # yields the Calls up to the end of the current block, Loop bodies are repeated.
+        while True:
+            self._skip_space()
+            c = self._peek()
+            if c == '}' or c == '':
+                self.pos += len(c)
+                return
+            if c == '"':  # label
+                self._quoted()
+                self._expect(':')
+                continue
+            keyword = self._word()
+            if keyword == 'Call':
+                name = self._quoted()
+                self._expect('{')
+                parameters = {}
+                while True:
+                    self._skip_space()
+                    if self._peek() == '}':
+                        self.pos += 1
+                        break
+                    parameter = self._quoted()
+                    self._expect('=')
+                    parameters[parameter] = self._until(';').lstrip()
+                yield Call(name, parameters)
+            elif keyword == 'Ann':
+                self._expect('{*')
+                self._until('*}')
+            elif keyword == 'Loop':
+                count = int(self._until('{'))
+                body = list(self._block_calls())
+                for _ in range(count):
+                    yield from body
+            else:
+                self._skip_statement()
+
+
 class StilTransformer(Transformer):
     def __init__(self):
         super().__init__()
@@ -151,16 +365,33 @@ class StilTransformer(Transformer):
 
     def signal_groups(self, args): self._signal_groups = dict(args)
     
-    def pattern(self, args): self._calls = [c for c in args if isinstance(c, Call)]
+    @staticmethod
+    def loop(args): return StilTransformer._flat_calls(args[1:]) * int(args[0])
+
+    @staticmethod
+    def _flat_calls(args):
+        calls = []
+        for a in args:
+            if isinstance(a, Call):
+                calls.append(a)
+            elif isinstance(a, list):
+                calls += a
+        return calls
+
+    def pattern(self, args): self._calls = self._flat_calls(args)
 
     def scan_structures(self, args): self._scan_chains = dict(args)
 
     def start(self, args):
         return StilFile(float(args[0]), self._signal_groups, self._scan_chains, self._calls)
+
+
+class _HeaderTransformer(StilTransformer):
+    def start(self, args):
+        return float(args[0]), self._signal_groups, self._scan_chains
         
 
-def parse(stil):
-    grammar = r"""
+_grammar = r"""
     start: "STIL" FLOAT _ignore _block*
     _block: signal_groups | scan_structures | pattern
         | "Header" _ignore
@@ -184,10 +415,13 @@ def parse(stil):
     scan_cells: "ScanCells" (quoted | /!/)* ";"
     scan_master_clock: "ScanMasterClock" quoted ";"
     
-    pattern: "Pattern" quoted "{" ( label | w | c | macro | ann | call )* "}"
+    pattern: "Pattern" quoted "{" _pattern_statement* "}"
+    _pattern_statement: label | w | c | v | macro | ann | call | loop
+    loop: "Loop" /[0-9]+/ "{" _pattern_statement* "}"
     label: quoted ":"
     w: "W" quoted ";"
     c: "C" _ignore
+    v: "V" _ignore
     macro: "Macro" quoted ";"
     ann: "Ann" _ignore
     call: "Call" quoted "{" call_parameter* "}"
@@ -200,16 +434,24 @@ def parse(stil):
     _NOB: /[^{}]+/
     %ignore ( /\r?\n/ | "//" /[^\n]*/ | /[\t\f ]/ )+
     """
+_pattern_block = re.compile(r'\s*Pattern\s+"')
+_word = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_brace = re.compile(r'[{}]')
+_statement_end = re.compile(r'[;{]')
+
+
+def _open(stil):
     if '\n' not in str(stil):  # One line?: Assuming it is a file name.
         if str(stil).endswith('.gz'):
-            with gzip.open(stil, 'rt') as f:
-                text = f.read()
-        else:
-            with open(stil, 'r') as f:
-                text = f.read()
-    else:
-        text = str(stil)
-    return Lark(grammar, parser="lalr", transformer=StilTransformer()).parse(text)
+            return gzip.open(stil, 'rt')
+        return open(stil, 'r')
+    return io.StringIO(str(stil))
+
+
+def parse(stil):
+    with _open(stil) as f:
+        text = f.read()
+    return Lark(_grammar, parser="lalr", transformer=StilTransformer()).parse(text)
 
 
 def extract_scan_pattens(stil_calls):
@@ -2,7 +2,7 @@ from lark import Lark, Transformer
 from collections import namedtuple
 import gzip
 from .circuit import Circuit, Node, Line
-from .saed import pin_index
+from .saed import pin_index, is_output
 
 Instantiation = namedtuple('Instantiation', ['type', 'name', 'pins'])
 
@@ -79,7 +79,7 @@ class VerilogTransformer(Transformer):
             if type(stmt) is Instantiation:
                 n = Node(c, stmt.name, kind=stmt.type)
                 for p, s in stmt.pins.items():
-                    if p[0] == 'Q' or p[0] == 'Z' or p[0] == 'Y':
+                    if is_output(stmt.type, p):
                         Line(c, n.o[pin_index(stmt.type, p)], Node(c, s))
             elif stmt is not None and stmt.data == 'assign':
                 assignments.append((stmt.children[0], stmt.children[1]))
@@ -102,7 +102,7 @@ class VerilogTransformer(Transformer):
             if type(stmt) is Instantiation:
                 for p, s in stmt.pins.items():
                     n = c.cells[stmt.name]
-                    if p[0] != 'Q' and p[0] != 'Z' and p[0] != 'Y':
+                    if not is_output(stmt.type, p):
                         if s.startswith("1'b"):
                             const = f'__const{s[3]}__'
                             if const not in c.cells:
@@ -1,11 +1,15 @@
 import numpy as np
 import importlib.util
 import math
+import heapq
+import os
 if importlib.util.find_spec('numba') is not None:
     import numba
 else:
     from . import numba
     print('Numba unavailable. Falling back to pure python')
+from . import saed
+from . import packed_vectors
 
 
 TMAX = np.float32(2**127)  # almost np.PINF for 32-bit floating point values
@@ -13,63 +17,94 @@ TMIN = np.float32(-2**127)  # almost np.NINF for 32-bit floating point values
 
 
 class WaveSim:
-    def __init__(self, circuit, line_times, sdim=8, tdim=16):
+    def __init__(self, circuit, line_times, sdim=8, tdim=16, library=None, observe=None,
+                 hazards=False, encoding='float32', timescale=0.001, pool=None, recycle=False):
+        library = library or saed.library
+
+        self._init_encoding(encoding, timescale)
         self.line_times = line_times.copy()
         self.circuit = circuit
         self.sdim = sdim
         self.overflows = 0
+        self.evaluations = 0  # (op, slot) pairs evaluated by propagate
+        self.skipped = 0  # of these, pairs with constant inputs that took the shortcut in static_eval
+        self.interface = list(circuit.interface) + [n for n in circuit.nodes if 'dff' in n.kind.lower()]
+
+        # with observe (interface nodes or positions), only the fan-in cone of these nodes is simulated.
+        if observe is None:
+            cone = None
+            used = np.ones(len(circuit.lines), dtype=bool)
+        else:
+            observe = set(self.interface[o] if isinstance(o, (int, np.integer)) else o for o in observe)
+            cone = set(circuit.comb_fanin(observe))
+            used = np.zeros(len(circuit.lines), dtype=bool)
+            for n in cone:
+                if n in observe or 'dff' not in n.kind.lower():
+                    for line in n.i_lines:
+                        if line is not None:
+                            used[line.index] = True
 
-        # map line indices to self.state memory locations
-        self.lmap = np.zeros(len(circuit.lines), dtype='int')
+        # with recycle or pool, only captured waveforms get fixed memory. All other waveforms are placed after the
+        # fixed memory once the levels are known and are no longer available after propagate:
+        #   recycle: the memory of a waveform is reused by later levels once the level reading it is done.
+        #   pool (initial entries per slot): each slot allocates waveforms with their actual length as they are
+        #     computed, entries are released like with recycle and the pool of a slot is compacted when full.
+        self.pool = pool
+        self.recycle = recycle or pool is not None
+        deferred = np.zeros(len(circuit.lines), dtype=bool)
+        if pool is not None or recycle:
+            deferred[used] = True
+            for n in self.interface:
+                if len(n.i_lines) > 0 and (cone is None or n in observe):
+                    deferred[n.i_lines[0].index] = False
+
+        # map line indices to self.state memory locations, -1 for lines outside the simulated cone, -2 for deferred
         if type(tdim) is int:
-            self.lsize = len(circuit.lines) * tdim
             self.tdim = np.zeros(len(circuit.lines), dtype='int') + tdim
-            for lidx in range(len(circuit.lines)):
-                self.lmap[lidx] = lidx * tdim
         else:
-            self.lsize = 0
             self.tdim = np.asarray(tdim, dtype='int')
-            for lidx, cap in enumerate(self.tdim):
-                self.lmap[lidx] = self.lsize
-                self.lsize += cap
+        fixed = used & ~deferred
+        caps = np.where(fixed, self.tdim, 0)
+        self.lsize = int(caps.sum())
+        self.lmap = np.where(fixed, np.cumsum(caps) - caps, np.where(deferred, -2, -1))
         
-        # allocate self.state
-        interface_tdim = 4  # sufficient for storing only 1 transition.
-        self.interface = list(circuit.interface) + [n for n in circuit.nodes if 'dff' in n.kind.lower()]
+        # fixed memory layout, waveform capacities are kept in self.tdim and the ops.
+        interface_tdim = 3  # initial value, 1 transition and TMAX.
         interface_dict = dict([(n, i) for i, n in enumerate(self.interface)])
-        self.state = np.zeros((self.lsize + (2 + len(self.interface)) * interface_tdim, sdim), dtype='float32') + TMAX
+        mem_size = self.lsize + (2 + len(self.interface)) * interface_tdim
+        self.pool_start = mem_size
         self.zero = self.lsize
         self.tmp = self.zero + interface_tdim
         self.inputs_offset = self.tmp + interface_tdim
-        
-        # store waveform capacities in self.state
-        for lidx in range(len(circuit.lines)):
-            self.state[self.lmap[lidx]] = self.tdim[lidx]
-        self.state[self.zero] = interface_tdim
-        self.state[self.tmp] = interface_tdim
-        for iidx in range(len(self.interface)):
-            self.state[self.inputs_offset + iidx * interface_tdim] = interface_tdim
+        self._max_cap = max(int(self.tdim.max(initial=0)), interface_tdim)
+        mem_caps = np.full(mem_size, interface_tdim, dtype='int32')
+        mem_caps[self.lmap[fixed]] = self.tdim[fixed]
 
         # map test pattern and response indices to self.state memory locations
         self.tmap = np.asarray([self.inputs_offset + interface_dict[n] * interface_tdim if len(n.o_lines) > 0 else -1
                                 for n in self.interface], dtype='int')
-        self.cmap = np.asarray([self.lmap[n.i_lines[0].index] if len(n.i_lines) > 0 else -1 for n in self.interface],
-                               dtype='int')
+        self.cmap = np.asarray([self.lmap[n.i_lines[0].index] if len(n.i_lines) > 0 and (cone is None or n in observe)
+                                else -1 for n in self.interface], dtype='int')
         
-        # generate self.ops
+        # generate self.ops, inputs that do not read a line (interface inputs, zero) have line index no_line.
+        no_line = len(circuit.lines)
         ops = []
         for n in circuit.topological_order():
+            if cone is not None and n not in cone: continue
             if n in interface_dict:
                 inp = self.inputs_offset + interface_dict[n] * interface_tdim
                 if len(n.o) > 0 and n.o_lines[0] is not None:
-                    ops.append((0b1010, self.lmap[n.o_lines[0].index], inp, self.zero, n.o_lines[0].index, 0, 0))
+                    ops.append((0b1010, self.lmap[n.o_lines[0].index], inp, self.zero, n.o_lines[0].index, no_line,
+                                no_line))
                 if 'dff' in n.kind.lower():
                     if len(n.o) > 1 and n.o_lines[1] is not None:
-                        ops.append((0b0101, self.lmap[n.o_lines[1].index], inp, self.zero, n.o_lines[1].index, 0, 0))
+                        ops.append((0b0101, self.lmap[n.o_lines[1].index], inp, self.zero, n.o_lines[1].index, no_line,
+                                    no_line))
                 else:
                     for o_line in n.o_lines[1:]:
                         if o_line is not None:
-                            ops.append((0b1010, self.lmap[o_line.index], inp, self.zero, o_line.index, 0, 0))
+                            ops.append((0b1010, self.lmap[o_line.index], inp, self.zero, o_line.index, no_line,
+                                        no_line))
             else:
                 if len(n.o_lines) > 0 and n.o_lines[0] is not None:
                     o0_idx = n.o_lines[0].index
@@ -82,96 +117,471 @@ class WaveSim:
                     i0_idx = n.i_lines[0].index
                     i0_mem = self.lmap[i0_idx]
                 else:
-                    i0_idx = 0
+                    i0_idx = no_line
                     i0_mem = self.zero
                 if len(n.i_lines) > 1 and n.i_lines[1] is not None:
                     i1_idx = n.i_lines[1].index
                     i1_mem = self.lmap[i1_idx]
                 else:
-                    i1_idx = 0
+                    i1_idx = no_line
                     i1_mem = self.zero
-                kind = n.kind.lower()
-                if kind == '__fork__':
+                if n.kind == '__fork__':
                     for o_line in n.o_lines:
+                        if o_line is None: continue
                         ops.append((0b1010, self.lmap[o_line.index], i0_mem, self.zero, o_line.index, i0_idx, i1_idx))
-                elif kind.startswith('nand'):
-                    ops.append((0b0111, o0_mem, i0_mem, i1_mem, o0_idx, i0_idx, i1_idx))
-                elif kind.startswith('nor'):
-                    ops.append((0b0001, o0_mem, i0_mem, i1_mem, o0_idx, i0_idx, i1_idx))
-                elif kind.startswith('and'):
-                    ops.append((0b1000, o0_mem, i0_mem, i1_mem, o0_idx, i0_idx, i1_idx))
-                elif kind.startswith('or'):
-                    ops.append((0b1110, o0_mem, i0_mem, i1_mem, o0_idx, i0_idx, i1_idx))
-                elif kind.startswith('xor'):
-                    ops.append((0b0110, o0_mem, i0_mem, i1_mem, o0_idx, i0_idx, i1_idx))
-                elif kind.startswith('xnor'):
-                    ops.append((0b1001, o0_mem, i0_mem, i1_mem, o0_idx, i0_idx, i1_idx))
-                elif kind.startswith('not') or kind.startswith('inv'):
-                    ops.append((0b0101, o0_mem, i0_mem, self.zero, o0_idx, i0_idx, i1_idx))
-                elif kind.startswith('buf') or kind.startswith('nbuf'):
-                    ops.append((0b1010, o0_mem, i0_mem, self.zero, o0_idx, i0_idx, i1_idx))
-                elif kind.startswith('__const1__') or kind.startswith('tieh'):
-                    ops.append((0b0101, o0_mem, self.zero, self.zero, o0_idx, i0_idx, i1_idx))
-                elif kind.startswith('__const0__') or kind.startswith('tiel'):
-                    ops.append((0b1010, o0_mem, self.zero, self.zero, o0_idx, i0_idx, i1_idx))
-                else:
-                    print('unknown gate type', kind)
-        self.ops = np.asarray(ops, dtype='int32')
-        
-        # generate level data
-        levels = np.zeros(len(self.state), dtype='int32')
+                    continue
+                k = len(n.i_lines)
+                if k > 2:
+                    raise ValueError(f'{n.kind} node {n.name} has {k} inputs, split complex gates first')
+                table = library.truth_table(n.kind, k)
+                if table is None:
+                    raise ValueError(f'Unsupported node kind {n.kind} of {n.name}')
+                # LUT (b a: 11 10 01 00) from the truth table over the first k inputs
+                lut = sum(((table >> (c & ((1 << k) - 1))) & 1) << c for c in range(4))
+                ops.append((lut, o0_mem, i0_mem if k > 0 else self.zero, i1_mem if k > 1 else self.zero, o0_idx,
+                            i0_idx, i1_idx))
+        self.ops = np.asarray([op for op in ops if op[1] != -1], dtype='int32').reshape(-1, 7)
+        z_caps = np.where(self.ops[:, 1] >= 0, mem_caps[self.ops[:, 1]], self.tdim[self.ops[:, 4]])
+        self.ops = np.hstack((self.ops, z_caps[:, None]))  # z capacity
+
+        # generate level data, deferred waveforms are keyed by line index after the fixed memory locations.
+        keys = np.where(self.ops[:, 1:4] >= 0, self.ops[:, 1:4], mem_size + self.ops[:, 4:7])
+        levels = np.zeros(mem_size + len(circuit.lines), dtype='int32')
         level_starts = [0]
         current_level = 1
-        for i, op in enumerate(self.ops):
-            if levels[op[2]] >= current_level or levels[op[3]] >= current_level:
+        for i, (z, a, b) in enumerate(keys):
+            if levels[a] >= current_level or levels[b] >= current_level:
                 current_level += 1
                 level_starts.append(i)
-            levels[op[1]] = current_level
+            levels[z] = current_level
         self.level_starts = np.asarray(level_starts, dtype='int32')
         self.level_stops = np.asarray(level_starts[1:] + [len(self.ops)], dtype='int32')
+
+        extra = 0
+        if pool is not None:
+            self._alloc_rows(deferred)
+            extra = pool
+        elif recycle:
+            offsets, extra, _ = self._reuse(deferred, self.tdim)
+            for c in (1, 2, 3):
+                reads = self.ops[:, c] == -2
+                self.ops[reads, c] = mem_size + offsets[self.ops[reads, c + 3]]
+        self.lmap[deferred] = -1
+
+        self._alloc_state(mem_size + extra)
         
         m1 = np.array([2 ** x for x in range(7, -1, -1)], dtype='uint8')
         m0 = ~m1
         self.mask = np.rollaxis(np.vstack((m0, m1)), 1)
+
+        # per-slot delay overrides: slot_delays[s, polarity] is added to the delay of line slot_lines[s] in slot s.
+        self.slot_lines = np.full(sdim, -1, dtype='int32')
+        self.slot_delays = np.zeros((sdim, 2), dtype='float32')
+        self._slot_overrides = False
+
+        # with hazards, propagate accumulates per line over all slots: functional toggles, glitches (pulse pairs),
+        # rejected pulses, overflow events and the largest number of toggles in one waveform.
+        self.hazards = np.zeros((len(circuit.lines), 5), dtype='int64') if hazards else None
+        self._init_derived()
+
+    def _init_derived(self):
+        # state derived from the compiled model and settings, shared by __init__ and load_checkpoint.
+        self._line_times = self._enc_line_times()
+        self._slot_delays = self._enc_delays(self.slot_delays)
+        # (line, slot) pairs known to be constant from a LogicSim pre-pass: 0 or 1, -1 for unknown.
+        self.static_vals = np.full((len(self.circuit.lines), self.sdim), -1, dtype='int8')
+        self._static = False
+        self._margins = None
+        if self.pool is not None:
+            self.bumps = np.zeros(self.sdim, dtype='int32')
+            self.row_releases = np.full(len(self.offs), -1, dtype='int32')
         
+    def _init_encoding(self, encoding, timescale):
+        # times in self.state are float32, or int32/int16 fixed-point in units of timescale, given in the units of
+        # line_times (1e-12 / DelayFile.timescale for ps). TMIN/TMAX map to the integer extremes.
+        self.encoding = np.dtype(encoding)
+        assert self.encoding in (np.float32, np.int32, np.int16)
+        if self.encoding.kind == 'f':
+            self.timescale = 1.0
+            self.tmin, self.tmax = TMIN, TMAX
+        else:
+            self.timescale = timescale
+            self.tmin = self.encoding.type(np.iinfo(self.encoding).min)
+            self.tmax = self.encoding.type(np.iinfo(self.encoding).max)
+
+    def _alloc_state(self, size):
+        self.state = np.full((size, self.sdim), self.tmax, dtype=self.encoding)
+
+    def _reuse(self, deferred, sizes):
+        # allocates sizes[line] entries to each deferred line from the level of its op to the last level reading
+        # it. Like registers, entries are reused by later levels once that level is done. Returns the offset of
+        # each line, the total size and the release level of each op.
+        op_levels = np.repeat(np.arange(len(self.level_starts)), self.level_stops - self.level_starts)
+        releases = np.full(len(deferred), -1)
+        for c in (5, 6):
+            reads = self.ops[:, c - 3] == -2
+            np.maximum.at(releases, self.ops[reads, c], op_levels[reads])
+        offsets = np.full(len(deferred), -1)
+        op_releases = np.full(len(self.ops), -1)
+        free = {}
+        busy = []
+        total = 0
+        for op_idx, op in enumerate(self.ops):
+            if op[1] != -2: continue
+            level = op_levels[op_idx]
+            while len(busy) > 0 and busy[0][0] < level:
+                _, size, offset = heapq.heappop(busy)
+                free[size].append(offset)
+            size = int(sizes[op[4]])
+            if len(free.setdefault(size, [])) > 0:
+                offset = free[size].pop()
+            else:
+                offset = total
+                total += size
+            offsets[op[4]] = offset
+            op_releases[op_idx] = max(releases[op[4]], level)
+            heapq.heappush(busy, (op_releases[op_idx], size, offset))
+        return offsets, total, op_releases
+
+    def _alloc_rows(self, deferred):
+        # self.rows holds the z, a and b rows of self.offs for each op (-1 for fixed memory) and the level after
+        # which z is released. self.offs holds the pool location of each row and slot, so there are as many rows
+        # as waveforms alive at any level.
+        line_rows, nrows, op_releases = self._reuse(deferred, np.ones(len(deferred), dtype='int'))
+        self.rows = np.full((len(self.ops), 4), -1, dtype='int32')
+        for c in (1, 2, 3):
+            reads = self.ops[:, c] == -2
+            self.rows[reads, c - 1] = line_rows[self.ops[reads, c + 3]]
+        self.rows[:, 3] = op_releases
+        self.offs = np.zeros((nrows, self.sdim), dtype='int32')
+
+    def _grow_pool(self):
+        self.pool = max(2 * self.pool, self._max_cap)
+        state = self.state
+        self._alloc_state(self.pool_start + self.pool)
+        self.state[:len(state)] = state
+
+    def _init_device(self):
+        pass
+
+    # compiled model and settings kept by checkpoints, everything else is derived on load.
+    _checkpoint_arrays = ('line_times', 'tdim', 'lmap', 'tmap', 'cmap', 'ops', 'level_starts', 'level_stops', 'mask',
+                          'slot_lines', 'slot_delays', 'hazards', 'rows', 'offs')
+    _checkpoint_values = ('timescale', 'sdim', 'overflows', 'evaluations',
+                          'skipped', 'pool', 'recycle', 'lsize', 'pool_start', 'zero',
+                          'tmp', 'inputs_offset', '_max_cap', '_slot_overrides')
+
+    def save_checkpoint(self, file, offset=0, **results):
+        """Saves the compiled simulator, the offset of the next vectors and result arrays to an .npz file.
+
+        results are keyword arrays or numbers (e.g. captures, SAIF counts, detections). The file is replaced
+        atomically, so an interrupted save keeps the previous checkpoint.
+        """
+        data = dict((f'result_{name}', value) for name, value in results.items())
+        for name in self._checkpoint_arrays + self._checkpoint_values:
+            value = getattr(self, name, None)
+            if value is not None:
+                data[name] = value
+        data.update(encoding=self.encoding.str, state_size=len(self.state), nlines=len(self.circuit.lines),
+                    offset=offset)
+        tmp_file = f'{file}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez_compressed(f, **data)
+        os.replace(tmp_file, file)
+
+    @classmethod
+    def load_checkpoint(cls, file, circuit):
+        """Restores a simulator saved by save_checkpoint for the same circuit without compiling it again.
+
+        Returns the simulator, the saved offset and a dict of the saved results.
+        """
+        sim = cls.__new__(cls)
+        with np.load(file) as data:
+            assert int(data['nlines']) == len(circuit.lines), 'checkpoint is for a different circuit'
+            sim.hazards = None
+            sim.pool = None
+            for name in cls._checkpoint_arrays:
+                if name in data:
+                    setattr(sim, name, data[name])
+            for name in cls._checkpoint_values:
+                if name in data:
+                    setattr(sim, name, data[name].item())
+            sim._init_encoding(str(data['encoding']), sim.timescale)
+            sim._alloc_state(int(data['state_size']))
+            offset = int(data['offset'])
+            results = dict((name[7:], data[name] if data[name].ndim > 0 else data[name].item())
+                           for name in data.files if name.startswith('result_'))
+        sim.circuit = circuit
+        sim.interface = list(circuit.interface) + [n for n in circuit.nodes if 'dff' in n.kind.lower()]
+        sim._init_derived()
+        sim._init_device()
+        return sim, offset, results
+
+    def run(self, vectors, captures, times, offset=0, time=0.0, sigma=0, checkpoint=None, interval=16):
+        """Simulates vectors from offset on in chunks of sdim and captures the values at times into captures.
+
+        With checkpoint, the simulator, the offset of the next chunk and captures are saved to this file every
+        interval chunks and after the last one. To resume, load the checkpoint and run again from the saved offset
+        with the saved captures. Returns the offset after the last vector.
+        """
+        chunks = 0
+        while offset < vectors.nvectors:
+            self.assign(vectors, time, offset)
+            self.propagate()
+            self.capture(captures, times, offset, sigma)
+            offset += self.sdim
+            chunks += 1
+            if checkpoint is not None and (chunks % interval == 0 or offset >= vectors.nvectors):
+                self.save_checkpoint(checkpoint, offset, captures=captures)
+        return offset
+
     def get_line_delay(self, line, polarity):
         return self.line_times[line, 0, polarity]
     
     def set_line_delay(self, line, polarity, delay):
         self.line_times[line, 0, polarity] = delay
+        self._line_times[line, 0, polarity] = self._enc_delays(delay)
+        self._margins = None
+
+    def _enc_line_times(self):
+        # line_times in state units with an extra zero-delay row, read by op inputs that are not lines.
+        enc = self._enc_delays(self.line_times)
+        return np.concatenate((enc, np.zeros((1,) + enc.shape[1:], dtype=enc.dtype)))
+
+    def _enc_delays(self, delays):
+        # delays in state units, the same array for float32 encoding.
+        if self.encoding.kind == 'f':
+            return delays
+        return np.rint(np.asarray(delays) / self.timescale).astype('int32')
+
+    def _enc_times(self, times):
+        return np.asarray(times, dtype='float64') / self.timescale
+
+    def _enc_launch(self, time):
+        # launch times for all interface nodes in state units.
+        launch = np.broadcast_to(np.asarray(time, dtype='float64'), (len(self.interface),))
+        if self.encoding.kind == 'f':
+            return launch.astype(self.encoding)
+        return np.clip(np.rint(launch / self.timescale), self.tmin + 1, self.tmax - 1).astype(self.encoding)
+
+    def _decode(self, raw):
+        # times from state units, with sentinels mapped to TMIN and TMAX.
+        if self.encoding.kind == 'f':
+            return raw
+        return np.where(raw >= self.tmax, TMAX, np.where(raw <= self.tmin, TMIN, raw * self.timescale))
+
+    def set_slot_delays(self, slot_lines=None, slot_delays=None):
+        """Sets the per-slot delay overrides from slot 0 on. Without arguments, all overrides are cleared.
+
+        slot_lines holds one line index per slot (-1 for none), slot_delays the extra (rising, falling) delays.
+        """
+        self.slot_lines[:] = -1
+        self.slot_delays[:] = 0
+        self._slot_overrides = slot_lines is not None
+        if slot_lines is not None:
+            self.slot_lines[:len(slot_lines)] = slot_lines
+            self.slot_delays[:len(slot_lines)] = slot_delays
+        self._slot_delays[...] = self._enc_delays(self.slot_delays)
+        self._upload_slot_delays()
+
+    def _upload_slot_delays(self):
+        pass
+
+    @staticmethod
+    def logic_stimuli(vectors):
+        """8-valued stimuli for a LogicSim pre-pass with the same input waveforms assign() derives from vectors."""
+        bits = vectors.bits
+        init = bits[:, 0]
+        if vectors.vdim > 2:
+            toggle = bits[:, 2] & ~(bits[:, 0] ^ bits[:, 1])
+        else:
+            toggle = np.zeros_like(init)
+        stimuli = packed_vectors.PackedVectors(vectors.nvectors, len(bits), 3)
+        stimuli.bits[:, 0] = init
+        stimuli.bits[:, 1] = ~(init ^ toggle)
+        stimuli.bits[:, 2] = toggle
+        return stimuli
+
+    @staticmethod
+    def toggle_tdim(logic, tdim=16):
+        """Line capacities from a pre-pass: 3 entries for lines that cannot toggle for any vector, tdim otherwise.
+
+        logic is a LogicSim (vdim 3, without recycle) propagated with logic_stimuli(vectors).
+        """
+        toggles = logic.state[logic.lmap, 2].any(axis=-1)
+        return np.where(toggles, tdim, 3)
+
+    def set_static(self, logic=None, offset=0):
+        """Takes the (line, slot) pairs that cannot toggle and their values from an 8-valued LogicSim pre-pass.
+
+        logic is a LogicSim (vdim 3, without recycle) propagated with logic_stimuli(vectors), its vectors offset to
+        offset + sdim correspond to slots 0 to sdim. propagate writes the values of these pairs instead of evaluating
+        them. Without logic, all pairs are evaluated again.
+        """
+        self.static_vals[...] = -1
+        self._static = logic is not None
+        if logic is not None:
+            assert len(logic.state) >= len(self.circuit.lines), 'pre-pass needs all line values'
+            nvectors = min(logic.nvectors - offset, self.sdim)
+            bits = logic.state[logic.lmap, :, offset // 8:(offset + nvectors - 1) // 8 + 1]
+            bits = np.unpackbits(bits, axis=-1)[..., offset % 8:offset % 8 + nvectors].astype(bool)
+            static = (bits[:, 0] != bits[:, 1]) & ~bits[:, 2]  # initial value = final value, no toggles
+            self.static_vals[:, :nvectors] = np.where(static, bits[:, 0], -1)
+        self._upload_static()
+
+    def _upload_static(self):
+        pass
+
+    def skip_ratio(self):
+        return self.skipped / max(self.evaluations, 1)
+
+    def reset_hazards(self):
+        self.hazards[...] = 0
+
+    def hazard_tdim(self):
+        # capacities sufficient for all waveforms seen so far: initial value, toggles and TMAX.
+        return self.hazards[:, 4] + 2
+
+    def update_delays(self, line_times=None, updates=None, resimulate=True, sdim=None):
+        """Changes line delays in place and re-simulates from the first level reading a changed line.
+
+        Either a complete new line_times array or updates, an iterable of (line, polarity, delay), is given.
+        The waveforms of all earlier levels in self.state are reused, so the inputs must still be assigned and
+        propagated as before. Returns the first affected level (len(self.level_starts) if nothing changed).
+        """
+        if line_times is not None:
+            line_times = np.asarray(line_times, dtype=self.line_times.dtype)
+            changed = np.nonzero((line_times != self.line_times).reshape(len(line_times), -1).any(axis=1))[0]
+            self.line_times[...] = line_times
+        else:
+            changed = []
+            for line, polarity, delay in updates:
+                self.line_times[line, 0, polarity] = delay
+                changed.append(line)
+            changed = np.unique(np.asarray(changed, dtype='int64'))
+        self._upload_line_times()
+        affected = np.nonzero(np.isin(self.ops[:, 5], changed) | np.isin(self.ops[:, 6], changed))[0]
+        if len(affected) == 0:
+            return len(self.level_starts)
+        level = int(np.searchsorted(self.level_starts, affected[0], side='right')) - 1
+        if resimulate:
+            self.propagate(sdim, level)
+        return level
+
+    def _upload_line_times(self):
+        self._line_times[:-1] = self._enc_delays(self.line_times)
+        self._margins = None
+
+    def capture_margins(self):
+        """Per line, the minimum delay to a captured line less the pulse thresholds on the way (inf if none).
+
+        The captured values up to a horizon only depend on the waveform of each line up to horizon - margin.
+        """
+        if self._margins is None:
+            margins = np.full(len(self.circuit.lines), np.inf)
+            margins[[n.i_lines[0].index for n, c in zip(self.interface, self.cmap) if c >= 0]] = 0
+            d_min = self.line_times[:, 0].min(axis=-1)
+            in_lines, used = self.ops[:, 5:7], self._line_inputs()
+            # a later input event within thresh may still cancel an output toggle before the horizon.
+            z_margins = -self._input_thresholds()
+            for op_start, op_stop in zip(self.level_starts[::-1], self.level_stops[::-1]):
+                z_margins[op_start:op_stop] += margins[self.ops[op_start:op_stop, 4]]
+                for pin in (0, 1):
+                    lines = in_lines[op_start:op_stop, pin][used[op_start:op_stop, pin]]
+                    np.minimum.at(margins, lines, z_margins[op_start:op_stop][used[op_start:op_stop, pin]] +
+                                  d_min[lines])
+            self._margins = margins
+        return self._margins
+
+    def _line_inputs(self):
+        # per op, whether a and b read lines. Otherwise they read zero or interface inputs with the zero-delay row.
+        return self.ops[:, 5:7] < len(self.line_times)
+
+    def _input_thresholds(self):
+        # per op, the largest pulse threshold of its input lines.
+        thresh = np.append(self.line_times[:, 1].max(axis=-1), 0)
+        return thresh[self.ops[:, 5:7]].max(axis=-1)
+
+    def _op_stops(self, horizon):
+        # per op, the time after which input events cannot change z up to horizon - margin(z), in state units.
+        stops = horizon - self.capture_margins()[self.ops[:, 4]] + self._input_thresholds()
+        if self._slot_overrides:
+            stops -= min(0.0, float(self.slot_delays[self.slot_lines >= 0].min(initial=0)))  # earlier arrivals
+        if self.encoding.kind == 'f':
+            return np.clip(stops, TMIN, TMAX).astype(self.encoding)
+        return np.clip(np.ceil(stops / self.timescale), self.tmin, self.tmax).astype(self.encoding)
 
     def assign(self, vectors, time=0.0, offset=0):
+        """Sets the input waveforms of slots 0 to sdim from vectors offset to offset + sdim.
+
+        time is the launch time of transitions, either a scalar or one value per interface node.
+        """
         nvectors = min(vectors.nvectors - offset, self.sdim)
-        for i, node in enumerate(self.interface):
-            iidx = self.tmap[i]
-            if iidx < 0: continue
-            for p in range(nvectors):
-                vector = p + offset
-                a = vectors.bits[i, :, vector // 8]
-                m = self.mask[vector % 8]
-                toggle = 0
-                if a[0] & m[1]:
-                    self.state[iidx + 1, p] = TMIN
-                    toggle += 1
-                if (len(a) > 2) and (a[2] & m[1]) and ((a[0] & m[1]) == (a[1] & m[1])):
-                    self.state[iidx + 1 + toggle, p] = time
-                    toggle += 1
-                self.state[iidx + 1 + toggle, p] = TMAX
-
-    def propagate(self, sdim=None):
+        if nvectors <= 0: return
+        bits = vectors.bits[:len(self.interface), :, offset // 8:(offset + nvectors - 1) // 8 + 1]
+        bits = np.unpackbits(bits, axis=-1)[..., offset % 8:offset % 8 + nvectors].astype(bool)
+        valid = self.tmap[:len(bits)] >= 0
+        mem = self.tmap[:len(bits)][valid]
+        bits = bits[valid]
+        launch = self._enc_launch(time)[:len(valid)][valid]
+        launch = np.broadcast_to(launch[:, None], (len(mem), nvectors))
+        init = bits[:, 0]
+        if bits.shape[1] > 2:
+            toggle = bits[:, 2] & (bits[:, 0] == bits[:, 1])
+        else:
+            toggle = np.zeros_like(init)
+        both = init & toggle
+        self.state[mem + 2, :nvectors] = np.where(both, self.tmax, self.state[mem + 2, :nvectors])
+        self.state[mem + 1, :nvectors] = np.where(both, launch, np.where(init | toggle, self.tmax,
+                                                                          self.state[mem + 1, :nvectors]))
+        self.state[mem, :nvectors] = np.where(init, self.tmin, np.where(toggle, launch, self.tmax))
+
+    def propagate(self, sdim=None, level=0, horizon=None):
+        """Computes the waveforms of slots 0 to sdim from level on.
+
+        With horizon, input events are dropped once they cannot change a captured value up to this time, so only
+        captures up to horizon stay exact (without overflows). Hazard counters then cover the kept events.
+        """
         if sdim is None:
             sdim = self.sdim
         else:
             sdim = min(sdim, self.sdim)
-        for op_start, op_stop in zip(self.level_starts, self.level_stops):
-            self.overflows += level_eval(self.ops, op_start, op_stop, self.state, 0, sdim,
-                                         self.line_times)
+        # without overrides (or hazards, static pairs), None compiles the lookup (or counting) out of the kernels.
+        slot_lines = self.slot_lines if self._slot_overrides else None
+        static_vals = self.static_vals if self._static else None
+        op_stops = None if horizon is None else self._op_stops(horizon)
+        assert level == 0 or not self.recycle, 'waveforms of earlier levels are not kept'
+        if self.pool is not None:
+            self.bumps[:] = self.pool_start
+            self.row_releases[:] = -1
+            for level, (op_start, op_stop) in enumerate(zip(self.level_starts, self.level_stops)):
+                while True:
+                    overflows, skipped, op_start = pool_eval(self.ops, self.rows, op_start, op_stop, level,
+                                                             self.state, self.pool_start, self.bumps, self.offs,
+                                                             self.row_releases, 0, sdim, self._line_times, slot_lines,
+                                                             self._slot_delays, self.hazards, static_vals,
+                                                             op_stops, self.tmin, self.tmax)
+                    self.overflows += overflows
+                    self.skipped += skipped
+                    if op_start == op_stop: break
+                    self._grow_pool()
+            self.evaluations += len(self.ops) * sdim
+            return
+        if level >= len(self.level_starts):
+            return
+        self.evaluations += (len(self.ops) - self.level_starts[level]) * sdim
+        for op_start, op_stop in zip(self.level_starts[level:], self.level_stops[level:]):
+            overflows, skipped = level_eval(self.ops, op_start, op_stop, self.state, 0, sdim, self._line_times,
+                                            slot_lines, self._slot_delays, self.hazards, static_vals, op_stops,
+                                            self.tmin, self.tmax)
+            self.overflows += overflows
+            self.skipped += skipped
 
     def _wave(self, mem, vector):
         if mem < 0:
             return None
-        wcap = int(self.state[mem, vector])
-        return self.state[mem+1:mem+wcap, vector]
+        w = self.state[mem:mem + self._max_cap, vector]
+        return self._decode(w[:np.argmax(w >= self.tmax) + 1])
 
     def wave(self, line, vector):
         return self._wave(self.lmap[line], vector)
@@ -182,56 +592,56 @@ class WaveSim:
     def wave_ppo(self, o, vector):
         return self._wave(self.cmap[o], vector)
 
+    def _stats(self, mems, st_start, st_stop):
+        # earliest arrival, latest stabilization and toggle count for each memory offset and slot.
+        out = self._stats_raw(np.asarray(mems, dtype='int64'), st_start, st_stop)
+        out[..., :2] = self._decode(out[..., :2])
+        return out
+
+    def _stats_raw(self, mems, st_start, st_stop):
+        out = np.zeros((len(mems), st_stop - st_start, 3), dtype='float64')
+        stats_eval(self.state, mems, st_start, st_stop, out, self.tmin, self.tmax)
+        return out
+
+    def _values(self, mems, st_start, st_stop, times, sigma=0.0):
+        # values (or probabilities of 1 if sigma > 0) at times for each memory offset and slot.
+        return self._values_raw(np.asarray(mems, dtype='int64'), st_start, st_stop, self._enc_times(times),
+                                sigma * math.sqrt(2) / self.timescale)
+
+    def _values_raw(self, mems, st_start, st_stop, times, s_sqrt2):
+        out = np.zeros((len(mems), st_stop - st_start, len(times)), dtype='float64')
+        values_eval(self.state, mems, st_start, st_stop, times, s_sqrt2, out, 0, self.tmin, self.tmax)
+        return out
+
+    def stats(self, lines=None, sdim=None):
+        """Earliest arrival, latest stabilization and toggle count of lines for slots 0 to sdim.
+
+        Returns an array of shape (len(lines), sdim, 3). Lines default to all lines.
+        """
+        mems = self.lmap if lines is None else self.lmap[np.asarray(lines, dtype='int64')]
+        return self._stats(mems, 0, self.sdim if sdim is None else min(sdim, self.sdim))
+
+    def stats_ppo(self, sdim=None):
+        return self._stats(self.cmap, 0, self.sdim if sdim is None else min(sdim, self.sdim))
+
     def eat(self, line, vector):
-        eat = TMAX
-        for t in self.wave(line, vector):
-            if t >= TMAX: break
-            if t <= TMIN: continue
-            eat = min(eat, t)
-        return eat
+        return self._stats([self.lmap[line]], vector, vector + 1)[0, 0, 0]
 
     def _lst(self, mem, vector):
-        lst = TMIN
-        for t in self._wave(mem, vector):
-            if t >= TMAX: break
-            if t <= TMIN: continue
-            lst = max(lst, t)
-        return lst
+        return self._stats([mem], vector, vector + 1)[0, 0, 1]
 
     def lst_ppo(self, o, vector):
         return self._lst(self.cmap[o], vector)
 
     def toggles(self, line, vector):
-        tog = 0
-        for t in self.wave(line, vector):
-            if t >= TMAX: break
-            if t <= TMIN: continue
-            tog += 1
-        return tog
-    
+        return int(self._stats([self.lmap[line]], vector, vector + 1)[0, 0, 2])
+
     def _vals(self, mem, vector, times, sigma=0.0):
-        s_sqrt2 = sigma * math.sqrt(2)
-        m = 0.5
-        accs = [0.0] * len(times)
-        values = [0] * len(times)
-        for t in self._wave(mem, vector):
-            if t >= TMAX: break
-            for idx, time in enumerate(times):
-                if t < time:
-                    values[idx] = values[idx] ^ 1
-            m = -m
-            if t <= TMIN: continue
-            if s_sqrt2 > 0:
-                for idx, time in enumerate(times):
-                    accs[idx] += m * (1 + math.erf((t - time) / s_sqrt2))
-        if (m < 0) and (s_sqrt2 > 0):
-            for idx, time in enumerate(times):
-                accs[idx] += 1
-        if s_sqrt2 == 0:
-            return values
-        else:
-            return accs
-    
+        values = self._values([mem], vector, vector + 1, times, sigma)[0, 0]
+        if sigma > 0:
+            return list(values)
+        return [int(v) for v in values]
+
     def vals(self, line, vector, times, sigma=0):
         return self._vals(self.lmap[line], vector, times, sigma)
 
@@ -243,60 +653,288 @@ class WaveSim:
 
     def val_ppo(self, o, vector, time=TMAX, sigma=0):
         return self._vals(self.cmap[o], vector, [time], sigma)[0]
-    
+
+    def saif(self, counts, t_start, t_end, sdim=None):
+        # adds the time at 0, the time at 1 and the number of toggles within [t_start, t_end) of each line
+        # and slot to counts (shape (lines, 3), float64).
+        if sdim is None:
+            sdim = self.sdim
+        else:
+            sdim = min(sdim, self.sdim)
+        raw = counts if self.timescale == 1.0 else np.zeros_like(counts)
+        self._saif_raw(raw, t_start / self.timescale, t_end / self.timescale, sdim)
+        if raw is not counts:
+            counts[:, :2] += raw[:, :2] * self.timescale
+            counts[:, 2] += raw[:, 2]
+
+    def _saif_raw(self, counts, t_start, t_end, sdim):
+        saif_eval(self.state, self.lmap, 0, sdim, t_start, t_end, counts, self.tmin, self.tmax)
+
     def capture(self, captures, times, offset=0, sigma=0):
         nvectors = min(captures.shape[1] - offset, self.sdim)
-        for i, node in enumerate(self.interface):
-            if len(node.i) == 0: continue
-            line = node.i_lines[0].index
-            for p in range(nvectors):
-                captures[i, p + offset] = self.vals(line, p, times, sigma)
+        values_eval(self.state, self.cmap, 0, nvectors, self._enc_times(times), sigma * math.sqrt(2) / self.timescale,
+                    captures, offset, self.tmin, self.tmax)
+
+
+@numba.njit
+def stats_eval(state, mems, st_start, st_stop, out, tmin, tmax):
+    for i in range(len(mems)):
+        mem = mems[i]
+        if mem < 0: continue
+        for st_idx in range(st_start, st_stop):
+            eat = tmax
+            lst = tmin
+            tog = 0
+            for tidx in range(len(state) - mem):
+                t = state[mem + tidx, st_idx]
+                if t >= tmax: break
+                if t <= tmin: continue
+                eat = min(eat, t)
+                lst = max(lst, t)
+                tog += 1
+            out[i, st_idx - st_start, 0] = eat
+            out[i, st_idx - st_start, 1] = lst
+            out[i, st_idx - st_start, 2] = tog
+
+
+@numba.njit
+def values_eval(state, mems, st_start, st_stop, times, s_sqrt2, out, offset, tmin, tmax):
+    for i in range(len(mems)):
+        mem = mems[i]
+        if mem < 0: continue
+        for st_idx in range(st_start, st_stop):
+            o = out[i, offset + st_idx - st_start]
+            for tidx in range(len(times)):
+                o[tidx] = 0
+            m = 0.5
+            for widx in range(len(state) - mem):
+                t = state[mem + widx, st_idx]
+                if t >= tmax: break
+                m = -m
+                if s_sqrt2 > 0:
+                    if t <= tmin: continue
+                    for tidx in range(len(times)):
+                        o[tidx] += m * (1 + math.erf((t - times[tidx]) / s_sqrt2))
+                else:
+                    for tidx in range(len(times)):
+                        if t < times[tidx]:
+                            o[tidx] = 1 - o[tidx]
+            if (m < 0) and (s_sqrt2 > 0):
+                for tidx in range(len(times)):
+                    o[tidx] += 1
 
 
 @numba.njit
-def level_eval(ops, op_start, op_stop, state, st_start, st_stop, line_times):
+def level_eval(ops, op_start, op_stop, state, st_start, st_stop, line_times, slot_lines, slot_delays, hazards,
+               static_vals, op_stops, tmin, tmax):
     overflows = 0
+    skipped = 0
     for op_idx in range(op_start, op_stop):
         op = ops[op_idx]
+        z_stop = tmax
+        if op_stops is not None:
+            z_stop = op_stops[op_idx]
         for st_idx in range(st_start, st_stop):
-            overflows += wave_eval(op, state, st_idx, line_times)
-    return overflows
+            if static_eval(op, state, st_idx, static_vals, tmin, tmax):
+                skipped += 1
+            else:
+                overflows += wave_eval(op, state, st_idx, line_times, slot_lines, slot_delays, hazards, z_stop,
+                                       tmin, tmax)
+    return overflows, skipped
+
+
+@numba.njit
+def pool_eval(ops, rows, op_start, op_stop, level, state, pool_start, bumps, offs, row_releases, st_start, st_stop,
+              line_times, slot_lines, slot_delays, hazards, static_vals, op_stops, tmin, tmax):
+    # the ops of one level with pooled waveforms. Returns the overflows, the skipped evaluations and the first op
+    # not evaluated for lack of pool space (op_stop if all were).
+    overflows = 0
+    skipped = 0
+    op = np.empty(ops.shape[1], dtype=ops.dtype)
+    for op_idx in range(op_start, op_stop):
+        z_row, a_row, b_row, z_release = rows[op_idx]
+        z_cap = ops[op_idx, 7]
+        if z_row >= 0:
+            for st_idx in range(st_start, st_stop):
+                if bumps[st_idx] + z_cap > len(state):
+                    pool_compact(state, pool_start, bumps, offs, row_releases, level, st_idx, tmax)
+                    if bumps[st_idx] + z_cap > len(state):
+                        return overflows, skipped, op_idx
+        op[:] = ops[op_idx]
+        z_stop = tmax
+        if op_stops is not None:
+            z_stop = op_stops[op_idx]
+        for st_idx in range(st_start, st_stop):
+            if z_row >= 0:
+                op[1] = bumps[st_idx]
+            if a_row >= 0:
+                op[2] = offs[a_row, st_idx]
+            if b_row >= 0:
+                op[3] = offs[b_row, st_idx]
+            if static_eval(op, state, st_idx, static_vals, tmin, tmax):
+                skipped += 1
+            else:
+                overflows += wave_eval(op, state, st_idx, line_times, slot_lines, slot_delays, hazards, z_stop,
+                                       tmin, tmax)
+            if z_row >= 0:
+                offs[z_row, st_idx] = op[1]
+                bumps[st_idx] += _wave_len(state, op[1], st_idx, tmax)
+        if z_row >= 0:
+            row_releases[z_row] = z_release
+    return overflows, skipped, op_stop
+
+
+@numba.njit
+def pool_compact(state, pool_start, bumps, offs, row_releases, level, st_idx, tmax):
+    # moves the waveforms still read at or after level to the start of the pool of slot st_idx.
+    live = np.nonzero(row_releases >= level)[0]
+    mems = np.empty(len(live), dtype=offs.dtype)
+    for i in range(len(live)):
+        mems[i] = offs[live[i], st_idx]
+    bump = pool_start
+    for i in np.argsort(mems):
+        mem = mems[i]
+        length = _wave_len(state, mem, st_idx, tmax)
+        if mem != bump:
+            for tidx in range(length):
+                state[bump + tidx, st_idx] = state[mem + tidx, st_idx]
+            offs[live[i], st_idx] = bump
+        bump += length
+    bumps[st_idx] = bump
+
+
+@numba.njit
+def _wave_len(state, mem, st_idx, tmax):
+    # number of entries including TMAX.
+    length = 1
+    while state[mem + length - 1, st_idx] < tmax:
+        length += 1
+    return length
 
 
 @numba.njit
-def wave_eval(op, state, st_idx, line_times):
-    lut, z_mem, a_mem, b_mem, z_idx, a_idx, b_idx = op
+def saif_eval(state, lmap, st_start, st_stop, t_start, t_end, counts, tmin, tmax):
+    for lidx in range(len(lmap)):
+        mem = lmap[lidx]
+        if mem < 0: continue
+        t0 = 0.0
+        t1 = 0.0
+        tc = 0
+        for st_idx in range(st_start, st_stop):
+            val = 0
+            previous_t = t_start
+            for tidx in range(len(state) - mem):
+                t = state[mem + tidx, st_idx]
+                if t >= tmax or t >= t_end: break
+                if t >= t_start:
+                    if val:
+                        t1 += t - previous_t
+                    else:
+                        t0 += t - previous_t
+                    previous_t = t
+                    tc += 1
+                val ^= 1
+            if val:
+                t1 += t_end - previous_t
+            else:
+                t0 += t_end - previous_t
+        counts[lidx, 0] += t0
+        counts[lidx, 1] += t1
+        counts[lidx, 2] += tc
+
+
+@numba.njit
+def _delayed(t, delay, tmin, tmax):
+    # t + delay, sentinels stay and results saturate to them (integer encodings).
+    if t <= tmin or t >= tmax:
+        return t
+    t_d = t + delay
+    if t_d >= tmax:
+        return tmax
+    if t_d <= tmin:
+        return tmin
+    return t_d
+
+
+@numba.njit
+def static_eval(op, state, st_idx, static_vals, tmin, tmax):
+    # shortcut for constant outputs in this slot: writes the value unless z already holds it. Outputs are constant
+    # if static_vals says so or if no input has transitions. Returns False if wave_eval is needed.
+    lut, z_mem, a_mem, b_mem, z_idx = op[0], op[1], op[2], op[3], op[4]
+    z_val = -1
+    if static_vals is not None:
+        z_val = static_vals[z_idx, st_idx]
+    if z_val < 0:
+        inputs = 0
+        a = state[a_mem, st_idx]
+        if a <= tmin:
+            if state[a_mem + 1, st_idx] < tmax: return False
+            inputs = 1
+        elif a < tmax:
+            return False
+        b = state[b_mem, st_idx]
+        if b <= tmin:
+            if state[b_mem + 1, st_idx] < tmax: return False
+            inputs |= 2
+        elif b < tmax:
+            return False
+        z_val = (lut >> inputs) & 1
+    if z_val:
+        if state[z_mem, st_idx] > tmin or state[z_mem + 1, st_idx] < tmax:
+            state[z_mem, st_idx] = tmin
+            state[z_mem + 1, st_idx] = tmax
+    elif state[z_mem, st_idx] < tmax:
+        state[z_mem, st_idx] = tmax
+    return True
+
+
+@numba.njit
+def wave_eval(op, state, st_idx, line_times, slot_lines, slot_delays, hazards, z_stop, tmin, tmax):
+    lut, z_mem, a_mem, b_mem, z_idx, a_idx, b_idx, z_cap = op
     overflows = int(0)
-    
-    z_cap = int(state[z_mem, st_idx])
+    rejects = int(0)
+
+    # delays of both inputs for output transitions to 0 and 1, including this slot's delay override
+    a_d0 = line_times[a_idx, 0, 0]
+    a_d1 = line_times[a_idx, 0, 1]
+    b_d0 = line_times[b_idx, 0, 0]
+    b_d1 = line_times[b_idx, 0, 1]
+    sd_line = -1
+    if slot_lines is not None:
+        sd_line = slot_lines[st_idx]
+    if sd_line == a_idx:
+        a_d0 += slot_delays[st_idx, 0]
+        a_d1 += slot_delays[st_idx, 1]
+    if sd_line == b_idx:
+        b_d0 += slot_delays[st_idx, 0]
+        b_d1 += slot_delays[st_idx, 1]
 
     a_cur = int(0)
     b_cur = int(0)
     z_cur = lut & 1
     if z_cur == 1:
-        state[z_mem + 1, st_idx] = TMIN
+        state[z_mem, st_idx] = tmin
 
-    a = state[a_mem + 1, st_idx] + line_times[a_idx, 0, z_cur]
-    b = state[b_mem + 1, st_idx] + line_times[b_idx, 0, z_cur]
+    a = _delayed(state[a_mem, st_idx], a_d1 if z_cur else a_d0, tmin, tmax)
+    b = _delayed(state[b_mem, st_idx], b_d1 if z_cur else b_d0, tmin, tmax)
     
-    previous_t = TMIN
+    previous_t = tmin
 
     current_t = min(a, b)
     inputs = int(0)
 
-    while current_t < TMAX:
+    while current_t < tmax:
+        if current_t > z_stop: break  # beyond the horizon of z
         z_val = z_cur & 1
         if b < a:
             b_cur += 1
-            b = state[b_mem + 1 + b_cur, st_idx] 
-            b += line_times[b_idx, 0, z_val ^ 1]
+            b = _delayed(state[b_mem + b_cur, st_idx], b_d0 if z_val else b_d1, tmin, tmax)
             thresh = line_times[b_idx, 1, z_val]
             inputs ^= 2
             next_t = b
         else:
             a_cur += 1
-            a = state[a_mem + 1 + a_cur, st_idx] 
-            a += line_times[a_idx, 0, z_val ^ 1]
+            a = _delayed(state[a_mem + a_cur, st_idx], a_d0 if z_val else a_d1, tmin, tmax)
             thresh = line_times[a_idx, 1, z_val]
             inputs ^= 1
             next_t = a
@@ -308,24 +946,36 @@ def wave_eval(op, state, st_idx, line_times):
             #   ( it is the first toggle in z_mem -or-
             #   following toggle is earlier -or-
             #   pulse is wide enough ).
-            if z_cur >= (z_cap - 2):
+            if z_cur >= (z_cap - 1):
                 z_cur -= 1
                 overflows += 1
                 if z_cur > 0:
-                    previous_t = state[z_mem + 1 + z_cur - 1, st_idx]
+                    previous_t = state[z_mem + z_cur - 1, st_idx]
                 else:
-                    previous_t = TMIN
+                    previous_t = tmin
             elif z_cur == 0 or next_t < current_t or (current_t - previous_t) > thresh:
-                state[z_mem + 1 + z_cur, st_idx] = current_t
+                state[z_mem + z_cur, st_idx] = current_t
                 previous_t = current_t
                 z_cur += 1
             else:
                 z_cur -= 1
+                if current_t > tmin:  # not just settling initial values
+                    rejects += 1
                 if z_cur > 0:
-                    previous_t = state[z_mem + 1 + z_cur - 1, st_idx]
+                    previous_t = state[z_mem + z_cur - 1, st_idx]
                 else:
-                    previous_t = TMIN
+                    previous_t = tmin
         current_t = min(a, b)
 
-    state[z_mem + 1 + z_cur, st_idx] = TMAX
+    state[z_mem + z_cur, st_idx] = tmax
+
+    if hazards is not None:
+        toggles = z_cur
+        if z_cur > 0 and state[z_mem, st_idx] <= tmin:
+            toggles -= 1  # initial value 1
+        hazards[z_idx, 0] += toggles & 1
+        hazards[z_idx, 1] += toggles >> 1
+        hazards[z_idx, 2] += rejects
+        hazards[z_idx, 3] += overflows
+        hazards[z_idx, 4] = max(hazards[z_idx, 4], toggles)
     return overflows
@@ -8,27 +8,52 @@ TMIN = np.float32(-2 ** 127)  # almost np.NINF for 32-bit floating point values
 
 
 class WaveSimCuda(WaveSim):
-    def __init__(self, circuit, line_times, sdim=8, tdim=16):
-        super().__init__(circuit, line_times, sdim, tdim)
+    def __init__(self, circuit, line_times, sdim=8, tdim=16, library=None, hazards=False, encoding='float32',
+                 timescale=0.001, recycle=False):
+        super().__init__(circuit, line_times, sdim, tdim, library, hazards=hazards, encoding=encoding,
+                         timescale=timescale, recycle=recycle)
+        self._init_device()
 
-        self.tdata = np.zeros((len(self.interface), 3, (sdim - 1) // 8 + 1), dtype='uint8')
-        self.cdata = np.zeros((len(self.interface), sdim), dtype='float32')
+    def _init_device(self):
+        self.tdata = np.zeros((len(self.interface), 3, (self.sdim - 1) // 8 + 1), dtype='uint8')
+        self.cdata = np.zeros((len(self.interface), self.sdim), dtype='float32')
 
         self.d_state = cuda.to_device(self.state)
         self.d_ops = cuda.to_device(self.ops)
-        self.d_line_times = cuda.to_device(self.line_times)
+        self.d_line_times = cuda.to_device(self._line_times)
         self.d_tdata = cuda.to_device(self.tdata)
         self.d_tmap = cuda.to_device(self.tmap)
         self.d_cdata = cuda.to_device(self.cdata)
         self.d_cmap = cuda.to_device(self.cmap)
+        self.d_slot_lines = cuda.to_device(self.slot_lines)
+        self.d_slot_delays = cuda.to_device(self._slot_delays)
+        self.d_hazards = cuda.to_device(self.hazards if self.hazards is not None else np.zeros((0, 5), dtype='int64'))
+        self.d_static_vals = cuda.to_device(self.static_vals)
+        self.d_op_stops = cuda.to_device(np.zeros(0, dtype=self.encoding))
 
         self._block_dim = (32, 16)
 
     def get_line_delay(self, line, polarity):
-        return self.d_line_times[line, 0, polarity]
+        return self.line_times[line, 0, polarity]
 
     def set_line_delay(self, line, polarity, delay):
-        self.d_line_times[line, 0, polarity] = delay
+        super().set_line_delay(line, polarity, delay)
+        self.d_line_times[line, 0, polarity] = self._line_times[line, 0, polarity]
+
+    def _upload_line_times(self):
+        super()._upload_line_times()
+        cuda.to_device(self._line_times, to=self.d_line_times)
+
+    def _upload_static(self):
+        cuda.to_device(self.static_vals, to=self.d_static_vals)
+
+    def _upload_slot_delays(self):
+        cuda.to_device(self.slot_lines, to=self.d_slot_lines)
+        cuda.to_device(self._slot_delays, to=self.d_slot_delays)
+
+    def reset_hazards(self):
+        self.hazards[...] = 0
+        cuda.to_device(self.hazards, to=self.d_hazards)
 
     def assign(self, vectors, time=0.0, offset=0):
         assert (offset % 8) == 0
@@ -42,64 +67,178 @@ class WaveSimCuda(WaveSim):
             self.tdata[:, 2, 0:pdim] = 0
         cuda.to_device(self.tdata, to=self.d_tdata)
 
+        times = np.ascontiguousarray(self._enc_launch(time))
         grid_dim = self._grid_dim(self.sdim, len(self.d_tmap))
-        assign_kernel[grid_dim, self._block_dim](self.d_state, self.d_tmap, self.d_tdata, time)
+        assign_kernel[grid_dim, self._block_dim](self.d_state, self.d_tmap, self.d_tdata, cuda.to_device(times),
+                                                 self.tmin, self.tmax)
 
     def _grid_dim(self, x, y):
         gx = math.ceil(x / self._block_dim[0])
         gy = math.ceil(y / self._block_dim[1])
         return gx, gy
 
-    def propagate(self, sdim=None):
+    def propagate(self, sdim=None, level=0, horizon=None):
         if sdim is None:
             sdim = self.sdim
         else:
             sdim = min(sdim, self.sdim)
-        for op_start, op_stop in zip(self.level_starts, self.level_stops):
+        assert level == 0 or not self.recycle, 'waveforms of earlier levels are not kept'
+        d_op_stops = self.d_op_stops if horizon is None else cuda.to_device(self._op_stops(horizon))
+        for op_start, op_stop in zip(self.level_starts[level:], self.level_stops[level:]):
             grid_dim = self._grid_dim(sdim, op_stop - op_start)
             wave_kernel[grid_dim, self._block_dim](self.d_ops, op_start, op_stop, self.d_state, int(0),
-                                                   sdim, self.d_line_times)
+                                                   sdim, self.d_line_times, self.d_slot_lines, self.d_slot_delays,
+                                                   self.d_hazards, self.d_static_vals, self._static, d_op_stops,
+                                                   self.tmin, self.tmax)
         cuda.synchronize()
+        if self.hazards is not None:
+            self.d_hazards.copy_to_host(self.hazards)
 
     def _wave(self, mem, vector):
         if mem < 0:
             return None
-        wcap = int(self.d_state[mem, vector])
-        return self.d_state[mem + 1:mem + wcap, vector]
+        w = self.d_state[mem:mem + self._max_cap, vector].copy_to_host()
+        return self._decode(w[:np.argmax(w >= self.tmax) + 1])
 
     def capture(self, captures, times, offset=0, sigma=0):
         assert offset < captures.shape[1]
         for tidx, time in enumerate(times):
             grid_dim = self._grid_dim(self.sdim, len(self.interface))
-            capture_kernel[grid_dim, self._block_dim](self.d_state, self.d_cmap,
-                                                      self.d_cdata, time, sigma * math.sqrt(2))
+            capture_kernel[grid_dim, self._block_dim](self.d_state, self.d_cmap, self.d_cdata,
+                                                      float(time) / self.timescale,
+                                                      sigma * math.sqrt(2) / self.timescale, self.tmin, self.tmax)
             cap_dim = min(captures.shape[1] - offset, self.sdim)
             captures[:, offset:cap_dim + offset, tidx] = self.d_cdata[:, 0:cap_dim]
         cuda.synchronize()
 
+    def _stats_raw(self, mems, st_start, st_stop):
+        d_mems = cuda.to_device(mems)
+        d_out = cuda.device_array((len(d_mems), st_stop - st_start, 3), dtype='float64')
+        grid_dim = self._grid_dim(st_stop - st_start, len(d_mems))
+        stats_kernel[grid_dim, self._block_dim](self.d_state, d_mems, st_start, st_stop, d_out, self.tmin, self.tmax)
+        return d_out.copy_to_host()
+
+    def _values_raw(self, mems, st_start, st_stop, times, s_sqrt2):
+        d_mems = cuda.to_device(mems)
+        d_times = cuda.to_device(times)
+        d_out = cuda.device_array((len(d_mems), st_stop - st_start, len(d_times)), dtype='float64')
+        grid_dim = self._grid_dim(st_stop - st_start, len(d_mems))
+        values_kernel[grid_dim, self._block_dim](self.d_state, d_mems, st_start, st_stop, d_times, s_sqrt2, d_out,
+                                                 self.tmin, self.tmax)
+        return d_out.copy_to_host()
+
+    def _saif_raw(self, counts, t_start, t_end, sdim):
+        if not hasattr(self, 'd_lmap'):
+            self.d_lmap = cuda.to_device(self.lmap)
+        d_counts = cuda.to_device(counts)
+        blocks = math.ceil(len(self.lmap) / 256)
+        saif_kernel[blocks, 256](self.d_state, self.d_lmap, int(0), sdim, t_start, t_end, d_counts, self.tmin,
+                                 self.tmax)
+        d_counts.copy_to_host(counts)
+
 
 @cuda.jit
-def capture_kernel(state, cmap, cdata, time, s_sqrt2):
+def stats_kernel(state, mems, st_start, st_stop, out, tmin, tmax):
+    x, y = cuda.grid(2)
+    st_idx = st_start + x
+    if y >= len(mems) or st_idx >= st_stop: return
+    mem = mems[y]
+    if mem < 0: return
+    eat = tmax
+    lst = tmin
+    tog = 0
+    for tidx in range(state.shape[0] - mem):
+        t = state[mem + tidx, st_idx]
+        if t >= tmax: break
+        if t <= tmin: continue
+        eat = min(eat, t)
+        lst = max(lst, t)
+        tog += 1
+    out[y, x, 0] = eat
+    out[y, x, 1] = lst
+    out[y, x, 2] = tog
+
+
+@cuda.jit
+def values_kernel(state, mems, st_start, st_stop, times, s_sqrt2, out, tmin, tmax):
+    x, y = cuda.grid(2)
+    st_idx = st_start + x
+    if y >= len(mems) or st_idx >= st_stop: return
+    mem = mems[y]
+    if mem < 0: return
+    for tidx in range(len(times)):
+        out[y, x, tidx] = 0
+    m = 0.5
+    for widx in range(state.shape[0] - mem):
+        t = state[mem + widx, st_idx]
+        if t >= tmax: break
+        m = -m
+        if s_sqrt2 > 0:
+            if t <= tmin: continue
+            for tidx in range(len(times)):
+                out[y, x, tidx] += m * (1 + math.erf((t - times[tidx]) / s_sqrt2))
+        else:
+            for tidx in range(len(times)):
+                if t < times[tidx]:
+                    out[y, x, tidx] = 1 - out[y, x, tidx]
+    if (m < 0) and (s_sqrt2 > 0):
+        for tidx in range(len(times)):
+            out[y, x, tidx] += 1
+
+
+@cuda.jit
+def saif_kernel(state, lmap, st_start, st_stop, t_start, t_end, counts, tmin, tmax):
+    lidx = cuda.grid(1)
+    if lidx >= len(lmap): return
+    mem = lmap[lidx]
+    if mem < 0: return
+    t0 = 0.0
+    t1 = 0.0
+    tc = 0
+    for st_idx in range(st_start, st_stop):
+        val = 0
+        previous_t = t_start
+        for tidx in range(state.shape[0] - mem):
+            t = state[mem + tidx, st_idx]
+            if t >= tmax or t >= t_end: break
+            if t >= t_start:
+                if val:
+                    t1 += t - previous_t
+                else:
+                    t0 += t - previous_t
+                previous_t = t
+                tc += 1
+            val ^= 1
+        if val:
+            t1 += t_end - previous_t
+        else:
+            t0 += t_end - previous_t
+    counts[lidx, 0] += t0
+    counts[lidx, 1] += t1
+    counts[lidx, 2] += tc
+
+
+@cuda.jit
+def capture_kernel(state, cmap, cdata, time, s_sqrt2, tmin, tmax):
     x, y = cuda.grid(2)
     if y >= len(cmap): return
     line = cmap[y]
     if line < 0: return
     if x >= state.shape[-1]: return
     vector = x
-    tdim = int(state[line, vector])
     m = 0.5
     acc = 0.0
-    eat = TMAX
-    lst = TMIN
+    eat = tmax
+    lst = tmin
     tog = 0
     val = int(0)
-    for tidx in range(tdim - 1):
-        t = state[line + 1 + tidx, vector]
-        if t >= TMAX: break
+    for tidx in range(state.shape[0] - line):
+        t = state[line + tidx, vector]
+        if t >= tmax: break
         m = -m
         if t < time:
             val ^= 1
-        if t <= TMIN: continue
+        if t <= tmin: continue
         if s_sqrt2 > 0:
             acc += m * (1 + math.erf((t - time) / s_sqrt2))
         eat = min(eat, t)
@@ -114,7 +253,7 @@ def capture_kernel(state, cmap, cdata, time, s_sqrt2):
 
 
 @cuda.jit
-def assign_kernel(state, tmap, tdata, time):
+def assign_kernel(state, tmap, tdata, times, tmin, tmax):
     x, y = cuda.grid(2)
     if y >= len(tmap): return
     line = tmap[y]
@@ -128,16 +267,59 @@ def assign_kernel(state, tmap, tdata, time):
     m = np.uint8(1 << (7 - (vector % 8)))
     toggle = 0
     if a0 & m:
-        state[line + 1 + toggle, x] = TMIN
+        state[line + toggle, x] = tmin
         toggle += 1
     if (a2 & m) and ((a0 & m) == (a1 & m)):
-        state[line + 1 + toggle, x] = time
+        state[line + toggle, x] = times[y]
         toggle += 1
-    state[line + 1 + toggle, x] = TMAX
+    state[line + toggle, x] = tmax
+
+
+@cuda.jit(device=True)
+def _delayed(t, delay, tmin, tmax):
+    if t <= tmin or t >= tmax:
+        return t
+    t_d = t + delay
+    if t_d >= tmax:
+        return tmax
+    if t_d <= tmin:
+        return tmin
+    return t_d
+
+
+@cuda.jit(device=True)
+def _static_eval(lut, z_mem, a_mem, b_mem, z_idx, state, st_idx, static_vals, static, tmin, tmax):
+    # see wave_sim.static_eval, warps with constant outputs in all their slots are done here.
+    z_val = -1
+    if static:
+        z_val = static_vals[z_idx, st_idx]
+    if z_val < 0:
+        inputs = 0
+        a = state[a_mem, st_idx]
+        if a <= tmin:
+            if state[a_mem + 1, st_idx] < tmax: return False
+            inputs = 1
+        elif a < tmax:
+            return False
+        b = state[b_mem, st_idx]
+        if b <= tmin:
+            if state[b_mem + 1, st_idx] < tmax: return False
+            inputs |= 2
+        elif b < tmax:
+            return False
+        z_val = (lut >> inputs) & 1
+    if z_val:
+        if state[z_mem, st_idx] > tmin or state[z_mem + 1, st_idx] < tmax:
+            state[z_mem, st_idx] = tmin
+            state[z_mem + 1, st_idx] = tmax
+    elif state[z_mem, st_idx] < tmax:
+        state[z_mem, st_idx] = tmax
+    return True
 
 
 @cuda.jit
-def wave_kernel(ops, op_start, op_stop, state, st_start, st_stop, line_times):
+def wave_kernel(ops, op_start, op_stop, state, st_start, st_stop, line_times, slot_lines, slot_delays, hazards,
+                static_vals, static, op_stops, tmin, tmax):
     x, y = cuda.grid(2)
     st_idx = st_start + x
     op_idx = op_start + y
@@ -150,36 +332,51 @@ def wave_kernel(ops, op_start, op_stop, state, st_start, st_stop, line_times):
     z_idx = ops[op_idx, 4]
     a_idx = ops[op_idx, 5]
     b_idx = ops[op_idx, 6]
+    z_cap = ops[op_idx, 7]
+    if _static_eval(lut, z_mem, a_mem, b_mem, z_idx, state, st_idx, static_vals, static, tmin, tmax): return
+    z_stop = op_stops[op_idx] if len(op_stops) > 0 else tmax
 
-    z_cap = int(state[z_mem, st_idx])
+    overflows = int(0)
+    rejects = int(0)
+
+    a_d0 = line_times[a_idx, 0, 0]
+    a_d1 = line_times[a_idx, 0, 1]
+    b_d0 = line_times[b_idx, 0, 0]
+    b_d1 = line_times[b_idx, 0, 1]
+    sd_line = slot_lines[st_idx]
+    if sd_line == a_idx:
+        a_d0 += slot_delays[st_idx, 0]
+        a_d1 += slot_delays[st_idx, 1]
+    if sd_line == b_idx:
+        b_d0 += slot_delays[st_idx, 0]
+        b_d1 += slot_delays[st_idx, 1]
 
     a_cur = int(0)
     b_cur = int(0)
     z_cur = lut & 1
     if z_cur == 1:
-        state[z_mem + 1, st_idx] = TMIN
+        state[z_mem, st_idx] = tmin
 
-    a = state[a_mem + 1, st_idx] + line_times[a_idx, 0, z_cur]
-    b = state[b_mem + 1, st_idx] + line_times[b_idx, 0, z_cur]
+    a = _delayed(state[a_mem, st_idx], a_d1 if z_cur else a_d0, tmin, tmax)
+    b = _delayed(state[b_mem, st_idx], b_d1 if z_cur else b_d0, tmin, tmax)
 
-    previous_t = TMIN
+    previous_t = tmin
 
     current_t = min(a, b)
     inputs = int(0)
 
-    while current_t < TMAX:
+    while current_t < tmax:
+        if current_t > z_stop: break
         z_val = z_cur & 1
         if b < a:
             b_cur += 1
-            b = state[b_mem + 1 + b_cur, st_idx]
-            b += line_times[b_idx, 0, z_val ^ 1]
+            b = _delayed(state[b_mem + b_cur, st_idx], b_d0 if z_val else b_d1, tmin, tmax)
             thresh = line_times[b_idx, 1, z_val]
             inputs ^= 2
             next_t = b
         else:
             a_cur += 1
-            a = state[a_mem + 1 + a_cur, st_idx]
-            a += line_times[a_idx, 0, z_val ^ 1]
+            a = _delayed(state[a_mem + a_cur, st_idx], a_d0 if z_val else a_d1, tmin, tmax)
             thresh = line_times[a_idx, 1, z_val]
             inputs ^= 1
             next_t = a
@@ -191,23 +388,35 @@ def wave_kernel(ops, op_start, op_stop, state, st_start, st_stop, line_times):
             #   ( it is the first toggle in z_mem -or-
             #   following toggle is earlier -or-
             #   pulse is wide enough ).
-            if z_cur >= (z_cap - 2):
+            if z_cur >= (z_cap - 1):
                 z_cur -= 1
-                # overflows += 1
+                overflows += 1
                 if z_cur > 0:
-                    previous_t = state[z_mem + 1 + z_cur - 1, st_idx]
+                    previous_t = state[z_mem + z_cur - 1, st_idx]
                 else:
-                    previous_t = TMIN
+                    previous_t = tmin
             elif z_cur == 0 or next_t < current_t or (current_t - previous_t) > thresh:
-                state[z_mem + 1 + z_cur, st_idx] = current_t
+                state[z_mem + z_cur, st_idx] = current_t
                 previous_t = current_t
                 z_cur += 1
             else:
                 z_cur -= 1
+                if current_t > tmin:
+                    rejects += 1
                 if z_cur > 0:
-                    previous_t = state[z_mem + 1 + z_cur - 1, st_idx]
+                    previous_t = state[z_mem + z_cur - 1, st_idx]
                 else:
-                    previous_t = TMIN
+                    previous_t = tmin
         current_t = min(a, b)
 
-    state[z_mem + 1 + z_cur, st_idx] = TMAX
+    state[z_mem + z_cur, st_idx] = tmax
+
+    if len(hazards) > 0:
+        toggles = z_cur
+        if z_cur > 0 and state[z_mem, st_idx] <= tmin:
+            toggles -= 1
+        cuda.atomic.add(hazards, (z_idx, 0), toggles & 1)
+        cuda.atomic.add(hazards, (z_idx, 1), toggles >> 1)
+        cuda.atomic.add(hazards, (z_idx, 2), rejects)
+        cuda.atomic.add(hazards, (z_idx, 3), overflows)
+        cuda.atomic.max(hazards, (z_idx, 4), toggles)
@@ -0,0 +1,26 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+# the ICCAD directory is the kyupy package, import it under that name.
+package_dir = Path(__file__).resolve().parent.parent / 'ICCAD'
+if 'kyupy' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('kyupy', package_dir / '__init__.py',
+                                                  submodule_search_locations=[str(package_dir)])
+    sys.modules['kyupy'] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules['kyupy'])
+
+
+@pytest.fixture
+def mydir():
+    return package_dir
+
+
+@pytest.fixture(scope='session')
+def b14():
+    from kyupy import verilog, sdf
+    from kyupy.saed import pin_index
+    c = verilog.parse(package_dir / 'b14.layout.v')
+    return c, sdf.parse(package_dir / 'b14.layout.sdf').line_times(c, pin_index)
@@ -0,0 +1,45 @@
+import numpy as np
+
+from kyupy import bittools
+
+
+def naive_counts(bits, nbits):
+    counts = np.zeros(nbits, dtype='int64')
+    for row in bits.reshape(-1, bits.shape[-1]):
+        for i in range(nbits):
+            counts[i] += (row[i >> 3] >> (7 - (i & 7))) & 1
+    return counts
+
+
+def test_popcount():
+    rng = np.random.default_rng(1)
+    for shape in [(13,), (5, 16), (3, 4, 7), (2, 3, 24)]:
+        a = rng.integers(0, 256, shape, dtype='uint8')
+        ref = sum(bin(x).count('1') for x in a.flat)
+        assert bittools.popcount(a) == ref
+        assert bittools.popcount(a[..., 1:]) == sum(bin(x).count('1') for x in a[..., 1:].flat)
+        for axis in range(a.ndim):
+            ref = np.vectorize(lambda x: bin(x).count('1'))(a).sum(axis=axis)
+            assert np.array_equal(bittools.popcount_batch(a, axis=axis), ref)
+
+
+def test_count_into():
+    rng = np.random.default_rng(2)
+    for shape, nbits in [((20, 5), 37), ((3, 6, 2), 16), ((2, 3), 30)]:
+        bits = rng.integers(0, 256, shape, dtype='uint8')
+        ref = naive_counts(bits, min(nbits, shape[-1] * 8))
+        counts = np.zeros(nbits, dtype='int64')
+        bittools.count_into(bits, counts, rows=7)
+        assert np.array_equal(counts[:len(ref)], ref)
+        assert not counts[len(ref):].any()
+        if len(shape) == 3:
+            batch = bittools.count_batch(bits, axis=1, nbits=min(nbits, shape[-1] * 8))
+            for i in range(shape[0]):
+                assert np.array_equal(batch[i], naive_counts(bits[i], batch.shape[-1]))
+
+
+def test_popcount_masked():
+    rng = np.random.default_rng(3)
+    a, mask = rng.integers(0, 256, (2, 37), dtype='uint8')
+    assert bittools.popcount_masked(a, mask) == bittools.popcount(a & mask)
+    assert bittools.popcount_masked(a[:0], mask[:0]) == 0
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from kyupy import celllib, saed, verilog
+from kyupy.logic_sim import LogicSim
+from kyupy.packed_vectors import PackedVectors
+from kyupy.wave_sim import WaveSim, TMAX
+
+complex_cells = """
+module top (a, b, c, d, e, o0, o1, o2, o3);
+input a, b, c, d, e;
+output o0, o1, o2, o3;
+wire w;
+AO21X1 g0 (.IN1(a), .IN2(b), .IN3(c), .Q(w));
+NOR3X0 g1 (.IN1(w), .IN2(d), .IN3(e), .QN(o0));
+MUX21X1 g2 (.IN1(a), .IN2(d), .S(e), .Q(o1));
+FADDX1 g3 (.A(b), .B(c), .CI(w), .CO(o2), .S(o3));
+endmodule
+"""
+
+
+def exhaustive(c):
+    tests = PackedVectors(32, len(c.interface), 1)
+    for p in range(32):
+        tests.set_values(p, ''.join(str((p >> j) & 1) for j in range(5)) + '0000')
+    return tests
+
+
+def reference(p):
+    a, b, c, d, e = ((p >> j) & 1 for j in range(5))
+    w = (a & b) | c
+    return ~(w | d | e) & 1, d if e else a, (b & c) | (b & w) | (c & w), b ^ c ^ w
+
+
+def test_pin_index():
+    assert [saed.pin_index('DFFX1', p) for p in ('D', 'CLK', 'Q', 'QN')] == [0, 1, 0, 1]
+    assert [saed.pin_index('SDFFASRX1', p) for p in ('D', 'SE', 'SI', 'CLK', 'RSTB', 'SETB')] == [0, 1, 2, 3, 4, 5]
+    assert saed.pin_index('DFFARX1', 'RSTB') == 4
+    assert saed.pin_index('DFFASX2', 'SETB') == 5
+    assert [saed.pin_index('DFFASRX1', p) for p in ('RSTB', 'SETB')] == [4, 5]
+    assert [saed.pin_index('SDFFASX1', p) for p in ('CLK', 'SETB')] == [3, 5]
+    assert [saed.pin_index('AOI222X1', f'IN{i}') for i in range(1, 7)] == list(range(6))
+
+
+def test_truth_tables():
+    lib = saed.library
+    assert lib.primitive('NAND3X0') == 'nand'
+    assert lib.primitive('AO21X1') is None
+    assert lib.cell('AO21X1').tables[0] == sum((((p & 1) & (p >> 1)) | (p >> 2)) << p for p in range(8))
+    assert lib.truth_table('NOR2X0', 2) == 0b0001
+    assert lib.truth_table('NAND', 3) == 0b01111111
+    assert lib.truth_table('__const1__', 0) == 1
+    assert lib.truth_table('HADDX1', 2) is None
+    tt = celllib.Library(celllib.parse_tt('MAJ A B C : Z=0xe8'))
+    assert tt.primitive('MAJ') is None
+    assert tt.pin_index('MAJ', 'C') == 2
+    assert len(tt.cell('MAJ').decomposition) > 0
+
+
+def test_load_in_memory(tmp_path):
+    src = tmp_path / 'cells.vlib'
+    src.write_text('module XOR2 (A, B, Y); input A, B; output Y; xor (Y, A, B); endmodule\n')
+    lib = celllib.load(src)
+    assert celllib.load(src) is lib
+    assert lib.truth_table('XOR2X1', 2) == 0b0110
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['cells.vlib']
+
+
+def test_cells_and_split():
+    c = verilog.parse(complex_cells)
+    tests = exhaustive(c)
+    expect = np.array([reference(p) for p in range(32)]).T
+    sim = LogicSim(c, 32)
+    sim.assign(tests)
+    sim.propagate()
+    resp = tests.copy()
+    sim.capture(resp)
+    for i in range(4):
+        assert resp.get_values_for_position(5 + i) == ''.join(map(str, expect[i]))
+
+    with pytest.raises(ValueError):
+        WaveSim(c, np.zeros((len(c.lines), 2, 2)), sdim=32)
+    saed.split_complex_gates(c)
+    assert all(len(n.i) <= 2 for n in c.nodes)
+    ws = WaveSim(c, np.full((len(c.lines), 2, 2), 0.1), sdim=32)
+    ws.assign(tests)
+    ws.propagate()
+    cap = np.zeros((len(ws.interface), 32, 1))
+    ws.capture(cap, [TMAX])
+    assert np.array_equal(cap[5:, :, 0], expect)
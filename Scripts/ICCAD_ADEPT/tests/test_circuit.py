@@ -0,0 +1,14 @@
+from kyupy import bench
+
+
+def test_fanin(mydir):
+    c = bench.parse(mydir / 'b01.bench')
+    origin = [n for n in c.nodes if n.name == 'U34' and n.kind == 'AND']
+    reverse = list(c.reversed_topological_order())
+    fanin = list(c.fanin(origin))
+    assert fanin == [n for n in reverse if n in set(fanin)]  # reverse-topological order
+    comb = list(c.comb_fanin(origin))
+    assert comb[0] == origin[0]
+    assert sorted(n.name for n in comb if 'DFF' in n.kind) == ['STATO_REG_0_', 'STATO_REG_1_', 'STATO_REG_2_']
+    # the search stops at these flip-flops, their D inputs are not in the cone
+    assert not any(n.name in ('U35', 'U36', 'U45') for n in comb)
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+from kyupy import bench, saed, verilog
+from kyupy.fault_sim import FaultSim, SmallDelayFaultSim
+from kyupy.logic_sim import LogicSim
+from kyupy.packed_vectors import PackedVectors
+from kyupy.wave_sim import WaveSim
+
+from test_wave_sim import captures, random_tests, simulate
+
+
+def brute_force(circuit, bits, line, force):
+    # responses of a LogicSim with line forced to force(good value of line) for vdim=1 stimuli bits.
+    sim = LogicSim(circuit, bits.shape[-1] * 8)
+    driver, pin = circuit.lines[line].driver, circuit.lines[line].driver_pin
+    fct = sim.node_fct[driver.index]
+
+    def faulty(inputs, outputs):
+        fct(inputs, outputs)
+        outputs[pin][0] = force(outputs[pin][0])
+    sim.node_fct[driver.index] = faulty
+    sim.assign(bits)
+    sim.state[line, 0] = force(sim.state[line, 0])
+    sim.propagate()
+    responses = np.zeros_like(bits)
+    sim.capture(responses)
+    return responses[sim.capture_pos, 0], sim.state[:, 0].copy()
+
+
+def detections(good, faulty, nvectors):
+    return int(np.unpackbits(np.bitwise_or.reduce(good ^ faulty, axis=0))[:nvectors].sum())
+
+
+def test_b01_stuck_at(mydir):
+    c = bench.parse(mydir / 'b01.bench')
+    np.random.seed(5)
+    fs = FaultSim(c, 64)
+    tests = PackedVectors(64, len(fs.sim.interface), 1)
+    tests.randomize()
+    detects, coverage = fs.stuck_at(tests)
+    bits = tests.value_bits[:, None]
+    good, _ = brute_force(c, bits, 0, lambda v: v)
+    for (line, value), count in zip(fs.stuck_at_faults(), detects):
+        faulty, _ = brute_force(c, bits, line, lambda v: np.full_like(v, 255 if value else 0))
+        assert count == detections(good, faulty, 64), (line, value)
+    assert coverage[-1] == np.count_nonzero(detects) / len(detects)
+
+
+def test_b01_transition(mydir):
+    c = bench.parse(mydir / 'b01.bench')
+    np.random.seed(7)
+    fs = FaultSim(c, 64)
+    tests = PackedVectors(64, len(fs.sim.interface), 3)
+    tests.randomize()
+    detects, _ = fs.transition(tests)
+    initial = tests.initial_bits[:, None]
+    final = tests.value_bits[:, None]
+    _, init_state = brute_force(c, initial, 0, lambda v: v)
+    good, _ = brute_force(c, final, 0, lambda v: v)
+    for (line, value), count in zip(fs.transition_faults(), detects):
+        init = init_state[line]
+        # slow-to-rise lines stay 0 unless they were 1 before, slow-to-fall lines stay 1 unless they were 0.
+        faulty, _ = brute_force(c, final, line, lambda v: v & init if value else v | init)
+        assert count == detections(good, faulty, 64), (line, value)
+    assert 0 < np.count_nonzero(detects) < len(detects)
+
+
+def test_dont_care_patterns(mydir):
+    c = bench.parse(mydir / 'b01.bench')
+    np.random.seed(9)
+    fs = FaultSim(c, 64)
+    tests = PackedVectors(64, len(fs.sim.interface), 3)
+    tests.randomize()
+    tests.bits[..., 4:] = 0  # patterns 32 to 63 are all don't-care
+    for grade in (fs.stuck_at, fs.transition):
+        assert np.array_equal(grade(tests)[0], grade(tests[:32])[0])
+
+
+complex_cells = """
+module top (a, b, c, d, o0, o1);
+input a, b, c, d;
+output o0, o1;
+AOI21X1 g0 (.IN1(a), .IN2(b), .IN3(c), .QN(o0));
+NAND3X0 g1 (.IN1(b), .IN2(c), .IN3(d), .QN(o1));
+endmodule
+"""
+
+
+def test_complex_cells():
+    c = verilog.parse(complex_cells)
+    with pytest.raises(ValueError, match='split'):
+        FaultSim(c, 16)
+    saed.split_complex_gates(c)
+    fs = FaultSim(c, 16)
+    tests = PackedVectors(16, len(fs.sim.interface), 1)
+    for p in range(16):
+        tests.set_values(p, format(p, '04b') + '--')
+    good, _ = brute_force(c, tests.bits, 0, lambda v: v)
+    detects, _ = fs.stuck_at(tests)
+    for (line, value), count in zip(fs.stuck_at_faults(), detects):
+        faulty, _ = brute_force(c, tests.bits, line, lambda v: np.full_like(v, 255 * value))
+        assert count == detections(good, faulty, 16), (line, value)
+
+
+def test_small_delay(b14):
+    c, lt = b14
+    tests = random_tests(c, 24, 13)
+    clock = 4.0
+    rng = np.random.default_rng(14)
+    lines = rng.choice(len(c.lines), 60, replace=False)
+    faults = [(int(line), int(rng.integers(2)), float(rng.uniform(0.5, 2.0))) for line in lines]
+    detected = SmallDelayFaultSim(c, lt, sdim=16).run(tests, faults, clock)
+
+    # reference: one full simulation of all patterns with the delay added to line_times for each fault
+    ws = WaveSim(c, lt, sdim=24)
+    good = simulate(ws, tests, [clock])
+    expect = []
+    for line, polarity, delay in faults:
+        ws.update_delays(updates=[(line, polarity, lt[line, 0, polarity] + delay)])
+        diff = (captures(ws, 24, [clock]) != good).any(axis=(0, 2))
+        expect.append(int(np.argmax(diff)) if diff.any() else -1)
+        ws.update_delays(updates=[(line, polarity, lt[line, 0, polarity])])
+    assert list(detected) == expect
+    assert 0 < np.count_nonzero(detected >= 0) < len(faults)
+
+
+def test_line_levels():
+    # line 0 (z) is only captured, interface ops do not read it.
+    c = bench.parse('INPUT(a)\nINPUT(b)\nOUTPUT(z)\nOUTPUT(y)\nz = AND(a, b)\ny = NOT(b)\n')
+    fs = SmallDelayFaultSim(c, np.full((len(c.lines), 2, 2), 0.1), sdim=2)
+    levels = len(fs.sim.level_starts)
+    assert fs.line_level[0] == levels and fs.line_slack[0] == 0
+    assert all(fs.line_level[line] < levels and fs.line_slack[line] == 0.1 for line in (1, 2, 4))
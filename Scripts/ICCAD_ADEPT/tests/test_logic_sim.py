@@ -0,0 +1,173 @@
+import itertools
+
+import numpy as np
+
+from kyupy import bench, verilog
+from kyupy.logic_sim import LogicSim
+from kyupy.packed_vectors import PackedVectors
+from kyupy.wave_sim import WaveSim, TMAX
+
+cells = """
+module top (a, b, c, d, e, o0, o1, o2, o3, o4);
+input a, b, c, d, e;
+output o0, o1, o2, o3, o4;
+AOI21X1 g0 (.IN1(a), .IN2(b), .IN3(c), .QN(o0));
+MUX21X1 g1 (.IN1(a), .IN2(d), .S(e), .Q(o1));
+FADDX1 g2 (.A(b), .B(c), .CI(d), .CO(o2), .S(o3));
+OA22X1 g3 (.IN1(a), .IN2(b), .IN3(d), .IN4(e), .Q(o4));
+endmodule
+"""
+
+functions = [
+    lambda a, b, c, d, e: 1 - ((a & b) | c),
+    lambda a, b, c, d, e: d if e else a,
+    lambda a, b, c, d, e: (b & c) | (b & d) | (c & d),
+    lambda a, b, c, d, e: b ^ c ^ d,
+    lambda a, b, c, d, e: (a | b) & (d | e),
+]
+
+# initial value, final value, toggles for each 8-valued symbol, None is unknown.
+symbols3 = {'0': (0, 0, False), '1': (1, 1, False), '-': (None, None, False), 'X': (None, None, False),
+            'R': (0, 1, True), 'F': (1, 0, True), 'P': (0, 0, True), 'N': (1, 1, True)}
+
+
+def ternary(f, values):
+    results = {f(*v) for v in itertools.product(*[(0, 1) if v is None else (v,) for v in values])}
+    return results.pop() if len(results) == 1 else None
+
+
+def ref3(f, syms):
+    initial = ternary(f, [symbols3[s][0] for s in syms])
+    final = ternary(f, [symbols3[s][1] for s in syms])
+    if initial is None or final is None:
+        return 'X'
+    stable = ternary(f, [None if symbols3[s][2] else symbols3[s][0] for s in syms])
+    return [k for k, v in symbols3.items() if v == (initial, final, stable is None)][0]
+
+
+def check_cells(vdim, alphabet, reference):
+    c = verilog.parse(cells)
+    patterns = list(itertools.product(alphabet, repeat=5))
+    tests = PackedVectors(len(patterns), len(c.interface), vdim)
+    for i, p in enumerate(patterns):
+        tests.set_values(i, ''.join(p) + '-----')
+    sim = LogicSim(c, len(patterns), vdim)
+    sim.assign(tests)
+    sim.propagate()
+    sim.capture(tests)
+    for i, p in enumerate(patterns):
+        assert tests[i][5:] == ''.join(reference(f, p) for f in functions), p
+
+
+def test_cells_vd2():
+    def reference(f, p):
+        v = ternary(f, [None if s == 'X' else int(s) for s in p])
+        return 'X' if v is None else str(v)
+    check_cells(2, '01X', reference)
+
+
+def test_cells_vd3():
+    check_cells(3, '01XRFPN', ref3)
+
+
+def test_b14_against_wave_sim(b14):
+    c, lt = b14
+    sim = LogicSim(c, 64)
+    ws = WaveSim(c, lt, sdim=64)
+    width = len(sim.interface)
+    np.random.seed(3)
+    for _ in range(2):
+        tests = PackedVectors(64, width, 1)
+        tests.randomize()
+        resp = tests.copy()
+        sim.assign(tests)
+        sim.propagate()
+        sim.capture(resp)
+        ws.assign(tests)
+        ws.propagate()
+        cap = np.zeros((width, 64, 1))
+        ws.capture(cap, [TMAX])
+        logic = np.unpackbits(resp.bits[:, 0], axis=-1)[:, :64]
+        assert len(sim.capture_pos) > 0
+        assert np.array_equal(logic[sim.capture_pos], cap[sim.capture_pos, :, 0])
+        # positions that are not captured keep their stimuli
+        kept = np.setdiff1d(np.arange(width), sim.capture_pos)
+        assert np.array_equal(resp.bits[kept], tests.bits[kept])
+
+
+shift_toggle = """
+INPUT(D)
+INPUT(EN)
+OUTPUT(Q2)
+OUTPUT(TO)
+Q0 = DFF(D)
+Q1 = DFF(Q0)
+Q2 = DFF(Q1)
+T = DFF(U1)
+U1 = XOR(T, EN)
+TN = NOT(T)
+TO = NOT(TN)
+"""
+
+
+def test_cycles():
+    # a 3-stage shift register and a flip-flop that toggles when EN is 1, two independent sequences.
+    c = bench.parse(shift_toggle)
+    sim = LogicSim(c, 2)
+    d = ['101100', '011010']
+    en = ['110101', '001110']
+    stimuli = []
+    for cycle in range(6):
+        stim = PackedVectors(2, len(c.interface), 1)
+        for v in range(2):
+            stim.set_values(v, d[v][cycle] + en[v][cycle] + '00')
+        stimuli.append(stim)
+    responses = [PackedVectors(2, len(sim.interface), 1) for _ in stimuli]
+    assert sim.cycles(stimuli[:2], responses[:2]) == 2
+    assert sim.cycles(stimuli[2:], responses[2:]) == 4  # flip-flop states carry over
+    q2 = ['000101', '000011']  # D three cycles earlier
+    t = ['010011', '000101']  # number of earlier cycles with EN = 1, mod 2
+    q0 = d  # the next state of Q0 is D
+    positions = [n.name for n in sim.interface].index
+    for v in range(2):
+        assert ''.join(r.get_value(v, positions('Q2')) for r in responses) == q2[v]
+        assert ''.join(r.get_value(v, positions('TO')) for r in responses) == t[v]
+        assert ''.join(r.get_value(v, len(c.interface)) for r in responses) == q0[v]
+
+    sim.reset_flops(np.full((4, 1, 1), 255, dtype='uint8'))  # all flip-flops 1
+    resp = PackedVectors(2, len(sim.interface), 1)
+    sim.cycles([stimuli[0]], [resp])
+    assert [resp.get_value(0, positions(name)) for name in ('Q2', 'TO')] == ['1', '1']
+
+
+def test_observe(b14):
+    c, _ = b14
+    full = LogicSim(c, 32)
+    captured = list(full.capture_pos[::5])
+    sim = LogicSim(c, 32, observe=captured)
+    assert len(sim.order) < len(full.order)
+    np.random.seed(12)
+    tests = PackedVectors(32, len(full.interface), 1)
+    tests.randomize()
+    expect, resp = tests.copy(), tests.copy()
+    for s, r in ((full, expect), (sim, resp)):
+        s.assign(tests)
+        s.propagate()
+        s.capture(r)
+    assert np.array_equal(resp.bits[captured], expect.bits[captured])
+
+
+def test_recycle(b14):
+    c, _ = b14
+    full = LogicSim(c, 32, vdim=3)
+    sim = LogicSim(c, 32, vdim=3, recycle=True)
+    assert len(sim.state) < len(full.state)
+    np.random.seed(19)
+    tests = PackedVectors(32, len(full.interface), 3)
+    tests.randomize()
+    expect, resp = tests.copy(), tests.copy()
+    for s, r in ((full, expect), (sim, resp)):
+        s.assign(tests)
+        s.propagate()
+        s.capture(r)
+    assert np.array_equal(resp.bits, expect.bits)
@@ -0,0 +1,97 @@
+import numpy as np
+
+from kyupy import bench
+from kyupy.logic_sim import LogicSim
+from kyupy.packed_vectors import PackedVectors, MappedVectors
+
+
+def random_vectors(nvectors, width, vdim):
+    pv = PackedVectors(nvectors, width, vdim)
+    pv.randomize()
+    return pv
+
+
+def vectors(pv):
+    return [pv[i] for i in range(len(pv))]
+
+
+def test_slicing():
+    np.random.seed(1)
+    for vdim in (1, 2, 3):
+        a = random_vectors(37, 5, vdim)
+        ref = vectors(a)
+        for start, stop in ((0, 16), (3, 30), (8, 37), (5, 6), (0, 37), (36, 37), (9, 9)):
+            s = a[start:stop]
+            assert len(s) == stop - start
+            assert vectors(s) == ref[start:stop]
+        assert vectors(a[1:30:3]) == ref[1:30:3]
+        assert np.shares_memory(a[8:24].bits, a.bits)
+
+
+def test_concatenation():
+    np.random.seed(2)
+    for vdim_a, vdim_b in ((1, 1), (3, 3), (1, 3), (2, 3)):
+        a = random_vectors(21, 4, vdim_a)
+        b = random_vectors(11, 4, vdim_b)
+        c = a + b
+        assert c.vdim == max(vdim_a, vdim_b)
+        assert vectors(c) == vectors(a) + vectors(b)
+
+
+def test_selection():
+    np.random.seed(3)
+    a = random_vectors(45, 6, 3)
+    keep = np.random.rand(45) < 0.4
+    s = a.copy(np.packbits(keep))
+    assert vectors(s) == [v for v, k in zip(vectors(a), keep) if k]
+    assert vectors(a.copy()) == vectors(a)
+
+
+def test_mapped_vectors(tmp_path):
+    np.random.seed(4)
+    parts = [random_vectors(n, 7, 3) for n in (13, 64, 5, 700)]
+    mv = MappedVectors.create(tmp_path / 'v.vec', 7, 3, interface=[f'n{i}' for i in range(7)])
+    for p in parts:
+        mv.append(p)
+    mv.flush()
+    ref = parts[0] + parts[1] + parts[2] + parts[3]
+    for m in (mv, MappedVectors(tmp_path / 'v.vec')):
+        assert (m.nvectors, m.width, m.vdim) == (782, 7, 3)
+        assert m.interface == [f'n{i}' for i in range(7)]
+        assert np.array_equal(m.bits, ref.bits)
+        assert vectors(m[77:90]) == vectors(ref)[77:90]
+    assert np.array_equal(ref.save(tmp_path / 'w.vec').bits, ref.bits)
+
+
+def test_chunked_assign(mydir, tmp_path):
+    c = bench.parse(mydir / 'b01.bench')
+    np.random.seed(5)
+    tests = random_vectors(100, len(c.interface) + 5, 2).save(tmp_path / 't.vec')
+    full = LogicSim(c, 100, 2)
+    full.assign(tests)
+    full.propagate()
+    expect = PackedVectors(100, tests.width, 2)
+    full.capture(expect)
+    sim = LogicSim(c, 32, 2)
+    resp = PackedVectors(100, tests.width, 2)
+    for offset, _ in tests.chunks(32):
+        sim.assign(tests, offset)
+        sim.propagate()
+        sim.capture(resp, offset)
+    assert np.array_equal(resp.bits, expect.bits)
+
+
+def test_set_values_bulk():
+    rng = np.random.default_rng(6)
+    symbols = np.array(list('01-XHLRFPN'))
+    values = [''.join(rng.choice(symbols, 9)) for _ in range(30)]
+    mapping = list(rng.permutation(12)[:9])
+    inversions = list(rng.random(9) < 0.5)
+    for vdim in (1, 2, 3):
+        for selection in (slice(None), [3, 17, 4, 29, 0]):
+            bulk = random_vectors(30, 12, vdim)
+            ref = bulk.copy()
+            bulk.set_values_bulk(selection, [values[i] for i in np.arange(30)[selection]], mapping, inversions)
+            for i in np.arange(30)[selection]:
+                ref.set_values(i, values[i], mapping, inversions)
+            assert vectors(bulk) == vectors(ref), (vdim, selection)
@@ -0,0 +1,41 @@
+import numpy as np
+
+from kyupy import stil, verilog
+from kyupy.packed_vectors import MappedVectors
+
+looped = '''Pattern "_pattern_" {
+   W "_default_WFT_";
+   Loop 2 {
+      V { "_pi"=\\r36 0 ; }
+      "load": Call "load_unload" { "Scan_In"=01; }
+      Loop 2 { Call "allclock_capture" { "_pi"=1; } }
+   }
+   Ann {* done *}
+   Call "load_unload" { "Scan_Out"=10; }
+}
+'''
+
+
+def test_loops(mydir):
+    text = (mydir / 'b14.layout.trans_flt.stil').read_text()
+    text = text[:text.index('Pattern "_pattern_"')] + looped
+    names = ['load_unload', 'allclock_capture', 'allclock_capture'] * 2 + ['load_unload']
+    assert [call.name for call in stil.parse(text).calls] == names
+    calls = list(stil.StilReader(text, buffer_size=16).iter_calls())
+    assert calls == stil.parse(text).calls
+    assert calls[0].parameters == {'Scan_In': '01'}
+
+
+def test_reader(mydir, tmp_path):
+    c = verilog.parse(mydir / 'b14.layout.v')
+    s = stil.parse(mydir / 'b14.layout.trans_flt.stil')
+    r = stil.StilReader(mydir / 'b14.layout.trans_flt.stil', buffer_size=4096)
+    assert list(r.iter_patterns()) == s.patterns
+    assert np.array_equal(r.tests(c, chunk=64).bits, s.tests(c).bits)
+    assert np.array_equal(r.responses(c, chunk=64).bits, s.responses(c).bits)
+    t8 = s.tests8v(c)
+    assert np.array_equal(r.tests8v(c, chunk=64).bits, t8.bits)
+    assert r._sim4v.nvectors == 64
+    mv = r.tests8v(c, MappedVectors.create(tmp_path / 't8.vec', t8.width, 3), chunk=128)
+    assert len(mv) == len(t8)
+    assert np.array_equal(mv.bits, t8.bits)
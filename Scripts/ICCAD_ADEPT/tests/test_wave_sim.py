@@ -0,0 +1,365 @@
+import math
+
+import numpy as np
+
+from kyupy import bench, stil
+from kyupy.logic_sim import LogicSim
+from kyupy.packed_vectors import PackedVectors
+from kyupy.saif import SaifAccumulator
+from kyupy.wave_sim import WaveSim, TMAX, TMIN
+
+
+def random_tests(c, nvectors, seed=1):
+    np.random.seed(seed)
+    tests = PackedVectors(nvectors, len(c.interface) + sum('dff' in n.kind.lower() for n in c.nodes), 3)
+    tests.randomize()
+    return tests
+
+
+def test_horizon(b14):
+    c, lt = b14
+    tests = random_tests(c, 64)
+    times = [0.2, 0.4, 0.5]
+    for kw in ({}, {'encoding': 'int16'}, {'recycle': True, 'tdim': 6}):
+        results = []
+        for horizon in (None, 0.5):
+            ws = WaveSim(c, lt, sdim=64, hazards=True, **kw)
+            ws.assign(tests)
+            ws.propagate(horizon=horizon)
+            cap = np.zeros((len(ws.interface), 64, len(times)))
+            ws.capture(cap, times)
+            results.append((cap, ws.hazards[:, :2].sum()))
+        assert np.array_equal(results[0][0], results[1][0]), kw
+        assert results[1][1] < results[0][1]
+
+    margins = ws.capture_margins()
+    captured = [n.i_lines[0].index for n in ws.interface if len(n.i_lines) > 0]
+    assert np.all(margins[captured] == 0)
+    # single-input ops do not read line 0 on their unused input
+    single = (ws.ops[:, 0] == 0b1010) | (ws.ops[:, 0] == 0b0101)
+    assert not ws._line_inputs()[single, 1].any()
+
+
+def test_saif(tmp_path):
+    c = bench.parse('INPUT(a) OUTPUT(z) z = NOT(a)')
+    line = [n for n in c.nodes if n.name == 'z' and n.kind == '__fork__'][0].i_lines[0].index
+    # waveforms of line in slots 0 to 4 and their time at 0, time at 1 and toggles within [0.2, 0.6)
+    waves = [[0.1, 0.3, 0.7], [TMIN, 0.4], [], [0.2], [0.6]]
+    expect = [(0.3, 0.1, 1), (0.2, 0.2, 1), (0.4, 0.0, 0), (0.0, 0.4, 1), (0.4, 0.0, 0)]
+    for encoding in ('float32', 'int32'):
+        ws = WaveSim(c, np.zeros((len(c.lines), 2, 2)), sdim=5, encoding=encoding)
+        mem = ws.lmap[line]
+        for slot, wave in enumerate(waves):
+            raw = [t if t <= TMIN or encoding == 'float32' else round(t / ws.timescale) for t in wave]
+            ws.state[mem:mem + len(wave) + 1, slot] = [ws.tmin if t <= TMIN else t for t in raw] + [ws.tmax]
+        acc = SaifAccumulator(ws, 0.2, 0.6)
+        acc.add()
+        assert np.allclose(acc.counts[line], np.sum(expect, axis=0)), encoding
+        counts = np.zeros((len(c.lines), 3))
+        ws.saif(counts, 0.2, 0.6, sdim=2)
+        assert np.allclose(counts[line], np.sum(expect[:2], axis=0)), encoding
+    assert np.isclose(acc.duration, 5 * 0.4)
+
+    acc.add(sdim=1)
+    acc.write(tmp_path / 'z.saif', design='top', scale=1000)
+    text = (tmp_path / 'z.saif').read_text()
+    assert '(DURATION 2400)' in text
+    assert '(z\n      (T0 1600) (T1 800) (TX 0) (TZ 0) (TC 4) (IG 0)' in text
+
+
+def captures(ws, nvectors, times=(0.2, 0.4, TMAX)):
+    cap = np.zeros((len(ws.interface), nvectors, len(times)))
+    ws.capture(cap, list(times))
+    return cap
+
+
+def simulate(ws, tests, times=(0.2, 0.4, TMAX)):
+    ws.assign(tests)
+    ws.propagate()
+    return captures(ws, tests.nvectors, times)
+
+
+def wave_values(wave, times, sigma=0.0):
+    # values (or probabilities of 1 with sigma) of a waveform at times, evaluated transition by transition.
+    s_sqrt2 = sigma * math.sqrt(2)
+    m = 0.5
+    accs = [0.0] * len(times)
+    values = [0] * len(times)
+    for t in wave:
+        if t >= TMAX: break
+        for idx, time in enumerate(times):
+            if t < time:
+                values[idx] ^= 1
+        m = -m
+        if t <= TMIN: continue
+        if s_sqrt2 > 0:
+            for idx, time in enumerate(times):
+                accs[idx] += m * (1 + math.erf((t - time) / s_sqrt2))
+    if m < 0 and s_sqrt2 > 0:
+        accs = [a + 1 for a in accs]
+    return accs if s_sqrt2 > 0 else values
+
+
+def wave_stats(wave):
+    events = []
+    for t in wave:
+        if t >= TMAX: break
+        if t > TMIN:
+            events.append(t)
+    return min(events, default=TMAX), max(events, default=TMIN), len(events)
+
+
+def test_batch_kernels(b14):
+    c, lt = b14
+    tests = random_tests(c, 16, 8)
+    ws = WaveSim(c, lt, sdim=16)
+    times = [0.1, 0.3, 0.5]
+    cap = simulate(ws, tests, times)
+    cap_sigma = np.zeros_like(cap)
+    ws.capture(cap_sigma, times, sigma=0.05)
+    stats = ws.stats()
+    stats_ppo = ws.stats_ppo(sdim=8)
+    for o, node in enumerate(ws.interface):
+        if len(node.i) == 0: continue
+        for v in range(16):
+            wave = ws.wave_ppo(o, v)
+            assert list(cap[o, v]) == wave_values(wave, times), (o, v)
+            assert np.allclose(cap_sigma[o, v], wave_values(wave, times, 0.05)), (o, v)
+            if v < 8:
+                assert tuple(stats_ppo[o, v]) == wave_stats(wave)
+    for lidx in range(0, len(c.lines), 11):
+        for v in (0, 7, 15):
+            wave = ws.wave(lidx, v)
+            assert tuple(stats[lidx, v]) == wave_stats(wave)
+            assert ws.eat(lidx, v) == stats[lidx, v, 0]
+            assert ws.toggles(lidx, v) == stats[lidx, v, 2]
+            assert ws.vals(lidx, v, times) == wave_values(wave, times)
+
+
+def input_wave(symbol, time):
+    # input waveform for a stimulus symbol: initial value 1 is a transition at TMIN, toggles launch at time.
+    return {'0': [TMAX], '1': [TMIN, TMAX], 'R': [time, TMAX], 'F': [TMIN, time, TMAX],
+            'P': [TMAX], 'N': [TMIN, TMAX], '-': [TMAX], 'X': [TMIN, TMAX]}[symbol]
+
+
+def test_assign_launch_times(b14):
+    c, lt = b14
+    tests = random_tests(c, 24, 9)
+    ws = WaveSim(c, lt, sdim=16)
+    launch = np.linspace(0.0, 0.2, len(ws.interface)).astype('float32')
+    for time, offset in ((0.05, 0), (launch, 8)):
+        ws.assign(tests, time=time, offset=offset)
+        for i in range(len(ws.interface)):
+            if ws.tmap[i] < 0: continue
+            t = time if np.isscalar(time) else launch[i]
+            for v in range(16):
+                assert list(ws.wave_ppi(i, v)) == input_wave(tests[offset + v][i], t), (i, v)
+
+    # a uniform per-input launch time is the same as a scalar one
+    scalar = WaveSim(c, lt, sdim=16)
+    scalar.assign(tests, time=0.1)
+    scalar.propagate()
+    ws.assign(tests, time=np.full(len(ws.interface), 0.1))
+    ws.propagate()
+    for o in range(len(ws.interface)):
+        for v in (0, 15):
+            assert np.array_equal(ws.wave_ppo(o, v), scalar.wave_ppo(o, v))
+
+
+def test_update_delays(b14):
+    c, lt = b14
+    tests = random_tests(c, 16, 10)
+    ws = WaveSim(c, lt, sdim=16)
+    before = simulate(ws, tests)
+    assert ws.update_delays(updates=[]) == len(ws.level_starts)
+    deep = list(range(len(c.lines) // 2, len(c.lines), 97))
+    new_times = lt.copy()
+    new_times[deep, 0] *= 1.7
+    level = ws.update_delays(updates=[(lidx, p, new_times[lidx, 0, p]) for lidx in deep for p in (0, 1)])
+    assert 0 < level < len(ws.level_starts)
+    after = captures(ws, 16)
+    assert not np.array_equal(before, after)
+    assert np.array_equal(simulate(WaveSim(c, new_times, sdim=16), tests), after)
+
+    assert ws.update_delays(lt) == level
+    assert np.array_equal(captures(ws, 16), before)
+
+    # only the ops reading line 0 are affected by it, not the interface ops
+    reader = np.nonzero((ws.ops[:, 5:7] == 0).any(axis=-1))[0][0]
+    level = ws.update_delays(updates=[(0, 1, 2 * lt[0, 0, 1])], resimulate=False)
+    assert level == np.searchsorted(ws.level_starts, reader, side='right') - 1 > 0
+
+
+def test_observe(b14):
+    c, lt = b14
+    tests = random_tests(c, 16, 11)
+    full = WaveSim(c, lt, sdim=16)
+    expect = simulate(full, tests)
+    captured = [i for i, n in enumerate(full.interface) if len(n.i_lines) > 0]
+    observe = captured[::7]
+    ws = WaveSim(c, lt, sdim=16, observe=observe)
+    assert len(ws.ops) < len(full.ops)
+    ws.assign(tests)
+    ws.propagate()
+    cap = np.full(expect.shape, -1.0)
+    ws.capture(cap, [0.2, 0.4, TMAX])
+    assert np.array_equal(cap[observe], expect[observe])
+    others = np.setdiff1d(np.arange(len(ws.interface)), observe)
+    assert (cap[others] == -1).all()
+
+
+def test_hazards(b14):
+    c, lt = b14
+    tests = random_tests(c, 32, 15)
+    ws = WaveSim(c, lt, sdim=32, hazards=True)
+    assert np.array_equal(simulate(ws, tests), simulate(WaveSim(c, lt, sdim=32), tests))
+    outputs = np.unique(ws.ops[:, 4])
+    toggles = ws.stats(outputs)[..., 2].astype('int64')
+    assert np.array_equal(ws.hazards[outputs, 0], (toggles & 1).sum(axis=1))
+    assert np.array_equal(ws.hazards[outputs, 1], (toggles >> 1).sum(axis=1))
+    assert np.array_equal(ws.hazards[outputs, 4], toggles.max(axis=1))
+    assert ws.hazards[:, 1].sum() > 0 and ws.hazards[:, 2].sum() > 0
+    assert np.array_equal(ws.hazard_tdim()[outputs], toggles.max(axis=1) + 2)
+
+    first = ws.hazards.copy()
+    ws.propagate()
+    assert np.array_equal(ws.hazards[:, :4], 2 * first[:, :4])
+    ws.reset_hazards()
+    assert not ws.hazards.any()
+
+
+def test_fixed_point(b14):
+    c, lt = b14
+    quantized = np.rint(lt / 0.001) * 0.001
+    tests = random_tests(c, 32, 16)
+    times = [0.3005, 0.8005, 1.5005, TMAX]  # off the 1ps grid, so rounding cannot change a captured value
+    float_ws = WaveSim(c, quantized, sdim=32)
+    expect = simulate(float_ws, tests, times)
+    for encoding in ('int32', 'int16'):
+        ws = WaveSim(c, quantized, sdim=32, encoding=encoding)
+        assert np.array_equal(simulate(ws, tests, times), expect), encoding
+        for lidx in range(0, len(c.lines), 29):
+            assert np.allclose(ws.wave(lidx, 3), float_ws.wave(lidx, 3), atol=1e-4), (encoding, lidx)
+
+
+def test_pool(b14):
+    c, lt = b14
+    tests = random_tests(c, 32, 17)
+    default = WaveSim(c, lt, sdim=32, hazards=True)
+    expect = simulate(default, tests)
+    ws = WaveSim(c, lt, sdim=32, hazards=True, pool=64)
+    assert ws.state.shape[0] < default.state.shape[0]
+    for _ in range(2):  # the pool grows on the first run and is reused on the second
+        ws.reset_hazards()
+        assert np.array_equal(simulate(ws, tests), expect)
+        assert np.array_equal(ws.hazards, default.hazards)
+    assert ws.pool > 64
+
+
+def test_recycle(b14):
+    c, lt = b14
+    tests = random_tests(c, 32, 18)
+    default = WaveSim(c, lt, sdim=32)
+    expect = simulate(default, tests)
+    ws = WaveSim(c, lt, sdim=32, recycle=True)
+    assert ws.state.shape[0] < default.state.shape[0]
+    assert np.array_equal(simulate(ws, tests), expect)
+    assert ws.overflows == default.overflows
+
+
+def test_checkpoint_run(b14, tmp_path):
+    c, lt = b14
+    tests = random_tests(c, 64, 20)
+    times = [0.4, TMAX]
+    for kw in ({}, {'pool': 64}, {'encoding': 'int32'}):
+        ws = WaveSim(c, lt, sdim=16, **kw)
+        expect = np.zeros((len(ws.interface), 64, len(times)))
+        for offset in range(0, 64, 16):
+            ws.assign(tests, offset=offset)
+            ws.propagate()
+            ws.capture(expect, times, offset)
+        captures = np.zeros_like(expect)
+        assert WaveSim(c, lt, sdim=16, **kw).run(tests, captures, times) == 64
+        assert np.array_equal(captures, expect), kw
+
+        # interrupted after 2 chunks, resumed from the checkpoint
+        file = tmp_path / 'sim.npz'
+        partial = np.zeros_like(expect)
+        WaveSim(c, lt, sdim=16, **kw).run(tests[:32], partial, times, checkpoint=file, interval=1)
+        sim, offset, results = WaveSim.load_checkpoint(file, c)
+        assert offset == 32
+        assert sim.run(tests, results['captures'], times, offset) == 64
+        assert np.array_equal(results['captures'], expect), kw
+
+        # the restored simulator derives its capture margins for propagate with a horizon
+        sim, _, _ = WaveSim.load_checkpoint(file, c)
+        sim.assign(tests)
+        sim.propagate(horizon=times[0])
+        early = np.zeros_like(expect)
+        sim.capture(early, times[:1])
+        assert np.array_equal(early[:, :16, 0], expect[:, :16, 0]), kw
+
+
+def test_static_inputs(b14, mydir):
+    c, lt = b14
+    tests = stil.parse(mydir / 'b14.layout.trans_flt.stil').tests8v(c)[:64]
+    ws = WaveSim(c, lt, sdim=64)
+    cap = simulate(ws, tests, [-1.0, TMAX])
+    assert ws.evaluations == len(ws.ops) * 64
+    assert 0 < ws.skipped < ws.evaluations
+
+    logic = LogicSim(c, 64, vdim=3)
+    resp = tests.copy()
+    logic.assign(tests)
+    logic.propagate()
+    logic.capture(resp)
+    pos = logic.capture_pos
+    assert np.array_equal(cap[pos, :, 0], np.unpackbits(resp.initial_bits[pos], axis=-1)[:, :64])
+    assert np.array_equal(cap[pos, :, 1], np.unpackbits(resp.value_bits[pos], axis=-1)[:, :64])
+
+
+def test_static_pre_pass(b14):
+    c, lt = b14
+    tests = random_tests(c, 96, 21)
+    # few transitions: most inputs keep their initial value
+    static = np.packbits(np.random.rand(len(tests.bits), 96) < 0.95, axis=-1)
+    tests.bits[:, 1] = (static & ~tests.bits[:, 0]) | (~static & tests.bits[:, 1])
+    tests.bits[:, 2] &= ~static
+    logic = LogicSim(c, 96, vdim=3)
+    logic.assign(WaveSim.logic_stimuli(tests))
+    logic.propagate()
+    tdim = WaveSim.toggle_tdim(logic)
+    assert (tdim == 3).any()
+
+    default = WaveSim(c, lt, sdim=32)
+    ws = WaveSim(c, lt, sdim=32, tdim=tdim)
+    assert ws.state.shape[0] < default.state.shape[0]
+    for offset in (0, 64):
+        default.skipped = ws.skipped = 0
+        expect = simulate(default, tests[offset:offset + 32])
+        ws.set_static(logic, offset)
+        ws.assign(tests, offset=offset)
+        ws.propagate()
+        assert ws.skipped > default.skipped
+        assert np.array_equal(captures(ws, 32), expect), offset
+        assert ws.overflows == 0
+
+
+def test_non_line_inputs():
+    # interface and unused op inputs do not read the delays or slot delay of line 0 (z here).
+    c = bench.parse('INPUT(a)\nINPUT(b)\nOUTPUT(z)\nOUTPUT(y)\nz = AND(a, b)\ny = NOT(b)\n')
+    z, y = 0, 3
+    assert c.lines[z].driver.kind == 'AND' and c.lines[y].driver.kind == 'NOT'
+    lt = np.zeros((len(c.lines), 2, 2), dtype='float32')
+    lt[:, 0] = 0.1
+    lt[0, 0] = 1.0
+    ws = WaveSim(c, lt, sdim=2)
+    ws.set_slot_delays([0], [(2.0, 2.0)])
+    tests = PackedVectors(2, len(ws.interface), 3)
+    for v in range(2):
+        tests.set_values(v, 'RR--')
+    ws.assign(tests)
+    ws.propagate()
+    for v in range(2):
+        assert list(ws.wave(y, v)) == [TMIN, np.float32(0.1), TMAX]
+        assert list(ws.wave(z, v)) == [np.float32(0.1), TMAX]